@@ -0,0 +1,145 @@
+"""
+危険・緊急コメントのアラート。
+
+LLMのラベル付けで 危険性 が true、または 緊急性 が ALERT_URGENCY_LEVEL 以上と判定されたコメントを、
+そのチャンクをコミットした時点で Alert テーブルに保存し、購読中のクライアント (/api/alerts/stream) に送る。
+パイプライン全体 (クラスタリング・グラフ作成など) の完了は待たない。
+
+ラベル付けはバッチのワーカースレッド (スレッドごとのイベントループ) でも実行されるため、
+購読者には購読したイベントループの call_soon_threadsafe でアラートを渡す。
+"""
+import asyncio
+import logging
+import threading
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app.config import ALERT_URGENCY_LEVEL
+from app.models import Alert, Comment
+from app import metrics
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 購読者ごとのキューに溜めるアラート数の上限 (送信が追いつかない場合は古いものから捨てる。取りこぼしは since_id で取得し直せる)
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+metrics.describe("alerts_total", "counter", "危険・緊急と判定されたコメントのアラート数")
+
+
+def alert_kinds(labels: dict) -> list:
+    """ラベルからアラートの種類 ("danger" / "urgent") を返す。"""
+    kinds = []
+    if labels.get("danger"):
+        kinds.append("danger")
+    if int((labels.get("tags") or {}).get("緊急性", 0) or 0) >= ALERT_URGENCY_LEVEL:
+        kinds.append("urgent")
+    return kinds
+
+
+def alert_to_dict(alert: Alert) -> dict:
+    return {
+        "id": alert.id,
+        "comment_id": alert.comment_id,
+        "session_id": alert.session_id,
+        "kinds": alert.kinds,
+        "urgency": alert.urgency,
+        "category": alert.category,
+        "text": alert.text,
+        "created_at": alert.created_at.isoformat() if alert.created_at else None,
+    }
+
+
+class AlertHub:
+    """アラートの購読者 (SSE の接続ごとのキュー) の管理。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}  # キュー -> 購読したイベントループ
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers[queue] = asyncio.get_running_loop()
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        with self._lock:
+            self._subscribers.pop(queue, None)
+
+    @staticmethod
+    def _put(queue: asyncio.Queue, message: dict):
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(message)
+
+    def publish(self, message: dict):
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+        for queue, loop in subscribers:
+            if loop.is_closed():
+                self.unsubscribe(queue)
+                continue
+            loop.call_soon_threadsafe(self._put, queue, message)
+
+
+hub = AlertHub()
+
+
+def raise_alerts(db: Session, labeled: list, session_id: int | None = None) -> list:
+    """
+    ラベル付けしたコメント [(comment_id, text, labels), ...] のうち危険・緊急のものを Alert に保存して購読者に送り、保存したアラートを返す。
+    ラベル付けの結果をコミットした後に呼ぶ (アラートの保存に失敗してもラベルは残る)。
+    Alert.session_id はコメントを取り込んだ分析セッション (Comment.ingest_session_id)。/upload のパイプラインの実行中は
+    セッションがまだないため None で保存し、セッションの作成時に attach_alerts で設定する。session_id (コメントのスコープ) は
+    取り込み元が未設定の場合に使う。
+    """
+    flagged = [(comment_id, text, labels) for comment_id, text, labels in labeled if labels is not None and alert_kinds(labels)]
+    if not flagged:
+        return []
+    ingest_session_ids = dict(db.query(Comment.id, Comment.ingest_session_id).filter(
+        Comment.id.in_([comment_id for comment_id, _, _ in flagged])
+    ).all())
+    alerts = [
+        Alert(
+            comment_id=comment_id,
+            session_id=ingest_session_ids.get(comment_id) or session_id,
+            kinds=alert_kinds(labels),
+            urgency=int((labels.get("tags") or {}).get("緊急性", 0) or 0),
+            category=labels.get("category"),
+            text=text,
+        )
+        for comment_id, text, labels in flagged
+    ]
+    try:
+        db.add_all(alerts)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"アラートの保存中にエラーが発生しました: {e}", exc_info=True)
+        return []
+
+    for alert in alerts:
+        for kind in alert.kinds:
+            metrics.inc("alerts_total", kind=kind)
+        hub.publish(alert_to_dict(alert))
+    logger.warning(f"危険・緊急と判定されたコメント {len(alerts)} 件のアラートを送りました (コメントID: {[a.comment_id for a in alerts]})。")
+    return alerts
+
+
+def attach_alerts(db: Session, analysis_session_id: int):
+    """/upload のパイプラインで作成したセッションに、その実行で取り込んだコメントのアラートを紐付ける (コミットは呼び出し側で行う)。"""
+    ingested = select(Comment.id).where(Comment.ingest_session_id == analysis_session_id)
+    db.query(Alert).filter(Alert.session_id == None, Alert.comment_id.in_(ingested)).update(
+        {Alert.session_id: analysis_session_id}, synchronize_session=False
+    )
+
+
+def list_alerts(db: Session, since_id: int = 0, session_id: int | None = None, limit: int = 100) -> list:
+    """since_id より後のアラートを古い順に返す (session_id を指定した場合はそのセッションで取り込んだコメントのアラートだけ)。"""
+    query = db.query(Alert).filter(Alert.id > since_id)
+    if session_id is not None:
+        query = query.filter(Alert.session_id == session_id)
+    return [alert_to_dict(alert) for alert in query.order_by(Alert.id).limit(limit).all()]
@@ -1,13 +1,18 @@
 import matplotlib.pyplot as plt
+import asyncio
 import io
 import base64
+import json
+import hashlib
 from collections import defaultdict
 import logging
+import time
+import threading
+from sqlalchemy import and_, or_, func
 from sqlalchemy.orm import Session
-from app.models import Comment
-from sqlalchemy import func
-from groq import Groq, AsyncGroq # Groqクライアントをインポート
-from app.config import GROQ_API_KEY, GROQ_MODEL_NAME # config.pyからAPIキーとモデル名を読み込む
+from app.models import Comment, ClusterStat, AnalysisSession, SummaryCache, comment_scope
+from app.providers import router, classify_error # LLMプロバイダー (Groq / OpenAI互換 / ローカルモデル) の切り替え
+from app import metrics
 
 # 日本語フォントの設定 (既存)
 plt.rcParams['font.family'] = 'Meiryo' # Windowsの場合の例
@@ -17,58 +22,138 @@ plt.rcParams['axes.unicode_minus'] = False # マイナス記号を正しく表
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Groqクライアントの初期化
-groq_client = Groq(api_key=GROQ_API_KEY)
+# PN比グラフ生成用のロック (generate_pn_charts を参照)
+_chart_lock = threading.Lock()
+
+# AI分析コメントのプロンプトのバージョン。プロンプトの文面や summary_inputs の内容を変えたときは上げる
+# (ダイジェストが変わるため、以前のプロンプトで生成したキャッシュは使われなくなる)
+SUMMARY_PROMPT_VERSION = "1"
+# AI分析コメントのプロンプトに含める重要度上位クラスタの数
+SUMMARY_TOP_CLUSTERS = 3
 
 # app/analyze.py の get_comments_in_cluster 関数
 
+def _comment_scope_for(db: Session, session_id: int | None):
+    # 分析セッションIDから、そのセッションが対象とするコメントの Comment.session_id を求める
+    if session_id is None:
+        return None
+    return comment_scope(db.get(AnalysisSession, session_id))
+
+def find_cluster_stat(db: Session, cluster_id: int, session_id: int | None = None):
+    # session_id を指定しない場合は最新の集計 (最後に実行したパイプラインの集計) を返す
+    query = db.query(ClusterStat).filter(ClusterStat.cluster_id == cluster_id)
+    if session_id is not None:
+        query = query.filter(ClusterStat.session_id == session_id)
+    return query.order_by(ClusterStat.id.desc()).first()
+
+def _representative_texts(db: Session, comment_ids: list) -> dict:
+    # コメントIDのリストから {id: (text, importance_score)} を1回のクエリで取得する
+    if not comment_ids:
+        return {}
+    rows = db.query(Comment.id, Comment.text, Comment.importance_score).filter(Comment.id.in_(comment_ids)).all()
+    return {row.id: (row.text, row.importance_score) for row in rows}
+
+def _display_tags(stat: ClusterStat) -> dict:
+    # ランキング表示用のタグ: 0/1 のタグはクラスタ内に1件でもあれば 1、緊急性はクラスタ内の平均値
+    tags = {}
+    for tag_name, total in (stat.tag_sums or {}).items():
+        if tag_name == '緊急性':
+            tags[tag_name] = round(total / stat.size) if stat.size else 0
+        else:
+            tags[tag_name] = 1 if total > 0 else 0
+    return tags
+
+# クラスタ詳細のページ送り用カーソル ((importance_score, id) を URL に載せられる文字列にする)
+def encode_cluster_cursor(importance_score, comment_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([importance_score, comment_id]).encode("utf-8")).decode("ascii")
+
+def decode_cluster_cursor(cursor: str):
+    try:
+        importance_score, comment_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return (float(importance_score) if importance_score is not None else None), int(comment_id)
+    except Exception as e:
+        raise ValueError(f"不正なカーソルです: {cursor}") from e
+
 # コメント詳細表示機能 (D3) に対応する関数
-def get_comments_in_cluster(db: Session, cluster_id: int):
+# 表示に必要なカラムだけを取得し、(importance_score 降順, id 昇順) のキーセット方式でページ送りする
+def get_comments_in_cluster(db: Session, cluster_id: int, session_id: int | None = None, limit: int = 50,
+                            cursor: str | None = None, category: str | None = None,
+                            sentiment: int | None = None, danger: bool | None = None):
     logger.info(f"クラスタID {cluster_id} に属するコメントを取得します。")
-    # cluster_id に基づいて、そのクラスタ内のすべてのコメントを取得
-    comments_in_cluster = db.query(Comment).filter(
-        Comment.cluster_id == cluster_id
-    ).order_by(Comment.importance_score.desc(), Comment.id).all() # 重要度順に並べ替え
-
-    # クラスタの代表文を抽出 (今回は重要度スコアが最も高いコメントを代表文とする)
-    representative_text = None
-    if comments_in_cluster:
-        # importance_score が None のコメントがある可能性を考慮
-        valid_comments_for_rep = [c for c in comments_in_cluster if c.importance_score is not None]
-        if valid_comments_for_rep:
-            representative_text = max(valid_comments_for_rep, key=lambda c: c.importance_score).text
+    query = db.query(
+        Comment.id, Comment.text, Comment.category, Comment.danger,
+        Comment.sentiment, Comment.importance_score, Comment.tags
+    ).filter(Comment.cluster_id == cluster_id, Comment.session_id == _comment_scope_for(db, session_id))
+    if category is not None:
+        query = query.filter(Comment.category == category)
+    if sentiment is not None:
+        query = query.filter(Comment.sentiment == sentiment)
+    if danger is not None:
+        query = query.filter(Comment.danger == danger)
+
+    stat = find_cluster_stat(db, cluster_id, session_id)
+
+    # 最初のページでのみ件数を数える (2ページ目以降はクライアントが保持している値を使う)
+    total_count = None
+    if cursor is None:
+        if stat is not None and category is None and sentiment is None and danger is None:
+            total_count = stat.size
         else:
-            # 有効なスコアを持つコメントがなくても、少なくとも最初のコメントを代表とする
-            representative_text = comments_in_cluster[0].text if comments_in_cluster else "代表コメントなし"
-    
-    formatted_comments = []
-    for c in comments_in_cluster:
-        formatted_tags = {}
-        if c.tags:
-            for tag_name, tag_value in c.tags.items():
-                formatted_tags[tag_name] = tag_value 
-        
-        formatted_comments.append({
-            "id": c.id,
-            "text": c.text,
-            "category": c.category,
-            "danger": c.danger,
-            "sentiment": c.sentiment,
-            "importance_score": c.importance_score if c.importance_score is not None else 'N/A',
-            "tags": formatted_tags
-        })
+            total_count = query.count()
+    else:
+        # SQLite では NULL は最小値として扱われ、降順では末尾に並ぶ
+        last_score, last_id = decode_cluster_cursor(cursor)
+        if last_score is None:
+            query = query.filter(Comment.importance_score == None, Comment.id > last_id)
+        else:
+            query = query.filter(or_(
+                Comment.importance_score < last_score,
+                and_(Comment.importance_score == last_score, Comment.id > last_id),
+                Comment.importance_score == None
+            ))
+
+    rows = query.order_by(Comment.importance_score.desc(), Comment.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cluster_cursor(rows[-1].importance_score, rows[-1].id)
+
+    # クラスタの代表文 (重要度スコアが最も高いコメント) は ClusterStat に保存済みのIDから取得する
+    # 保存済みのIDのコメントがDBにない (アーカイブで削除済みなど) 場合は、次に重要度の高いIDのコメントを使う
+    representative_text = "代表コメントなし"
+    representative = None
+    if stat and stat.top_comment_ids:
+        texts = _representative_texts(db, stat.top_comment_ids)
+        representative = next((texts[i][0] for i in stat.top_comment_ids if i in texts), None)
+    if representative:
+        representative_text = representative
+    elif cursor is None and rows:
+        # 集計がない (クラスタ別集計の導入前のデータなど) 場合や代表のコメントがない場合は、先頭ページの最上位コメントを代表とする
+        representative_text = rows[0].text
+
+    formatted_comments = [{
+        "id": row.id,
+        "text": row.text,
+        "category": row.category,
+        "danger": row.danger,
+        "sentiment": row.sentiment,
+        "importance_score": row.importance_score,
+        "tags": dict(row.tags) if row.tags else {}
+    } for row in rows]
     logger.info(f"クラスタID {cluster_id} から {len(formatted_comments)} 件のコメントを取得しました。")
 
     return {
         "cluster_id": cluster_id,
         "representative_text": representative_text,
-        "comments": formatted_comments
+        "comments": formatted_comments,
+        "total_count": total_count,
+        "next_cursor": next_cursor
     }
 
 # ... (generate_pn_charts 関数は変更なし) ...
-def generate_pn_charts(db: Session): # db セッションを引数で受け取るように変更
+def generate_pn_charts(db: Session, session_id: int | None = None): # db セッションを引数で受け取るように変更
     logger.info("PN比グラフの生成を開始します。")
-    comments = db.query(Comment).filter(Comment.sentiment != None).all()
+    comments = db.query(Comment).filter(Comment.sentiment != None, Comment.session_id == session_id).all()
 
     if not comments:
         logger.warning("コメントデータがありません。PN比グラフは生成されません。")
@@ -77,6 +162,11 @@ def generate_pn_charts(db: Session): # db セッションを引数で受け取
             "category_pn_charts": {}
         }
 
+    # matplotlib.pyplot はスレッドセーフではないため、バッチアップロードの並列ワーカー間でグラフ生成を直列化する
+    with _chart_lock:
+        return _render_pn_charts(comments)
+
+def _render_pn_charts(comments) -> dict:
     # 全体PN比の計算
     total_pos = sum(1 for c in comments if c.sentiment == 1)
     total_neg = sum(1 for c in comments if c.sentiment == 0)
@@ -126,63 +216,91 @@ def generate_pn_charts(db: Session): # db セッションを引数で受け取
     return charts_data # 全体とカテゴリ別の両方のグラフデータを返す
 
 
-# ... (get_top_clusters_and_comments 関数は変更なし) ...
-async def get_top_clusters_and_comments(db: Session, top_n_clusters=5, comments_per_cluster=3): # ここに async を追加
+# ClusterStat (クラスタ別集計) から重要度上位のクラスタを取得する
+# session_id が None の場合は、実行中のパイプラインが作成した (セッション保存前の) 集計を参照する
+async def get_top_clusters_and_comments(db: Session, top_n_clusters=5, comments_per_cluster=3, session_id: int | None = None): # ここに async を追加
     logger.info(f"上位 {top_n_clusters} の重要度クラスタを取得します。")
-    
-    cluster_scores = db.query(
-        Comment.cluster_id,
-        func.avg(Comment.importance_score).label('avg_score'), 
-        func.count(Comment.id).label('comment_count')
-    ).filter(
-        Comment.importance_score != None,
-        Comment.cluster_id != None,
-        Comment.cluster_id != -1 
-    ).group_by(Comment.cluster_id).order_by(func.avg(Comment.importance_score).desc()).limit(top_n_clusters).all()
+
+    cluster_stats = db.query(ClusterStat).filter(
+        ClusterStat.session_id == session_id,
+        ClusterStat.avg_importance != None,
+        ClusterStat.cluster_id != -1
+    ).order_by(ClusterStat.avg_importance.desc(), ClusterStat.cluster_id).limit(top_n_clusters).all()
+
+    # 全クラスタの例コメントを1回のクエリでまとめて取得する
+    example_ids = [comment_id for stat in cluster_stats for comment_id in (stat.top_comment_ids or [])[:comments_per_cluster]]
+    examples = _representative_texts(db, example_ids)
 
     top_clusters_data = []
-    for cluster_id, avg_score, comment_count in cluster_scores:
-        cluster_comments = db.query(Comment).filter(
-            Comment.cluster_id == cluster_id,
-            Comment.importance_score != None
-        ).order_by(Comment.importance_score.desc()).limit(comments_per_cluster).all()
-
-        representative_text = "代表コメントなし"
-        if  cluster_comments:
-            valid_comments_for_rep = [c for c in cluster_comments if c.importance_score is not None]
-            if valid_comments_for_rep:
-                representative_text = max(valid_comments_for_rep, key=lambda c: c.importance_score).text
-            else:
-                representative_text = cluster_comments[0].text
-        
-        all_tags_in_cluster = set()
-        merged_tags_in_cluster = {}
-        for c in db.query(Comment).filter(Comment.cluster_id == cluster_id).all():
-            if c.tags:
-                merged_tags_in_cluster.update(c.tags) # 辞書を結合・上書き
+    for stat in cluster_stats:
+        cluster_example_ids = [i for i in (stat.top_comment_ids or [])[:comments_per_cluster] if i in examples]
+        representative_text = examples[cluster_example_ids[0]][0] if cluster_example_ids else "代表コメントなし"
 
         top_clusters_data.append({
-            "cluster_id": cluster_id,
-            "score": round(avg_score, 2),
+            "cluster_id": stat.cluster_id,
+            "score": round(stat.avg_importance, 2),
             "representative_text": representative_text,
-            "tags": merged_tags_in_cluster, # ★ここを修正: List[str] ではなく Dict[str, Any] を渡す★
-            "comment_count": comment_count,
-            "comments_examples": [{"id": c.id, "text": c.text, "importance_score": c.importance_score} for c in cluster_comments]
+            "tags": _display_tags(stat), # ★ここを修正: List[str] ではなく Dict[str, Any] を渡す★
+            "tag_sums": stat.tag_sums,
+            "comment_count": stat.size,
+            "comments_examples": [{"id": i, "text": examples[i][0], "importance_score": examples[i][1]} for i in cluster_example_ids]
         })
-        logger.info(f"クラスタID {cluster_id} のデータを取得しました。スコア: {round(avg_score, 2)}")
+        logger.info(f"クラスタID {stat.cluster_id} のデータを取得しました。スコア: {round(stat.avg_importance, 2)}")
 
     return top_clusters_data
 
-# ★★★ 新規追加関数: AI分析コメント生成 ★★★
-async def generate_ai_analysis_comment(db: Session) -> str:
-    logger.info("AI分析コメントの生成を開始します。")
-
-    # ここで AsyncGroq クライアントをインスタンス化
-    groq_client = AsyncGroq(api_key=GROQ_API_KEY) # ai_groq_client ではなく groq_client に変更
+# 感情ラベルの件数を全体とカテゴリ別に1回のクエリで数える
+# 戻り値: ({"positive", "negative", "total"}, {カテゴリ: {"positive", "negative", "total"}})。total は未ラベルのコメントを含む件数
+def count_sentiments(db: Session, scope: int | None) -> tuple:
+    rows = db.query(Comment.category, Comment.sentiment, func.count(Comment.id)).filter(
+        Comment.session_id == scope
+    ).group_by(Comment.category, Comment.sentiment).all()
+    overall = {"positive": 0, "negative": 0, "total": 0}
+    by_category = defaultdict(lambda: {"positive": 0, "negative": 0, "total": 0})
+    for category, sentiment, count in rows:
+        targets = [overall] if category is None else [overall, by_category[category]]
+        for counts in targets:
+            counts["total"] += count
+            if sentiment == 1:
+                counts["positive"] += count
+            elif sentiment == 0:
+                counts["negative"] += count
+    return overall, dict(by_category)
+
+# AI分析コメントのプロンプトに使う集計値 (AnalysisSession.summary_inputs に保存し、summary_digest のキーにもなる)
+# パイプラインで計算済みの感情の件数と重要度ランキングから作るため、生成時にコメントを集計し直さない
+def summary_inputs(overall_counts: dict, category_counts: dict, top_clusters: list) -> dict:
+    return {
+        "positive": overall_counts["positive"],
+        "negative": overall_counts["negative"],
+        "categories": {
+            category: {"positive": counts["positive"], "negative": counts["negative"]}
+            for category, counts in sorted(category_counts.items())
+            if counts["positive"] + counts["negative"] > 0
+        },
+        "top_clusters": [
+            # タグはランキング表示用の辞書 (_display_tags) のキーをプロンプトに並べる
+            {"score": cluster["score"], "representative_text": cluster["representative_text"], "tags": list(cluster["tags"] or {})}
+            for cluster in top_clusters[:SUMMARY_TOP_CLUSTERS]
+        ],
+    }
 
-    # 全体PN比の取得
-    total_pos = db.query(Comment).filter(Comment.sentiment == 1).count()
-    total_neg = db.query(Comment).filter(Comment.sentiment == 0).count()
+# summary_inputs を保存していないセッション (この機能の追加前の分析、または session_id=None) 用に、DBから集計値を作る
+async def collect_summary_inputs(db: Session, session_id: int | None = None) -> dict:
+    overall_counts, category_counts = count_sentiments(db, _comment_scope_for(db, session_id))
+    top_clusters = await get_top_clusters_and_comments(db, top_n_clusters=SUMMARY_TOP_CLUSTERS, session_id=session_id)
+    return summary_inputs(overall_counts, category_counts, top_clusters)
+
+# 集計値とプロンプトのバージョンのダイジェスト (SummaryCache のキー)
+def summary_digest(inputs: dict) -> str:
+    payload = json.dumps({"prompt_version": SUMMARY_PROMPT_VERSION, "inputs": inputs}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# AI分析コメント生成用のプロンプトを作成する
+def build_ai_analysis_prompt(inputs: dict) -> str:
+    # 全体PN比
+    total_pos = inputs["positive"]
+    total_neg = inputs["negative"]
     total_comments = total_pos + total_neg
 
     pn_ratio_str = "コメントデータがありません。"
@@ -191,42 +309,27 @@ async def generate_ai_analysis_comment(db: Session) -> str:
         neg_percent = (total_neg / total_comments) * 100
         pn_ratio_str = f"全体コメントの約{pos_percent:.1f}%がポジティブ、約{neg_percent:.1f}%がネガティブです。"
 
-    # カテゴリ別PN比の取得
-    category_sentiment_counts = defaultdict(lambda: {"positive": 0, "negative": 0, "total": 0})
-    categories = db.query(Comment.category).distinct().filter(Comment.category != None).all()
-    for category_tuple in categories:
-        category = category_tuple.category
-        cat_pos = db.query(Comment).filter(Comment.sentiment == 1, Comment.category == category).count()
-        cat_neg = db.query(Comment).filter(Comment.sentiment == 0, Comment.category == category).count()
-        cat_total = cat_pos + cat_neg
-        if cat_total > 0:
-            category_sentiment_counts[category]["positive"] = cat_pos
-            category_sentiment_counts[category]["negative"] = cat_neg
-            category_sentiment_counts[category]["total"] = cat_total
-
+    # カテゴリ別PN比
     category_summary_str = "カテゴリ別のコメント傾向は見られません。"
-    if category_sentiment_counts:
-        cat_summaries = []
-        for category, counts in category_sentiment_counts.items():
-            if counts["total"] > 0:
-                cat_pos_percent = (counts["positive"] / counts["total"]) * 100
-                cat_neg_percent = (counts["negative"] / counts["total"]) * 100
-                cat_summaries.append(f"「{category}」カテゴリでは、ポジティブが{cat_pos_percent:.1f}%、ネガティブが{cat_neg_percent:.1f}%です。")
-        if cat_summaries:
-            category_summary_str = " ".join(cat_summaries)
-
-    # 重要度上位クラスタの取得 (代表文とスコア、タグ)
-    top_clusters = await get_top_clusters_and_comments(db, top_n_clusters=3) # 上位3つのクラスタを見る
+    cat_summaries = []
+    for category, counts in inputs["categories"].items():
+        cat_total = counts["positive"] + counts["negative"]
+        cat_pos_percent = (counts["positive"] / cat_total) * 100
+        cat_neg_percent = (counts["negative"] / cat_total) * 100
+        cat_summaries.append(f"「{category}」カテゴリでは、ポジティブが{cat_pos_percent:.1f}%、ネガティブが{cat_neg_percent:.1f}%です。")
+    if cat_summaries:
+        category_summary_str = " ".join(cat_summaries)
+
+    # 重要度上位クラスタ (代表文とスコア、タグ)
     cluster_summary_str = "重要度が高いコメントは特定されませんでした。"
-    if top_clusters:
-        cluster_summaries = []
-        for cluster in top_clusters:
-            tags_str = ", ".join(cluster["tags"]) if cluster["tags"] else "なし"
-            cluster_summaries.append(
-                f"スコア {cluster['score']:.2f} のクラスタ（代表コメント:「{cluster['representative_text']}」、タグ: {tags_str}）"
-            )
-        if cluster_summaries:
-            cluster_summary_str = "重要度が高いコメント群がいくつか見つかりました。" + " ".join(cluster_summaries)
+    cluster_summaries = []
+    for cluster in inputs["top_clusters"]:
+        tags_str = ", ".join(cluster["tags"]) if cluster["tags"] else "なし"
+        cluster_summaries.append(
+            f"スコア {cluster['score']:.2f} のクラスタ（代表コメント:「{cluster['representative_text']}」、タグ: {tags_str}）"
+        )
+    if cluster_summaries:
+        cluster_summary_str = "重要度が高いコメント群がいくつか見つかりました。" + " ".join(cluster_summaries)
 
     # LLMへのプロンプト作成
     prompt = f"""
@@ -243,26 +346,91 @@ async def generate_ai_analysis_comment(db: Session) -> str:
 
     分析コメント:
     """
+    return prompt
+
+# AI分析コメントを生成しながら、トークン (テキスト断片) を順に返す非同期ジェネレーター
+# /api/ai_analysis_comment/stream から Server-Sent Events としてブラウザに中継される
+# inputs (summary_inputs の戻り値) を省略した場合はDBから集計する。同じ集計値とプロンプトで生成済みの場合はLLMを呼ばずに保存済みのコメントを返す
+async def stream_ai_analysis_comment(db: Session, session_id: int | None = None, inputs: dict | None = None):
+    logger.info("AI分析コメントのストリーミング生成を開始します。")
+    if inputs is None:
+        inputs = await collect_summary_inputs(db, session_id)
+    digest = summary_digest(inputs)
+    cached = db.get(SummaryCache, digest)
+    if cached is not None:
+        metrics.inc("llm_cache_hits_total", purpose="summary")
+        logger.info(f"同じ集計値のAI分析コメントが保存済みのため、LLMを呼ばずに返します (digest: {digest[:12]})。")
+        yield cached.summary
+        return
+    prompt = build_ai_analysis_prompt(inputs)
+
+    # プロバイダーを優先順に試す。最初のトークンを返す前に失敗した場合だけ次のプロバイダーに切り替える
+    failed_providers = set()
+    while True:
+        provider = router.pick(failed_providers)
+        if provider is None:
+            # すべてのプロバイダーのサーキットブレーカーが開いている (障害中)
+            raise RuntimeError(f"利用できるLLMプロバイダーがありません ({router.next_available_in():.0f} 秒後に再開します)。")
+        admission = provider.breaker.admit()
+        if admission is None:
+            # 選んだ後に他の呼び出しが "half_open" の試験の呼び出しを始めた
+            failed_providers.add(provider.name)
+            continue
+        try:
+            await provider.rate_limiter.acquire()
+        except asyncio.CancelledError:
+            if admission == "probe":
+                provider.breaker.release_probe()
+            raise
+        request_started = time.perf_counter()
+        started_streaming = False
+        tokens = []
+        try:
+            # 非同期イテレーターには 'async for' を使用
+            async for token in provider.astream(
+                [{"role": "user", "content": prompt}],
+                temperature=0.7,
+                max_tokens=500,
+                purpose="summary"
+            ):
+                started_streaming = True
+                tokens.append(token)
+                yield token
+        except Exception as e:
+            provider.record_failure(classify_error(provider, e))
+            metrics.inc("llm_requests_total", purpose="summary", outcome="error", provider=provider.name)
+            failed_providers.add(provider.name)
+            next_provider = router.pick(failed_providers)
+            if started_streaming or next_provider is None or next_provider.name in failed_providers:
+                raise
+            logger.warning(f"AI分析コメントの生成に失敗したため ({provider.name}: {e})、別のプロバイダーで再試行します。")
+            continue
+        elapsed = time.perf_counter() - request_started
+        provider.record_success(elapsed)
+        metrics.observe("llm_request_seconds", elapsed, purpose="summary", provider=provider.name)
+        metrics.inc("llm_requests_total", purpose="summary", outcome="success", provider=provider.name)
+        logger.info(f"AI分析コメントのストリーミング生成が完了しました ({provider.name})。")
+        _save_summary_cache(db, digest, "".join(tokens), provider.name)
+        return
+
+def _save_summary_cache(db: Session, digest: str, summary: str, provider_name: str):
+    # 同じ集計値の生成が同時に完了した場合は、後に完了した方で上書きする (どちらも同じ入力から生成したコメント)
+    try:
+        db.merge(SummaryCache(digest=digest, prompt_version=SUMMARY_PROMPT_VERSION, summary=summary, provider=provider_name))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"AI分析コメントのキャッシュを保存できませんでした: {e}")
+
+# ★★★ 新規追加関数: AI分析コメント生成 ★★★
+async def generate_ai_analysis_comment(db: Session, session_id: int | None = None, inputs: dict | None = None) -> str:
+    logger.info("AI分析コメントの生成を開始します。")
 
     ai_analysis_comment = "分析コメントの生成に失敗しました。"
     try:
-        # AsyncGroqクライアントを使用してAPIを呼び出す
-        # 'await' と 'async for' が正しく使える
-        completion = await groq_client.chat.completions.create( # await を使用
-            model=GROQ_MODEL_NAME, 
-            messages=[
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=500,
-            stream=True # ストリーミングを有効にする
-        )
-        
         full_response_content = ""
-        # 非同期イテレーターには 'async for' を使用
-        async for chunk in completion: # ここを async for に変更
-            if chunk.choices[0].delta.content:
-                full_response_content += chunk.choices[0].delta.content
+        async for token in stream_ai_analysis_comment(db, session_id, inputs):
+            full_response_content += token
         ai_analysis_comment = full_response_content
         logger.info("AI分析コメントの生成が完了しました。")
 
@@ -0,0 +1,187 @@
+"""
+近似分析モード (大規模なアンケート向け)。
+
+全コメントをLLMでラベル付けせず、埋め込みのクラスタを層とした層化抽出でサンプルだけをラベル付けし、
+全体のPN比・カテゴリの割合・カテゴリ別のPN比を、信頼区間付きで推定する。
+- 層: クラスタIDごと (ノイズ -1 も1つの層)。ラベル付け済みのコメント (再利用したラベル、/upload の累積コメント) は
+  層ごとに全数調査した層として扱い、未ラベルのコメントからだけ抽出する
+- 配分: 層のコメント数 (重複メンバーを含む) に比例し、分散を推定できるよう各層から少なくとも APPROXIMATE_MIN_PER_STRATUM 件を抽出する。
+  比例配分が下限に満たない小さなクラスタは1つの層にまとめる
+- 推定: 重複グループ (代表コメント) を抽出単位とする層化比推定。信頼区間は線形化した分散による正規近似
+推定値は AnalysisSession のPN比・カテゴリ別ポジティブ率に保存し、信頼区間などの詳細は AnalysisSession.approximation に保存する。
+"""
+import logging
+import math
+from collections import defaultdict
+
+import numpy as np
+from scipy.stats import norm
+from sqlalchemy.orm import Session
+
+from app.config import APPROXIMATE_SAMPLE_SIZE, APPROXIMATE_MIN_PER_STRATUM, APPROXIMATE_CONFIDENCE
+from app.models import Comment
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 推定値をまとめて取得する代表コメントの件数 (IN 句の上限に収めるため分割する)
+QUERY_CHUNK_SIZE = 5000
+
+
+def _population(db: Session, session_id: int | None) -> list:
+    # 抽出単位は代表コメント (重複メンバーは代表のラベルを展開するため、duplicate_count 件分として数える)
+    return db.query(Comment.id, Comment.cluster_id, Comment.duplicate_count, Comment.category).filter(
+        Comment.duplicate_of == None, Comment.session_id == session_id
+    ).all()
+
+
+def allocate(stratum_weights: dict, stratum_sizes: dict, sample_size: int, min_per_stratum: int = APPROXIMATE_MIN_PER_STRATUM) -> dict:
+    """層ごとの抽出件数を、コメント数に比例させて決める (各層の下限は min_per_stratum、上限は層の代表コメント数)。"""
+    total_weight = sum(stratum_weights.values())
+    allocation = {}
+    for key, weight in stratum_weights.items():
+        proportional = round(sample_size * weight / total_weight) if total_weight else 0
+        allocation[key] = min(stratum_sizes[key], max(proportional, min_per_stratum))
+    return allocation
+
+
+def draw_sample(db: Session, session_id: int | None = None, sample_size: int = APPROXIMATE_SAMPLE_SIZE, rng=None) -> dict:
+    """
+    未ラベルの代表コメントからクラスタ別の層化抽出を行う。
+    戻り値: {"strata": {層のキー: {"population": 代表コメント数, "weight": コメント数, "sampled": [コメントID, ...]}}, "sample_ids": [...]}
+    ラベル付け済みの代表コメントは ("labeled", クラスタID) の層として全件を含める。
+    """
+    rng = rng or np.random.default_rng()
+    strata = defaultdict(lambda: {"population": 0, "weight": 0, "ids": []})
+    for row in _population(db, session_id):
+        key = ("labeled" if row.category is not None else "sampled", row.cluster_id if row.cluster_id is not None else -1)
+        stratum = strata[key]
+        stratum["population"] += 1
+        stratum["weight"] += row.duplicate_count or 1
+        stratum["ids"].append(row.id)
+
+    # 比例配分で下限に満たない小さな層 (小さなクラスタ) は1つの層にまとめる (クラスタが多い場合に下限だけでサンプル数を超えないように)
+    total_weight = sum(s["weight"] for key, s in strata.items() if key[0] == "sampled")
+    for key in [key for key, s in strata.items() if key[0] == "sampled" and sample_size * s["weight"] < APPROXIMATE_MIN_PER_STRATUM * total_weight]:
+        small = strata.pop(key)
+        merged = strata[("sampled", "small")]
+        merged["population"] += small["population"]
+        merged["weight"] += small["weight"]
+        merged["ids"].extend(small["ids"])
+
+    unlabeled = {key: s for key, s in strata.items() if key[0] == "sampled"}
+    allocation = allocate({key: s["weight"] for key, s in unlabeled.items()}, {key: s["population"] for key, s in unlabeled.items()},
+                          sample_size)
+    sample_ids = []
+    for key, stratum in strata.items():
+        if key[0] == "labeled":
+            stratum["sampled"] = stratum["ids"]
+        else:
+            stratum["sampled"] = [int(i) for i in rng.choice(stratum["ids"], size=allocation[key], replace=False)]
+            sample_ids.extend(stratum["sampled"])
+        del stratum["ids"]
+    logger.info(
+        f"近似分析: 代表コメント {sum(s['population'] for s in unlabeled.values())} 件 ({len(unlabeled)} 層) から "
+        f"{len(sample_ids)} 件を抽出しました (ラベル付け済み {sum(s['population'] for k, s in strata.items() if k[0] == 'labeled')} 件は全件を使用)。"
+    )
+    return {"strata": dict(strata), "sample_ids": sample_ids}
+
+
+def _ratio_estimate(strata: list, y_key, x_key, z: float) -> dict | None:
+    """
+    層化比推定 R = Σ N_h ȳ_h / Σ N_h x̄_h と、その信頼区間 (パーセント)。
+    strata: [(層の代表コメント数 N_h, [抽出単位の値の辞書, ...]), ...]。ラベルが得られなかった層は推定から除く。
+    """
+    observed = [(population, np.array([y_key(u) for u in units], dtype=float), np.array([x_key(u) for u in units], dtype=float))
+                for population, units in strata if units]
+    y_total = sum(population * y.mean() for population, y, _ in observed)
+    x_total = sum(population * x.mean() for population, _, x in observed)
+    if x_total <= 0:
+        return None
+    ratio = y_total / x_total
+    variance = 0.0
+    for population, y, x in observed:
+        n = len(y)
+        # 全数調査した層 (n == N_h) と1件しか得られなかった層は分散に寄与しない (有限母集団修正)
+        if n < 2 or n >= population:
+            continue
+        residuals = y - ratio * x
+        variance += population ** 2 * (1 - n / population) * residuals.var(ddof=1) / n
+    margin = z * math.sqrt(variance) / x_total
+    return {
+        "estimate": round(ratio * 100, 2),
+        "low": round(max(ratio - margin, 0.0) * 100, 2),
+        "high": round(min(ratio + margin, 1.0) * 100, 2),
+    }
+
+
+def estimate(db: Session, sample: dict, confidence: float = APPROXIMATE_CONFIDENCE) -> dict:
+    """
+    ラベル付けしたサンプルから、全体のポジティブ・ネガティブ率、カテゴリの割合、カテゴリ別のポジティブ・ネガティブ率を推定する。
+    戻り値は AnalysisSession.approximation に保存する辞書 (パーセント単位の推定値と信頼区間)。
+    """
+    ids = [comment_id for stratum in sample["strata"].values() for comment_id in stratum["sampled"]]
+    labels = {}
+    for offset in range(0, len(ids), QUERY_CHUNK_SIZE):
+        for row in db.query(Comment.id, Comment.category, Comment.sentiment, Comment.duplicate_count).filter(
+            Comment.id.in_(ids[offset:offset + QUERY_CHUNK_SIZE]), Comment.category != None
+        ).all():
+            labels[row.id] = {"category": row.category, "sentiment": row.sentiment, "weight": row.duplicate_count or 1}
+
+    # LLMのラベル付けに失敗したコメントは無回答として層のサンプルから除く
+    strata = [(s["population"], [labels[i] for i in s["sampled"] if i in labels]) for s in sample["strata"].values()]
+    z = float(norm.ppf(0.5 + confidence / 2))
+
+    def weight(u):
+        return u["weight"]
+
+    categories = sorted({u["category"] for _, units in strata for u in units})
+
+    overall = {
+        "positive": _ratio_estimate(strata, lambda u: u["weight"] * (u["sentiment"] == 1), weight, z),
+        "negative": _ratio_estimate(strata, lambda u: u["weight"] * (u["sentiment"] == 0), weight, z),
+    }
+    by_category = {}
+    for category in categories:
+        def in_category(u, c=category):
+            return u["weight"] * (u["category"] == c)
+
+        by_category[category] = {
+            "share": _ratio_estimate(strata, in_category, weight, z),
+            "positive": _ratio_estimate(strata, lambda u, c=category: u["weight"] * (u["category"] == c and u["sentiment"] == 1), in_category, z),
+            "negative": _ratio_estimate(strata, lambda u, c=category: u["weight"] * (u["category"] == c and u["sentiment"] == 0), in_category, z),
+        }
+
+    sampled_strata = [s for key, s in sample["strata"].items() if key[0] == "sampled"]
+    return {
+        "confidence": confidence,
+        "population_comments": sum(s["weight"] for s in sample["strata"].values()),
+        "strata": len(sampled_strata),
+        "sampled_comments": sum(len(s["sampled"]) for s in sampled_strata),
+        "sampled_population": sum(s["population"] for s in sampled_strata),
+        "labeled_comments": len(labels),
+        "overall": overall,
+        "categories": by_category,
+        "refined": False,
+    }
+
+
+def estimated_counts(approximation: dict) -> tuple:
+    """
+    推定した割合を、analyze.count_sentiments と同じ形の件数 (全体, カテゴリ別) に換算する。
+    AI分析コメントのプロンプト (summary_inputs) が推定値と同じ比率を使うようにするため。
+    """
+    total = approximation["population_comments"]
+
+    def count(interval, base):
+        return int(round(interval["estimate"] / 100 * base)) if interval else 0
+
+    overall = {"positive": count(approximation["overall"]["positive"], total), "negative": count(approximation["overall"]["negative"], total),
+               "total": total}
+    by_category = {}
+    for category, intervals in approximation["categories"].items():
+        category_total = count(intervals["share"], total)
+        by_category[category] = {"positive": count(intervals["positive"], category_total), "negative": count(intervals["negative"], category_total),
+                                 "total": category_total}
+    return overall, by_category
@@ -0,0 +1,339 @@
+"""
+古い分析セッションのアーカイブ (保持期間を過ぎたコメントの列指向ファイルへの移動)。
+
+作成から ARCHIVE_RETENTION_DAYS 日を過ぎたセッションごとに、ARCHIVE_DIR/session_id=<ID>/ に以下を書き出し、DBから削除する。
+- comments.parquet: そのセッションで取り込んだコメント (zstd圧縮、埋め込みベクトルを含む。列は app.export と同じ)
+- session.json.gz: グラフ画像、重要度ランキング、AI分析コメント、クラスタ別集計 (cluster_stats)
+時系列グラフ (/api/time_series_data) と履歴一覧で使う数値 (PN比、コメント数など) は analysis_sessions に残す。
+アーカイブ済みのセッションは、分析結果・クラスタ詳細・エクスポートのAPIからファイルを読み取り専用で参照する。
+すべてのセッションを処理した後に VACUUM と ANALYZE を実行し、DBファイルを縮小して統計情報を更新する。
+
+使い方 (CLI):
+    python -m app.archive --days 180
+    python -m app.archive --dry-run
+"""
+import argparse
+import functools
+import gzip
+import json
+import logging
+import os
+import pickle
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import and_, func, or_, select, text
+from sqlalchemy.orm import Session
+
+from app.config import ARCHIVE_DIR, ARCHIVE_RETENTION_DAYS
+from app.models import Comment, AnalysisSession, ClusterStat, comment_scope
+from app.export import TAG_NAMES, CSV_COLUMNS, EXPORT_BATCH_SIZE, parquet_batches
+from app.analyze import encode_cluster_cursor, decode_cluster_cursor
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+COMMENTS_FILE = "comments.parquet"
+SIDECAR_FILE = "session.json.gz"
+
+# アーカイブ時にDBから外してサイドカーファイルに移す AnalysisSession のカラム
+SIDECAR_FIELDS = ["total_pn_chart_base64", "category_pn_charts_base64", "top_clusters_data", "ai_analysis_comment"]
+
+
+def _session_dir(session_id: int) -> str:
+    # Hive形式のパーティション名にしておくと、pyarrow.dataset で全セッションをまとめて読むこともできる
+    return os.path.join(ARCHIVE_DIR, f"session_id={session_id}")
+
+
+def find_sessions_to_archive(db: Session, retention_days: int = ARCHIVE_RETENTION_DAYS) -> list:
+    """保持期間を過ぎた、未アーカイブの完了済み (または失敗した) セッションを古い順に返す。"""
+    cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=retention_days)
+    return db.query(AnalysisSession).filter(
+        AnalysisSession.created_at < cutoff,
+        AnalysisSession.archived_at == None,
+        or_(AnalysisSession.status == None, AnalysisSession.status != "running")
+    ).order_by(AnalysisSession.created_at).all()
+
+
+def _cluster_stat_to_dict(stat: ClusterStat) -> dict:
+    return {
+        "cluster_id": stat.cluster_id,
+        "size": stat.size,
+        "avg_importance": stat.avg_importance,
+        "max_importance": stat.max_importance,
+        "tag_sums": stat.tag_sums,
+        "positive_count": stat.positive_count,
+        "negative_count": stat.negative_count,
+        "medoid_comment_id": stat.medoid_comment_id,
+        "top_comment_ids": stat.top_comment_ids,
+        "centroid": pickle.loads(stat.centroid).tolist() if stat.centroid is not None else None,
+    }
+
+
+def _write_sidecar(path: str, data: dict):
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _releasable_comments(db: Session, analysis_session: AnalysisSession):
+    """
+    アーカイブに伴ってDBから削除できるコメントの条件。
+    バッチ・ライブのセッションのコメントは、そのセッションだけが参照するため、取り込んだコメントをすべて削除する。
+    /upload のコメントは累積で、セッション X で取り込んだコメントは X 以降のすべての /upload のセッションのクラスタ・ランキングが参照する。
+    そのため、取り込んだセッションがアーカイブ済み (またはこれからアーカイブする) で、それより新しい未アーカイブの /upload のセッションが
+    ないコメントだけを削除する (残したコメントは、新しいセッションをアーカイブするときに削除される)。
+    """
+    if comment_scope(analysis_session) is not None:
+        return Comment.ingest_session_id == analysis_session.id
+    newest_active = db.query(func.max(AnalysisSession.id)).filter(
+        AnalysisSession.id != analysis_session.id, AnalysisSession.archived_at == None, AnalysisSession.batch_id == None,
+        or_(AnalysisSession.live == None, AnalysisSession.live == False)
+    ).scalar()
+    archived = select(AnalysisSession.id).where(or_(AnalysisSession.archived_at != None, AnalysisSession.id == analysis_session.id))
+    criterion = and_(Comment.session_id == None, Comment.ingest_session_id.in_(archived))
+    if newest_active is not None:
+        criterion = and_(criterion, Comment.ingest_session_id > newest_active)
+    return criterion
+
+
+def archive_session(db: Session, analysis_session: AnalysisSession) -> int:
+    """
+    1セッション分のコメントとグラフ等をファイルに書き出してDBから削除し、書き出したコメント数を返す。
+    ファイルの書き出しが完了してからDBを更新するため、途中で失敗してもコメントは失われない。
+    /upload のセッションのコメントは、新しい /upload のセッションが参照している間はDBに残す (_releasable_comments)。
+    """
+    session_dir = _session_dir(analysis_session.id)
+    os.makedirs(session_dir, exist_ok=True)
+    criterion = Comment.ingest_session_id == analysis_session.id
+    comment_count = db.query(Comment.id).filter(criterion).count()
+
+    comments_path = os.path.join(session_dir, COMMENTS_FILE)
+    tmp_path = comments_path + ".tmp"
+    for _ in parquet_batches(db, criterion, tmp_path, include_embeddings=True):
+        pass
+    os.replace(tmp_path, comments_path)
+
+    stats = db.query(ClusterStat).filter(ClusterStat.session_id == analysis_session.id).all()
+    sidecar = {field: getattr(analysis_session, field) for field in SIDECAR_FIELDS}
+    sidecar["cluster_stats"] = [_cluster_stat_to_dict(stat) for stat in stats]
+    _write_sidecar(os.path.join(session_dir, SIDECAR_FILE), sidecar)
+
+    try:
+        releasable = _releasable_comments(db, analysis_session)
+        released_ids = select(Comment.id).where(releasable)
+        # 他のセッションに残るコメントが削除するコメントを重複の代表としている場合は、自身を代表にする
+        db.query(Comment).filter(Comment.duplicate_of.in_(released_ids)).update(
+            {Comment.duplicate_of: None}, synchronize_session=False
+        )
+        released_count = db.query(Comment).filter(releasable).delete(synchronize_session=False)
+        db.query(ClusterStat).filter(ClusterStat.session_id == analysis_session.id).delete(synchronize_session=False)
+        for field in SIDECAR_FIELDS:
+            setattr(analysis_session, field, None)
+        analysis_session.archived_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        analysis_session.archive_path = session_dir
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    logger.info(
+        f"分析セッションID {analysis_session.id} のコメント {comment_count} 件を {session_dir} にアーカイブしました "
+        f"(DBから削除 {released_count} 件。新しい /upload のセッションが参照するコメントはDBに残します)。"
+    )
+    return comment_count
+
+
+def compact_database(engine):
+    """VACUUM でアーカイブ後の空き領域を解放し、ANALYZE でクエリプランナーの統計情報を更新する。"""
+    # VACUUM はトランザクションの中では実行できないため、自動コミットの接続を使う
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM"))
+        conn.execute(text("ANALYZE"))
+    logger.info("VACUUM と ANALYZE が完了しました。")
+
+
+def run_retention(db: Session, retention_days: int = ARCHIVE_RETENTION_DAYS, compact: bool = True) -> dict:
+    """保持期間を過ぎたセッションをすべてアーカイブする。1件失敗しても残りのセッションは処理する。"""
+    report = {"sessions": 0, "comments": 0, "failed": []}
+    for analysis_session in find_sessions_to_archive(db, retention_days):
+        try:
+            report["comments"] += archive_session(db, analysis_session)
+            report["sessions"] += 1
+        except Exception as e:
+            logger.error(f"分析セッションID {analysis_session.id} のアーカイブ中にエラーが発生しました: {e}", exc_info=True)
+            report["failed"].append(analysis_session.id)
+    if compact and report["sessions"]:
+        compact_database(db.get_bind())
+    return report
+
+
+# --- アーカイブ済みセッションの読み取り (読み取り専用) ---
+
+@functools.lru_cache(maxsize=32)
+def _read_sidecar(path: str, mtime_ns: int, inode: int) -> dict:
+    # クラスタ詳細のページごとに読み直さないよう、ファイルの更新時刻ごとにキャッシュする (save_session_result で書き換えると読み直す)
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_session_sidecar(analysis_session: AnalysisSession) -> dict:
+    """サイドカーファイルの内容を返す (キャッシュした辞書のため、変更する場合はコピーする)。"""
+    path = os.path.join(analysis_session.archive_path, SIDECAR_FILE)
+    stat = os.stat(path)
+    return _read_sidecar(path, stat.st_mtime_ns, stat.st_ino)
+
+
+def session_results(analysis_session: AnalysisSession) -> dict:
+    """グラフ・ランキング・AI分析コメントを返す (アーカイブ済みの場合はサイドカーファイルから読む)。"""
+    if analysis_session.archived_at is None:
+        return {field: getattr(analysis_session, field) for field in SIDECAR_FIELDS}
+    sidecar = load_session_sidecar(analysis_session)
+    return {field: sidecar.get(field) for field in SIDECAR_FIELDS}
+
+
+def save_session_result(analysis_session: AnalysisSession, field: str, value):
+    """
+    SIDECAR_FIELDS のカラムに値を保存する (コミットは呼び出し側で行う)。
+    アーカイブ済みの場合はDBのカラムではなくサイドカーファイルを書き換える (session_results がサイドカーファイルから読むため)。
+    """
+    if analysis_session.archived_at is None:
+        setattr(analysis_session, field, value)
+        return
+    sidecar = dict(load_session_sidecar(analysis_session))
+    sidecar[field] = value
+    _write_sidecar(os.path.join(analysis_session.archive_path, SIDECAR_FILE), sidecar)
+
+
+def read_archived_comments(analysis_session: AnalysisSession, columns: list | None = None, filter=None):
+    """アーカイブしたコメントを pyarrow.Table として返す (filter は pyarrow.dataset の式)。"""
+    import pyarrow.dataset as ds  # 任意の依存ライブラリのため、アーカイブの読み取り時にのみ読み込む
+
+    dataset = ds.dataset(os.path.join(analysis_session.archive_path, COMMENTS_FILE), format="parquet")
+    return dataset.to_table(columns=columns, filter=filter)
+
+
+def get_archived_comments_in_cluster(analysis_session: AnalysisSession, cluster_id: int, limit: int = 50,
+                                     cursor: str | None = None, category: str | None = None,
+                                     sentiment: int | None = None, danger: bool | None = None) -> dict:
+    """
+    app.analyze.get_comments_in_cluster と同じ形式で、アーカイブしたクラスタのコメントを返す。
+    クラスタ・絞り込み・カーソルの条件は Parquet の読み込み時に適用し、並べ替えは pyarrow で行う。
+    """
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    condition = ds.field("cluster_id") == cluster_id
+    if category is not None:
+        condition = condition & (ds.field("category") == category)
+    if sentiment is not None:
+        condition = condition & (ds.field("sentiment") == sentiment)
+    if danger is not None:
+        condition = condition & (ds.field("danger") == danger)
+
+    total_count = None
+    if cursor is not None:
+        # DBのクラスタ詳細と同じ順序 (重要度スコアの降順、スコアのないコメントは末尾、同点はID順) で、カーソルより後の行
+        last_score, last_id = decode_cluster_cursor(cursor)
+        score, comment_id = ds.field("importance_score"), ds.field("id")
+        if last_score is None:
+            condition = condition & score.is_null() & (comment_id > last_id)
+        else:
+            condition = condition & ((score < last_score) | ((score == last_score) & (comment_id > last_id)) | score.is_null())
+
+    # 並べ替えに必要な列だけを読んで今回のページの行を決め、本文・タグはページの行だけ読む
+    keys = read_archived_comments(analysis_session, ["id", "importance_score"], condition)
+    if cursor is None:
+        total_count = keys.num_rows
+    order = pc.sort_indices(keys, sort_keys=[("importance_score", "descending"), ("id", "ascending")])
+    page_ids = keys.column("id").take(order[:limit + 1])
+    columns = ["id", "text", "category", "danger", "sentiment", "importance_score"] + TAG_NAMES
+    rows_by_id = {row["id"]: row for row in read_archived_comments(analysis_session, columns, ds.field("id").isin(page_ids)).to_pylist()}
+    rows = [rows_by_id[comment_id] for comment_id in page_ids.to_pylist()]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cluster_cursor(rows[-1]["importance_score"], rows[-1]["id"])
+
+    representative_text = "代表コメントなし"
+    stat = next((s for s in load_session_sidecar(analysis_session)["cluster_stats"] if s["cluster_id"] == cluster_id), None)
+    if stat and stat["top_comment_ids"]:
+        representative = read_archived_comments(analysis_session, ["text"], ds.field("id") == stat["top_comment_ids"][0]).to_pylist()
+        if representative:
+            representative_text = representative[0]["text"]
+
+    return {
+        "cluster_id": cluster_id,
+        "representative_text": representative_text,
+        "comments": [{
+            "id": row["id"],
+            "text": row["text"],
+            "category": row["category"],
+            "danger": row["danger"],
+            "sentiment": row["sentiment"],
+            "importance_score": row["importance_score"],
+            "tags": {name: row[name] for name in TAG_NAMES if row[name] is not None},
+        } for row in rows],
+        "total_count": total_count,
+        "next_cursor": next_cursor,
+    }
+
+
+def iter_archived_parquet(analysis_session: AnalysisSession, chunk_size: int = 1024 * 1024):
+    """アーカイブしたParquetファイルをそのままバイト列のチャンクとして返す (エクスポート用)。"""
+    with open(os.path.join(analysis_session.archive_path, COMMENTS_FILE), "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def iter_archived_csv(analysis_session: AnalysisSession, batch_size: int = EXPORT_BATCH_SIZE):
+    """アーカイブしたコメントを app.export.iter_csv と同じ列のCSVとして返す。"""
+    import csv
+    import io
+    import pyarrow.parquet as pq
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")
+    writer.writerow(CSV_COLUMNS)
+    parquet_file = pq.ParquetFile(os.path.join(analysis_session.archive_path, COMMENTS_FILE))
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=CSV_COLUMNS):
+        for row in batch.to_pylist():
+            writer.writerow([row[column] for column in CSV_COLUMNS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+
+
+def main():
+    from app.config import SessionLocal, engine
+    from app.models import Base, upgrade_schema
+
+    parser = argparse.ArgumentParser(description="保持期間を過ぎた分析セッションのコメントをParquetファイルにアーカイブする")
+    parser.add_argument("--days", type=int, default=ARCHIVE_RETENTION_DAYS, help="この日数より前に作成したセッションをアーカイブする")
+    parser.add_argument("--dry-run", action="store_true", help="対象のセッションを表示するだけで、アーカイブしない")
+    parser.add_argument("--no-vacuum", action="store_true", help="VACUUM/ANALYZE を実行しない")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    upgrade_schema(engine)
+
+    db = SessionLocal()
+    try:
+        if args.dry_run:
+            for analysis_session in find_sessions_to_archive(db, args.days):
+                count = db.query(Comment.id).filter(Comment.ingest_session_id == analysis_session.id).count()
+                print(f"セッションID {analysis_session.id} ({analysis_session.csv_filename}, {analysis_session.created_at}): コメント {count} 件")
+            return
+        report = run_retention(db, args.days, compact=not args.no_vacuum)
+    finally:
+        db.close()
+    print(f"{report['sessions']} 件のセッション (コメント {report['comments']} 件) をアーカイブしました。"
+          + (f" 失敗: {report['failed']}" if report["failed"] else ""))
+
+
+if __name__ == "__main__":
+    main()
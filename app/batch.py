@@ -0,0 +1,232 @@
+"""
+複数ファイル (講義ごとのCSV) の一括分析。
+
+ディレクトリまたはzipに含まれるCSVごとに AnalysisSession を1件作成し、ワーカースレッドのプールで並列に分析する。
+- 各ファイルのコメントは Comment.session_id でセッションごとに分けて取り込み、他のファイルとは混ぜずに分析する
+- LLM呼び出しのレート上限 (app.providers の各プロバイダーの rate_limiter) と埋め込みモデル (app.cluster.get_model()、または埋め込みサーバー) は全ワーカーで共有する
+- 分析済みのファイルと内容が同じCSVは分析せず、既存のセッションを返す (app.fingerprint)
+- 進捗はメモリ上のジョブ一覧に記録し、/api/batch/{batch_id} またはCLIの出力で確認できる
+
+使い方 (CLI):
+    python -m app.batch path/to/surveys/ --workers 8
+    python -m app.batch surveys.zip
+"""
+import argparse
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import pandas as pd
+
+from app.config import SessionLocal, BATCH_WORKERS, UPLOAD_REUSE_ENABLED
+from app.models import AnalysisSession
+from app.pipeline import run_analysis_pipeline
+from app.fingerprint import file_sha256, find_analyzed_session
+from app.llm import get_label_queue_status
+from app.providers import router as llm_router
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 実行中・実行済みのバッチジョブ (batch_id -> BatchJob)。プロセスを再起動すると消える
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+class BatchJob:
+    """1回のバッチアップロード (複数ファイル) の進捗。"""
+
+    def __init__(self, batch_id: str, paths: list):
+        self.batch_id = batch_id
+        self.created_at = datetime.now(timezone.utc)
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self.files = [
+            {"filename": os.path.basename(path), "path": path, "status": "queued", "session_id": None, "comments": None, "reused": False, "error": None}
+            for path in paths
+        ]
+
+    def update(self, index: int, **values):
+        with self._lock:
+            self.files[index].update(values)
+
+    @property
+    def status(self) -> str:
+        with self._lock:
+            if self.finished_at is not None:
+                return "done"
+            if any(f["status"] != "queued" for f in self.files):
+                return "running"
+            return "queued"
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            files = [{k: v for k, v in f.items() if k != "path"} for f in self.files]
+        counts = {state: sum(1 for f in files if f["status"] == state) for state in ("queued", "running", "done", "failed")}
+        return {
+            "batch_id": self.batch_id,
+            "status": self.status,
+            "created_at": self.created_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "total_files": len(files),
+            "files_by_status": counts,
+            "files": files,
+        }
+
+
+def new_batch_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+def get_job(batch_id: str):
+    with _jobs_lock:
+        return _jobs.get(batch_id)
+
+
+def collect_csv_files(path: str, extract_dir: str) -> list:
+    """
+    ディレクトリ (サブディレクトリを含む) またはzipファイルからCSVファイルのパスを集める。
+    zipの場合は extract_dir に展開する。
+    """
+    if zipfile.is_zipfile(path):
+        paths = []
+        with zipfile.ZipFile(path) as archive:
+            for member in archive.infolist():
+                name = member.filename
+                if member.is_dir() or not name.lower().endswith(".csv") or name.startswith("__MACOSX/"):
+                    continue
+                # extract はzip内の絶対パスや ".." を取り除いて extract_dir の中に展開する
+                paths.append(archive.extract(member, extract_dir))
+        return sorted(paths)
+
+    if os.path.isdir(path):
+        paths = []
+        for root, _dirs, filenames in os.walk(path):
+            paths.extend(os.path.join(root, name) for name in filenames if name.lower().endswith(".csv"))
+        return sorted(paths)
+
+    if path.lower().endswith(".csv"):
+        return [path]
+    raise ValueError(f"CSVファイルを含むディレクトリまたはzipファイルを指定してください: {path}")
+
+
+async def _run_pipeline(db, df, filename: str, analysis_session: AnalysisSession):
+    try:
+        await run_analysis_pipeline(db, df, filename, analysis_session)
+    finally:
+        # ワーカースレッドのイベントループはこのファイルの処理が終わると閉じるため、そのループで作ったLLMの接続プールも閉じる
+        await llm_router.aclose()
+
+
+def _process_file(job: BatchJob, index: int):
+    """1ファイル分の分析をワーカースレッドで実行する (スレッドごとにDBセッションとイベントループを持つ)。"""
+    file_info = job.files[index]
+    db = SessionLocal()
+    analysis_session = None
+    try:
+        job.update(index, status="running")
+        with open(file_info["path"], "rb") as f:
+            sha256 = file_sha256(f)
+        existing_session = find_analyzed_session(db, sha256) if UPLOAD_REUSE_ENABLED else None
+        if existing_session is not None:
+            # 同じ内容のファイルを分析済みの場合は、パイプラインを実行せずにそのセッションを返す
+            job.update(index, status="done", session_id=existing_session.id, comments=existing_session.total_comments, reused=True)
+            logger.info(f"[batch {job.batch_id}] {file_info['filename']} は分析セッションID {existing_session.id} と同じ内容のため、分析を省略しました。")
+            return
+
+        df = pd.read_csv(file_info["path"])
+        if df.empty or df.iloc[:, 0].isnull().all():
+            raise ValueError("CSVファイルが空であるか、コメントデータが含まれていません。")
+
+        analysis_session = AnalysisSession(csv_filename=file_info["filename"], status="running", batch_id=job.batch_id, file_sha256=sha256)
+        db.add(analysis_session)
+        db.commit()
+        job.update(index, session_id=analysis_session.id)
+
+        asyncio.run(_run_pipeline(db, df, file_info["filename"], analysis_session))
+        job.update(index, status="done", comments=analysis_session.total_comments)
+        logger.info(f"[batch {job.batch_id}] {file_info['filename']} の分析が完了しました (セッションID {analysis_session.id})。")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"[batch {job.batch_id}] {file_info['filename']} の分析中にエラーが発生しました: {e}", exc_info=True)
+        job.update(index, status="failed", error=str(e))
+        if analysis_session is not None and analysis_session.id is not None:
+            analysis_session.status = "failed"
+            db.commit()
+    finally:
+        db.close()
+
+
+def run_batch(job: BatchJob, workers: int = BATCH_WORKERS):
+    """ジョブの全ファイルをワーカープールで処理し、すべて終わるまで待つ。"""
+    logger.info(f"[batch {job.batch_id}] {len(job.files)} 件のファイルを {workers} 並列で分析します。")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix=f"batch-{job.batch_id}") as executor:
+        for index in range(len(job.files)):
+            executor.submit(_process_file, job, index)
+    job.finished_at = datetime.now(timezone.utc)
+    logger.info(f"[batch {job.batch_id}] すべてのファイルの処理が完了しました ({time.perf_counter() - started:.1f} 秒)。")
+
+
+def start_batch(paths: list, batch_id: str | None = None, workers: int = BATCH_WORKERS) -> BatchJob:
+    """バッチジョブを登録し、バックグラウンドのスレッドで処理を開始する。"""
+    job = BatchJob(batch_id or new_batch_id(), paths)
+    with _jobs_lock:
+        _jobs[job.batch_id] = job
+    threading.Thread(target=run_batch, args=(job, workers), name=f"batch-{job.batch_id}", daemon=True).start()
+    return job
+
+
+def batch_progress(job: BatchJob) -> dict:
+    """ジョブの進捗に、処理中のファイルのLLMラベル付けの進捗 (状態ごとの件数) とLLMプロバイダーの状態を加えて返す。"""
+    progress = job.to_dict()
+    # サーキットブレーカーが開いている間はラベル付けが止まるため、その状態も返す
+    progress["llm"] = llm_router.status()
+    running = [f for f in progress["files"] if f["status"] == "running" and f["session_id"] is not None]
+    if running:
+        db = SessionLocal()
+        try:
+            for file_info in running:
+                file_info["labeling"] = get_label_queue_status(db, file_info["session_id"])["counts"]
+        finally:
+            db.close()
+    return progress
+
+
+def main():
+    from app.config import engine, UPLOAD_DIR
+    from app.models import Base, upgrade_schema
+
+    parser = argparse.ArgumentParser(description="ディレクトリまたはzipに含まれるCSVをファイルごとに分析する")
+    parser.add_argument("path", help="CSVファイルを含むディレクトリまたはzipファイル")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="同時に処理するファイル数")
+    parser.add_argument("--interval", type=float, default=5.0, help="進捗を表示する間隔 (秒)")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    upgrade_schema(engine)
+
+    batch_id = new_batch_id()
+    paths = collect_csv_files(args.path, os.path.join(UPLOAD_DIR, f"batch_{batch_id}"))
+    if not paths:
+        parser.error(f"CSVファイルが見つかりません: {args.path}")
+
+    job = start_batch(paths, batch_id, args.workers)
+    while job.status != "done":
+        time.sleep(args.interval)
+        counts = job.to_dict()["files_by_status"]
+        print(f"[batch {job.batch_id}] 完了 {counts['done']} / 失敗 {counts['failed']} / 処理中 {counts['running']} / 待機 {counts['queued']} (全 {len(paths)} 件)", flush=True)
+
+    for file_info in job.to_dict()["files"]:
+        print(f"{file_info['filename']}: {file_info['status']} (セッションID {file_info['session_id']}, コメント {file_info['comments']} 件){' ' + file_info['error'] if file_info['error'] else ''}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,74 @@
 from sentence_transformers import SentenceTransformer
 # from sklearn.cluster import DBSCAN # HDBSCANを使用する場合は不要
 import hdbscan # HDBSCANを使用する場合にインポート
+import base64
 import pickle
 import logging # ロギングのためのインポート
+import threading
+import httpx
+import numpy as np
 from sqlalchemy.orm import Session
 from app.models import Comment
-from app.config import MIN_CLUSTER_SIZE, EMBEDDING_MODEL_NAME # config.py から設定を読み込むことを想定
+from app.config import MIN_CLUSTER_SIZE, EMBEDDING_MODEL_NAME, EMBEDDING_SERVER_URL, EMBEDDING_SERVER_TIMEOUT # config.py から設定を読み込むことを想定
+from app import metrics
 
 # ロガーの設定
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Sentence-BERTモデルのロード
-# 要件定義書に記載のモデル名を使用
-model = SentenceTransformer(EMBEDDING_MODEL_NAME) # 'all-MiniLM-L6-v2' など
+# Sentence-BERTモデル
+# 要件定義書に記載のモデル名を使用 ('all-MiniLM-L6-v2' など)
+# 埋め込みサーバー (EMBEDDING_SERVER_URL) を使う場合はワーカーごとにモデルを読み込まないよう、最初に必要になった時点で読み込む
+_model = None
+_model_lock = threading.Lock()
 
-async def cluster_comments(db: Session): # ここに async を追加
+def get_model() -> SentenceTransformer:
+    global _model
+    with _model_lock:
+        if _model is None:
+            logger.info(f"埋め込みモデル {EMBEDDING_MODEL_NAME} を読み込みます。")
+            _model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+        return _model
+
+_server_client = None
+
+def _encode_with_server(texts: list) -> np.ndarray:
+    # 埋め込みサーバー (app.embedding_server) に問い合わせる。"unix:///path/to.sock" の場合はUnixソケットで接続する
+    global _server_client
+    if _server_client is None:
+        if EMBEDDING_SERVER_URL.startswith("unix://"):
+            transport = httpx.HTTPTransport(uds=EMBEDDING_SERVER_URL[len("unix://"):])
+            _server_client = httpx.Client(transport=transport, base_url="http://embedding-server", timeout=EMBEDDING_SERVER_TIMEOUT)
+        else:
+            _server_client = httpx.Client(base_url=EMBEDDING_SERVER_URL, timeout=EMBEDDING_SERVER_TIMEOUT)
+    response = _server_client.post("/encode", json={"texts": texts})
+    response.raise_for_status()
+    body = response.json()
+    return np.frombuffer(base64.b64decode(body["embeddings"]), dtype=np.float32).reshape(len(texts), body["dim"])
+
+def encode_texts(texts: list) -> np.ndarray:
+    """
+    テキストの埋め込みベクトルを返す。
+    EMBEDDING_SERVER_URL が設定されていれば埋め込みサーバーを使い、未設定または接続できない場合はこのプロセスのモデルで計算する。
+    """
+    if EMBEDDING_SERVER_URL:
+        try:
+            embeddings = _encode_with_server(texts)
+            metrics.inc("embedding_requests_total", backend="server")
+            return embeddings
+        except Exception as e:
+            logger.warning(f"埋め込みサーバー ({EMBEDDING_SERVER_URL}) を利用できないため、このプロセスで埋め込みを計算します: {e}")
+    metrics.inc("embedding_requests_total", backend="local")
+    return get_model().encode(texts, convert_to_numpy=True)
+
+async def cluster_comments(db: Session, labeled_only: bool = True, session_id: int | None = None): # ここに async を追加
+    # labeled_only=False の場合はLLMラベル付け前のコメントもクラスタリングする (cluster_first パイプライン用)
     logger.info("クラスタリングを開始します。") # main.py との重複を避けるため、cluster.py での開始ログはより詳細に
-    comments_to_cluster = db.query(Comment).filter(Comment.sentiment != None).all()
+    # 重複メンバーは代表コメントのクラスタを展開するため、代表コメントのみをクラスタリングする
+    query = db.query(Comment).filter(Comment.duplicate_of == None, Comment.session_id == session_id)
+    if labeled_only:
+        query = query.filter(Comment.sentiment != None)
+    comments_to_cluster = query.all()
     
     if not comments_to_cluster:
         logger.info("クラスタリングすべきコメントはありません。")
@@ -29,10 +80,27 @@ async def cluster_comments(db: Session): # ここに async を追加
     # sentence-transformers の encode メソッドは通常同期的に動作しますが、
     # 大規模なデータセットではI/Oバウンドになり得るため、非同期の実行コンテキストで呼び出すことが推奨される場合もあります。
     # しかし、ここではモデルの推論自体はCPU/GPUバウンドなので、そのまま呼び出します。
-    embeddings = model.encode(texts, convert_to_numpy=True)
+    with metrics.span("embedding"):
+        # 保存済みの埋め込み (前回のクラスタリング、または fingerprint.py で再利用したもの) はそのまま使い、未計算のコメントだけを埋め込む
+        missing = [i for i, c in enumerate(comments_to_cluster) if c.embedding is None]
+        embeddings = [None] * len(texts)
+        if missing:
+            encoded = encode_texts([texts[i] for i in missing])
+            for i, vector in zip(missing, encoded):
+                embeddings[i] = vector
+        for i, comment in enumerate(comments_to_cluster):
+            if comment.embedding is not None:
+                embeddings[i] = pickle.loads(comment.embedding)
+        embeddings = np.vstack(embeddings)
+        metrics.inc("embedding_cache_hits_total", len(texts) - len(missing))
 
-    clusterer = hdbscan.HDBSCAN(min_cluster_size=MIN_CLUSTER_SIZE, metric='euclidean', cluster_selection_epsilon=0.0)
-    labels = clusterer.fit_predict(embeddings)
+    with metrics.span("clustering"):
+        if len(texts) < MIN_CLUSTER_SIZE:
+            # 重複集約後などでコメント数が最小クラスタサイズに満たない場合、HDBSCANは実行できないため全件ノイズとする
+            labels = [-1] * len(texts)
+        else:
+            clusterer = hdbscan.HDBSCAN(min_cluster_size=MIN_CLUSTER_SIZE, metric='euclidean', cluster_selection_epsilon=0.0)
+            labels = clusterer.fit_predict(embeddings)
 
     noise_count = 0
     clustered_comment_count = 0
@@ -40,7 +108,8 @@ async def cluster_comments(db: Session): # ここに async を追加
 
     for i, (comment, label) in enumerate(zip(comments_to_cluster, labels)):
         comment.cluster_id = int(label)
-        comment.embedding = pickle.dumps(embeddings[i])
+        if comment.embedding is None:
+            comment.embedding = pickle.dumps(embeddings[i])
 
         if label == -1:
             noise_count += 1
@@ -51,7 +120,8 @@ async def cluster_comments(db: Session): # ここに async を追加
         db.add(comment)
         
     try:
-        db.commit()
+        with metrics.span("db_commit"):
+            db.commit()
         logger.info(f"コメントのクラスタリングが完了しました。")
         logger.info(f"  総コメント数: {len(comments_to_cluster)}")
         logger.info(f"  生成されたクラスタ数: {len(unique_clusters)}")
@@ -0,0 +1,223 @@
+import logging
+import pickle
+from collections import defaultdict
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app.models import Comment
+from app.llm import label_comment, reset_stale_label_states
+from app.providers import Deadline
+from app.config import (
+    CLUSTER_FIRST_EXEMPLARS, CLUSTER_FIRST_SIMILARITY_THRESHOLD, PRIORITY_MIN_SCORE, PRIORITY_COMMIT_CHUNK_SIZE, LABEL_COMMIT_CHUNK_SIZE,
+)
+from app.priority import prescore_texts
+from app.alerts import raise_alerts
+from app import metrics
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# ラベル付けの結果としてまとめて書き込むカラム
+_LABEL_COLUMNS = ("category", "danger", "sentiment", "tags", "label_state", "label_error", "label_attempts", "label_provider")
+# 状態を "in_flight" にするときの IN 句1回あたりのコメント数
+_STATE_UPDATE_CHUNK_SIZE = 500
+
+
+def _normalize_rows(embeddings: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
+
+def _copy_labels(source: Comment, target: Comment):
+    target.category = source.category
+    target.danger = source.danger
+    target.sentiment = source.sentiment
+    target.tags = dict(source.tags) if source.tags is not None else None
+    target.label_state = "done"
+    target.label_error = None
+    target.label_provider = source.label_provider
+
+
+def _mark_in_flight(db: Session, comments: list):
+    # llm.label_comments と同じく、LLMに送る前に "in_flight" にしてコミットする (中断された場合は reset_stale_label_states で戻る)
+    ids = [c.id for c in comments]
+    for start in range(0, len(ids), _STATE_UPDATE_CHUNK_SIZE):
+        db.query(Comment).filter(Comment.id.in_(ids[start:start + _STATE_UPDATE_CHUNK_SIZE])).update(
+            {Comment.label_state: "in_flight"}, synchronize_session=False
+        )
+    db.commit()
+    for comment in comments:
+        comment.label_state = "in_flight"
+
+
+async def label_clusters_by_exemplars(db: Session, session_id: int | None = None, deadline: Deadline | None = None, rng=None) -> dict:
+    """
+    クラスタリング済み・未ラベルの代表コメントを、クラスタ単位でラベル付けする (cluster_first パイプライン用)。
+    各クラスタの medoid (重心に最も近いコメント) と、数件の例コメント (medoid を含めて CLUSTER_FIRST_EXEMPLARS 件) だけをLLMでラベル付けし、
+    medoid とのコサイン類似度が閾値以上のメンバーには medoid のラベルを展開する。
+    閾値未満のメンバーとノイズ (cluster_id == -1) は個別にLLMでラベル付けする。
+
+    例コメントは、ラベルを展開する対象 (medoid との類似度が閾値以上のメンバー) から無作為に抽出して個別にラベル付けし、
+    そのラベルと medoid のラベルの一致率を「展開したラベルと全件ラベル付けとの一致率」の推定値として返す
+    (medoid に最も近いメンバーだけを選ぶと、一致しやすいメンバーに偏って一致率が高く出るため)。rng は抽出に使う乱数生成器。
+    deadline (パイプラインの時間予算) を使い切った後のコメントはLLMを呼ばずに未ラベルのまま残す (次回の実行で処理する)。
+
+    危険・緊急を示す語を含むコメント (priority.prescore が PRIORITY_MIN_SCORE 以上) は medoid のラベルを展開せず、最初に個別にラベル付けして
+    PRIORITY_COMMIT_CHUNK_SIZE 件ごとにコミットし、危険・緊急と判定されたものはその時点でアラートを送る。
+    llm.label_comments と同じく、処理中のコメントは "in_flight" にし、結果はクラスタごと (小さなクラスタは LABEL_COMMIT_CHUNK_SIZE 件まで
+    まとめる)、個別のラベル付けは LABEL_COMMIT_CHUNK_SIZE 件ごとにコミットする。途中で中断しても書き込み済みのラベルは残る。
+    """
+    rng = rng or np.random.default_rng()
+    reset_stale_label_states(db, session_id)
+    comments = db.query(Comment).filter(
+        Comment.category == None, Comment.duplicate_of == None, Comment.session_id == session_id
+    ).all()
+    # 結果はチャンクごとに bulk_update_mappings で書き込むため、コミットのたびに読み直されないようセッションから外す
+    for comment in comments:
+        db.expunge(comment)
+
+    report = {
+        "clusters": 0,
+        "llm_calls": 0,
+        "propagated": 0,
+        "individual": 0,
+        "failed": 0,
+        "deadline_skipped": 0,
+        "priority": 0,
+        "exemplar_pairs": 0,
+        "category_agreement": None,
+        "sentiment_agreement": None,
+    }
+    if not comments:
+        logger.info("クラスタ単位でラベル付けすべきコメントはありません。")
+        return report
+
+    # 事前スコアの高いコメントはクラスタから外し、先に個別にラベル付けする
+    scores = prescore_texts([c.text for c in comments])
+    priority = [c for c, score in sorted(zip(comments, scores), key=lambda pair: -pair[1]) if score >= PRIORITY_MIN_SCORE]
+    priority_ids = {c.id for c in priority}
+    report["priority"] = len(priority)
+
+    by_cluster = defaultdict(list)
+    individual = []
+    for comment in comments:
+        if comment.id in priority_ids:
+            continue
+        if comment.cluster_id is None or comment.cluster_id == -1 or comment.embedding is None:
+            individual.append(comment)
+        else:
+            by_cluster[comment.cluster_id].append(comment)
+
+    # コミット待ちのコメント (LLMのラベル、展開したラベル、"failed" / "pending" の状態) と、
+    # LLMでラベル付けしたコメント (アラートの判定に使う。展開したラベルではアラートを送らない)
+    written = []
+    labeled = []
+
+    def checkpoint():
+        # llm.label_comments と同じく、チャンクの結果をまとめて書き込んでコミットし、危険・緊急のコメントのアラートを送る
+        nonlocal labeled
+        if not written:
+            return
+        try:
+            db.bulk_update_mappings(Comment, [{"id": c.id, **{column: getattr(c, column) for column in _LABEL_COLUMNS}} for c in written])
+            with metrics.span("db_commit"):
+                db.commit()
+            raise_alerts(db, labeled, session_id)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"クラスタ単位のラベル付け結果のコミット中にエラーが発生しました: {e}", exc_info=True)
+        written.clear()
+        labeled = []
+
+    async def label(comment: Comment) -> bool:
+        written.append(comment)
+        if deadline is not None and deadline.expired():
+            # 次回の実行で処理するため "pending" に戻す
+            comment.label_state = "pending"
+            report["deadline_skipped"] += 1
+            return False
+        report["llm_calls"] += 1
+        if await label_comment(comment, deadline):
+            labeled.append((comment.id, comment.text, {"category": comment.category, "danger": comment.danger, "tags": comment.tags}))
+            return True
+        report["failed"] += 1
+        return False
+
+    for start in range(0, len(priority), max(PRIORITY_COMMIT_CHUNK_SIZE, 1)):
+        chunk = priority[start:start + PRIORITY_COMMIT_CHUNK_SIZE]
+        _mark_in_flight(db, chunk)
+        for comment in chunk:
+            report["individual"] += 1
+            await label(comment)
+        checkpoint()
+
+    category_matches = 0
+    sentiment_matches = 0
+
+    for cluster_id, members in by_cluster.items():
+        report["clusters"] += 1
+        vectors = _normalize_rows(np.vstack([pickle.loads(c.embedding) for c in members]).astype(np.float32))
+        centroid = vectors.mean(axis=0)
+        centroid /= np.linalg.norm(centroid) or 1.0
+        medoid_index = int(np.argmax(vectors @ centroid))
+        similarities = vectors @ vectors[medoid_index]
+        # クラスタのメンバーは、ラベルを展開するか個別のラベル付けに回すまで "in_flight" にする
+        _mark_in_flight(db, members)
+
+        # 例コメントはラベルを展開する対象のメンバーから無作為に選ぶ (medoid 自身が先頭)
+        propagated = np.flatnonzero(similarities >= CLUSTER_FIRST_SIMILARITY_THRESHOLD)
+        propagated = propagated[propagated != medoid_index]
+        audit_size = min(max(CLUSTER_FIRST_EXEMPLARS - 1, 0), len(propagated))
+        exemplar_indices = [medoid_index] + [int(i) for i in rng.choice(propagated, size=audit_size, replace=False)]
+        medoid = members[medoid_index]
+
+        if not await label(medoid):
+            # medoid のラベルが得られなければ展開元がないため、クラスタ全体を個別ラベル付けに回す
+            individual.extend(c for i, c in enumerate(members) if i != medoid_index)
+            continue
+
+        for i in exemplar_indices[1:]:
+            exemplar = members[i]
+            if await label(exemplar):
+                report["exemplar_pairs"] += 1
+                category_matches += exemplar.category == medoid.category
+                sentiment_matches += exemplar.sentiment == medoid.sentiment
+
+        exemplar_set = set(exemplar_indices)
+        for i, member in enumerate(members):
+            if i in exemplar_set:
+                continue
+            if similarities[i] >= CLUSTER_FIRST_SIMILARITY_THRESHOLD:
+                _copy_labels(medoid, member)
+                written.append(member)
+                report["propagated"] += 1
+            else:
+                individual.append(member)
+        # クラスタ単位でコミットする (小さなクラスタは LABEL_COMMIT_CHUNK_SIZE 件までまとめる)
+        if len(written) >= LABEL_COMMIT_CHUNK_SIZE:
+            checkpoint()
+    checkpoint()
+
+    for start in range(0, len(individual), LABEL_COMMIT_CHUNK_SIZE):
+        chunk = individual[start:start + LABEL_COMMIT_CHUNK_SIZE]
+        _mark_in_flight(db, chunk)
+        for comment in chunk:
+            report["individual"] += 1
+            await label(comment)
+        checkpoint()
+
+    # LLMを呼ばずに medoid のラベルを再利用した件数をキャッシュヒットとして数える
+    metrics.inc("llm_cache_hits_total", report["propagated"], purpose="label")
+    if report["exemplar_pairs"]:
+        report["category_agreement"] = round(category_matches / report["exemplar_pairs"], 4)
+        report["sentiment_agreement"] = round(sentiment_matches / report["exemplar_pairs"], 4)
+
+    logger.info(
+        f"クラスタ単位のラベル付けが完了しました。対象 {len(comments)} 件、クラスタ {report['clusters']} 件、"
+        f"LLM呼び出し {report['llm_calls']} 回、展開 {report['propagated']} 件、個別 {report['individual']} 件、"
+        f"一致率 (カテゴリ/感情): {report['category_agreement']} / {report['sentiment_agreement']}"
+    )
+    return report
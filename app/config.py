@@ -1,19 +1,49 @@
 import os
+import time
+import logging
 from dotenv import load_dotenv 
 
 load_dotenv()
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
+from app import metrics
 
 # データベース設定
-DATABASE_URL = "sqlite:///./comments.db" # SQLite を使用する場合
+# 環境変数 DATABASE_URL で上書き可能 (ベンチマークなどで別のDBファイルを使う場合)
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./comments.db") # SQLite を使用する場合
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False}) # SQLite の場合のみ connect_args が必要
+# SQLite の場合のみ connect_args が必要
+# バッチアップロードでは複数スレッドが同時に書き込むため、ロック待ちのタイムアウトを長めにする
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# デバッグモード (True の場合、APIレスポンスに X-DB-Query-Count / X-DB-Query-Time-Ms ヘッダーを付ける)
+DEBUG = os.getenv("DEBUG", "false").lower() == "true"
+
+# この時間 (ミリ秒) 以上かかったSQLクエリをパラメータ付きでログに出す
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "200"))
+
+_query_logger = logging.getLogger("app.sql")
+
+# SQLクエリごとの実行時間を計測し、リクエスト別・ステージ別のクエリ数/時間と遅いクエリのログを記録する
+@event.listens_for(engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+@event.listens_for(engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started_at"].pop()
+    metrics.record_db_query(elapsed)
+    if elapsed * 1000 >= SLOW_QUERY_THRESHOLD_MS:
+        metrics.inc("db_slow_queries_total")
+        _query_logger.warning(f"遅いSQLクエリ ({elapsed * 1000:.1f} ms): {statement} パラメータ: {str(parameters)[:500]}")
+
+# この大きさ (バイト) 以上のAPIレスポンスを gzip で圧縮する (ブラウザが Accept-Encoding: gzip を送った場合)
+GZIP_MINIMUM_SIZE = int(os.getenv("GZIP_MINIMUM_SIZE", "1000"))
+
 # CSVアップロードディレクトリ
-UPLOAD_DIR = "uploads"
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
 
 # Groq APIキー
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
@@ -27,13 +57,141 @@ if GROQ_API_KEY is None:
 GROQ_MODEL_NAME = os.getenv("GROQ_MODEL_NAME", "meta-llama/llama-4-scout-17b-16e-instruct") 
 
 # Groq APIのベースURL (通常はデフォルトで良いため、設定不要な場合が多いですが、明示的に設定することも可能)
-# GROQ_BASE_URL = "https://api.groq.com/openai/v1" 
+# ベンチマークではローカルの疑似Groqサーバー (benchmarks/fake_groq.py) を指定する。None の場合はSDKのデフォルト
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL")
+
+# LLMプロバイダー (providers.py) の設定
+# 使用するプロバイダーを優先順にカンマ区切りで指定する ("groq" / "openai" / "local")。例: "groq,local"
+LLM_PROVIDERS = os.getenv("LLM_PROVIDERS", "groq")
+# 任意の OpenAI 互換エンドポイント ("openai")
+OPENAI_COMPAT_BASE_URL = os.getenv("OPENAI_COMPAT_BASE_URL", "https://api.openai.com/v1")
+OPENAI_COMPAT_API_KEY = os.getenv("OPENAI_COMPAT_API_KEY")
+OPENAI_COMPAT_MODEL = os.getenv("OPENAI_COMPAT_MODEL", "gpt-4o-mini")
+OPENAI_COMPAT_REQUESTS_PER_MINUTE = float(os.getenv("OPENAI_COMPAT_REQUESTS_PER_MINUTE", "0"))
+# ローカルのCPUモデル ("local")。llama.cpp の llama-server など OpenAI 互換APIを持つサーバーのURL
+LOCAL_LLM_BASE_URL = os.getenv("LOCAL_LLM_BASE_URL", "http://127.0.0.1:8080/v1")
+LOCAL_LLM_MODEL = os.getenv("LOCAL_LLM_MODEL", "local")
+# エラー率 (指数移動平均) または応答時間 (秒、指数移動平均) がこの値を超えたプロバイダーは後回しにする
+LLM_ROUTER_MAX_ERROR_RATE = float(os.getenv("LLM_ROUTER_MAX_ERROR_RATE", "0.5"))
+LLM_ROUTER_MAX_LATENCY = float(os.getenv("LLM_ROUTER_MAX_LATENCY", "30"))
+# 後回しにしたプロバイダーを、回復したか確かめるために再び使うまでの間隔 (秒)
+LLM_ROUTER_PROBE_INTERVAL = float(os.getenv("LLM_ROUTER_PROBE_INTERVAL", "60"))
 
 # Hugging Faceの埋め込みモデル名 (cluster.py で使用)
 EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
 
+# 埋め込みサーバー (app.embedding_server) のURL。uvicorn の複数ワーカーで1つのモデルを共有する場合に設定する
+# 例: "http://127.0.0.1:8766" または "unix:///tmp/embedding.sock"。未設定の場合は各プロセスでモデルを読み込む
+EMBEDDING_SERVER_URL = os.getenv("EMBEDDING_SERVER_URL")
+EMBEDDING_SERVER_TIMEOUT = float(os.getenv("EMBEDDING_SERVER_TIMEOUT", "120")) # 秒
+# 埋め込みサーバーが同時に届いたリクエストをまとめて計算する際の最大テキスト数と、まとめるために待つ最大時間 (ミリ秒)
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", "256"))
+EMBEDDING_MAX_WAIT_MS = float(os.getenv("EMBEDDING_MAX_WAIT_MS", "10"))
+
 # HDBSCANの最小クラスタサイズ (cluster.py で使用)
 MIN_CLUSTER_SIZE = 5
 
-# LLMからJSON形式で返す際のタイムアウト設定（任意）
-LLM_TIMEOUT = 60 # 秒
\ No newline at end of file
+# LLMラベル付けの結果をこの件数ごとにまとめてDBに書き込む (中断しても書き込み済みの分は再実行されない)
+LABEL_COMMIT_CHUNK_SIZE = int(os.getenv("LABEL_COMMIT_CHUNK_SIZE", "50"))
+
+# ラベル付けの優先度 (priority.py): 危険・緊急を示す語による事前スコアがこの値以上のコメントを先にラベル付けし、
+# PRIORITY_COMMIT_CHUNK_SIZE 件ごとにコミットしてアラートを送る
+PRIORITY_MIN_SCORE = float(os.getenv("PRIORITY_MIN_SCORE", "1.0"))
+PRIORITY_COMMIT_CHUNK_SIZE = int(os.getenv("PRIORITY_COMMIT_CHUNK_SIZE", "5"))
+# 事前スコアに加える語 (カンマ区切り、例: "休講,教室変更")
+PRIORITY_EXTRA_KEYWORDS = [word.strip() for word in os.getenv("PRIORITY_EXTRA_KEYWORDS", "").split(",") if word.strip()]
+# アラート (alerts.py): 危険性が true、または緊急性 (0〜3) がこの値以上のコメントでアラートを送る
+ALERT_URGENCY_LEVEL = int(os.getenv("ALERT_URGENCY_LEVEL", "3"))
+
+# パイプラインの実行順序
+# "label_first": 全コメントをLLMでラベル付けしてからクラスタリングする (従来の順序)
+# "cluster_first": 先にクラスタリングし、各クラスタの代表 (medoid) と数件の例をLLMでラベル付けしてメンバーに展開する
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "label_first")
+# cluster_first でクラスタごとにLLMでラベル付けするコメント数 (medoid を含む)
+CLUSTER_FIRST_EXEMPLARS = 3
+# medoid とのコサイン類似度がこの値未満のメンバーと、ノイズ (cluster_id == -1) は個別にLLMでラベル付けする
+CLUSTER_FIRST_SIMILARITY_THRESHOLD = 0.8
+
+# LLM呼び出し1回あたりのタイムアウト (秒)。ストリーミングが途中で止まった場合もこの時間で打ち切って再試行する
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+# LLM APIクライアントの接続プール (プロバイダー・イベントループごと)。keep-alive で接続を使い回し、呼び出しごとのTLSハンドシェイクを省く
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+# 使われていない keep-alive 接続を閉じるまでの秒数
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+# パイプライン1回あたりのLLMラベル付けの時間予算 (秒)。超えた分のコメントは未処理のまま残し、次回の実行で処理する。0 以下の場合は無制限
+PIPELINE_DEADLINE_SECONDS = float(os.getenv("PIPELINE_DEADLINE_SECONDS", "0"))
+# ヘッジリクエスト: 呼び出しがプロバイダーの応答時間の p95 を超えても終わらない場合、同じリクエストをもう1つ送り、先に返った方を使う
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "true").lower() == "true"
+# p95 を計算するのに必要な成功した呼び出しの件数 (これより少ない間はヘッジしない)
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+# サーキットブレーカー: 連続でこの回数失敗したプロバイダーへの呼び出しを LLM_BREAKER_COOLDOWN 秒止める
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+# LLMラベル付けのリクエスト間隔 (レート制限対策) とリトライ前の待ち時間 (秒)
+LLM_REQUEST_INTERVAL = float(os.getenv("LLM_REQUEST_INTERVAL", "3"))
+LLM_PARSE_RETRY_WAIT = float(os.getenv("LLM_PARSE_RETRY_WAIT", "2")) # レスポンスのパースに失敗した場合
+# API呼び出しが失敗した場合の待ち時間の上限。レート制限 (429) は Retry-After ヘッダーがあればそれに従い、
+# 接続エラー・サーバーエラーは試行回数に応じて指数的に延ばす。タイムアウトは待たずに再試行し、その他の 4xx は再試行しない
+LLM_ERROR_RETRY_WAIT = float(os.getenv("LLM_ERROR_RETRY_WAIT", "10"))
+
+# 全ワーカー (バッチアップロードの並列処理を含む) で共有するLLM呼び出しのレート上限 (1分あたりのリクエスト数)
+# 既定値は従来の LLM_REQUEST_INTERVAL 秒ごとに1回と同じ。0 以下の場合は制限しない
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", str(60 / LLM_REQUEST_INTERVAL if LLM_REQUEST_INTERVAL > 0 else 0)))
+
+# バッチアップロードで同時に処理するファイル数
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", str(os.cpu_count() or 4)))
+
+# ライブセッション (live.py) の設定: 授業中に届いたコメントを小さなバッチにまとめてラベル付け・クラスタ割り当てを行う
+# 最初のコメントが届いてから LIVE_BATCH_WAIT_MS ミリ秒、または LIVE_BATCH_SIZE 件に達するまで次のコメントを待つ
+LIVE_BATCH_SIZE = int(os.getenv("LIVE_BATCH_SIZE", "20"))
+LIVE_BATCH_WAIT_MS = float(os.getenv("LIVE_BATCH_WAIT_MS", "200"))
+# 1つのバッチで同時に送るLLMラベル付けのリクエスト数 (プロバイダーのレート上限は別に適用される)
+LIVE_LABEL_CONCURRENCY = int(os.getenv("LIVE_LABEL_CONCURRENCY", "8"))
+# 既存クラスタの重心とのコサイン類似度がこの値以上なら、そのクラスタに割り当てる (未満なら新しいクラスタを作る)
+LIVE_CLUSTER_SIMILARITY = float(os.getenv("LIVE_CLUSTER_SIMILARITY", "0.75"))
+# ダッシュボードに送る直近のコメント数と上位クラスタ数
+LIVE_RECENT_COMMENTS = 50
+LIVE_TOP_CLUSTERS = 5
+# 緊急性 (0〜3) がこの値以上のコメントを「緊急」として数える
+LIVE_URGENCY_LEVEL = 2
+
+# トピック追跡 (topics.py) の設定: クラスタの重心と既存トピックの重心のコサイン類似度がこの値以上なら同じトピックとみなす
+TOPIC_MATCH_THRESHOLD = float(os.getenv("TOPIC_MATCH_THRESHOLD", "0.8"))
+
+# 用語分析 (terms.py) の設定
+# TERMS_TOKENIZER: "janome" (形態素解析、janome のインストールが必要) / "bigram" (文字2-gram) / "auto" (janome があれば janome)
+TERMS_TOKENIZER = os.getenv("TERMS_TOKENIZER", "auto")
+# クラスタ・カテゴリごとに保存するキーワード数
+TERMS_TOP_K = int(os.getenv("TERMS_TOP_K", "10"))
+
+# アーカイブ (archive.py) の設定
+# 作成から ARCHIVE_RETENTION_DAYS 日を過ぎた分析セッションのコメントを ARCHIVE_DIR のParquetファイルに移し、DBから削除する
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "365"))
+
+# 重複コメント集約の設定 (dedup.py で使用)
+# 正規化テキストの完全一致に加え、MinHash/LSH で近似重複をまとめ、代表1件だけをLLM・クラスタリングに回す
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() == "true"
+# 近似重複とみなす推定Jaccard類似度 (文字3-gram) の閾値
+DEDUP_JACCARD_THRESHOLD = 0.7
+# MinHash の置換数と LSH のバンド数 (DEDUP_NUM_PERM は DEDUP_LSH_BANDS で割り切れること)
+DEDUP_NUM_PERM = 128
+DEDUP_LSH_BANDS = 32
+
+# アップロードの指紋による再利用の設定 (fingerprint.py で使用)
+# 内容が同じCSVは分析済みのセッションを返し、本文が一致する行は既存のラベル・埋め込みを再利用して差分だけを分析する
+UPLOAD_REUSE_ENABLED = os.getenv("UPLOAD_REUSE_ENABLED", "true").lower() == "true"
+
+# 近似分析モードの設定 (approximate.py で使用)
+# クラスタを層とした層化抽出でサンプルだけをLLMでラベル付けし、PN比とカテゴリの割合を信頼区間付きで推定する
+# /upload の approximate (フォームの値) で指定する。未指定の場合はコメント数が APPROXIMATE_MIN_COMMENTS 以上のときに使う (0 は使わない)
+APPROXIMATE_MIN_COMMENTS = int(os.getenv("APPROXIMATE_MIN_COMMENTS", "0"))
+# ラベル付けするサンプルの件数 (代表コメント数) と、各層から抽出する最小件数
+# LLM呼び出しは1件1回のため、最初の結果までの時間はおよそ サンプル数 / LLM_REQUESTS_PER_MINUTE 分 (400件で信頼区間の幅は約 ±5 ポイント)
+APPROXIMATE_SAMPLE_SIZE = int(os.getenv("APPROXIMATE_SAMPLE_SIZE", "400"))
+APPROXIMATE_MIN_PER_STRATUM = 2
+# 信頼区間の信頼水準
+APPROXIMATE_CONFIDENCE = float(os.getenv("APPROXIMATE_CONFIDENCE", "0.95"))
+# 近似の結果を返した後、残りのコメントのラベル付けをバックグラウンドで続け、完了後に正確な値で置き換える
+APPROXIMATE_REFINE = os.getenv("APPROXIMATE_REFINE", "true").lower() == "true"
@@ -1,9 +1,11 @@
 from sqlalchemy.orm import Session # Session をインポート
 from app.models import Comment
+from app import metrics
 import pandas as pd
 # from app.config import SessionLocal # 依存性注入を使うので不要になる
 
-def save_comments_from_csv(db: Session, df) -> int: # セッションを引数で受け取り、int を返すように変更
+def save_comments_from_csv(db: Session, df, session_id: int | None = None) -> int: # セッションを引数で受け取り、int を返すように変更
+    # session_id: バッチアップロードの場合の分析セッションID (/upload では None)
     comments_to_add = []
     saved_count = 0
     for index, row in df.iterrows():
@@ -13,7 +15,7 @@ def save_comments_from_csv(db: Session, df) -> int: # セッションを引数
             if pd.isna(comment_text): # コメントがNaNの場合をスキップ
                 continue
             
-            comment = Comment(text=str(comment_text)) # textカラムはString型なので文字列に変換
+            comment = Comment(text=str(comment_text), session_id=session_id, ingest_session_id=session_id) # textカラムはString型なので文字列に変換
             comments_to_add.append(comment)
             saved_count += 1
         except IndexError:
@@ -26,7 +28,9 @@ def save_comments_from_csv(db: Session, df) -> int: # セッションを引数
 
     if comments_to_add: # 追加するコメントがある場合のみ処理
         db.add_all(comments_to_add) # add_all で一括挿入
-        db.commit()
+        with metrics.span("db_commit"):
+            db.commit()
+        metrics.inc("comments_ingested_total", saved_count)
         # commit()後に各オブジェクトはDBから最新の状態に更新される
         # 必要であれば、db.refresh(comment) をコメントオブジェクトに対して実行
     
@@ -0,0 +1,185 @@
+import hashlib
+import logging
+import re
+import unicodedata
+import zlib
+from collections import defaultdict
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session, aliased
+
+from app.models import Comment
+from app import metrics
+from app.config import DEDUP_JACCARD_THRESHOLD, DEDUP_NUM_PERM, DEDUP_LSH_BANDS
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# MinHash のハッシュ関数パラメータ (実行ごとに結果が変わらないよう乱数シードを固定)
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, (1 << 32) - 1, size=DEDUP_NUM_PERM).astype(np.uint64)
+_PERM_B = _rng.randint(0, (1 << 32) - 1, size=DEDUP_NUM_PERM).astype(np.uint64)
+
+_SEPARATORS_RE = re.compile(r"[\W_]+")
+
+
+def normalize_text(text: str) -> str:
+    """
+    重複判定用にテキストを正規化する。
+    全角/半角の統一、小文字化、空白・記号の除去を行う。
+    数字は残す (「第3回」と「第12回」、「5点」と「1点」は別のコメントとして扱う)。数字だけが違う長いコメントは MinHash の近似重複判定でまとめる。
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    return _SEPARATORS_RE.sub("", text)
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def _shingles(normalized: str, k: int = 3) -> set:
+    if len(normalized) <= k:
+        return {normalized}
+    return {normalized[i:i + k] for i in range(len(normalized) - k + 1)}
+
+
+def minhash_signature(normalized: str) -> np.ndarray:
+    hashes = np.array([zlib.crc32(s.encode("utf-8")) for s in _shingles(normalized)], dtype=np.uint64)
+    permuted = (np.outer(hashes, _PERM_A) + _PERM_B) % _MERSENNE_PRIME & _MAX_HASH
+    return permuted.min(axis=0)
+
+
+def _find(parent: dict, x):
+    while parent[x] != x:
+        parent[x] = parent[parent[x]]
+        x = parent[x]
+    return x
+
+
+def group_near_duplicates(texts: list) -> list:
+    """
+    テキストのリストを重複グループに分け、各テキストのグループ番号 (代表テキストのインデックス) を返す。
+    正規化テキストの完全一致でまとめた後、MinHash/LSH で推定Jaccard類似度が閾値以上のものを同じグループにする。
+    代表は各グループで最も小さいインデックス (= 最初に登録されたコメント) になる。
+    """
+    parent = {i: i for i in range(len(texts))}
+
+    def union(a, b):
+        root_a, root_b = _find(parent, a), _find(parent, b)
+        if root_a != root_b:
+            # 小さいインデックスを代表にする
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    # 1. 正規化テキストの完全一致
+    first_by_normalized = {}
+    normalized_texts = [normalize_text(t) for t in texts]
+    for i, normalized in enumerate(normalized_texts):
+        if normalized in first_by_normalized:
+            union(first_by_normalized[normalized], i)
+        else:
+            first_by_normalized[normalized] = i
+
+    # 2. 完全一致の代表同士で MinHash/LSH による近似重複判定
+    unique_indices = list(first_by_normalized.values())
+    signatures = {i: minhash_signature(normalized_texts[i]) for i in unique_indices}
+    rows_per_band = DEDUP_NUM_PERM // DEDUP_LSH_BANDS
+    buckets = defaultdict(list)
+    for i in unique_indices:
+        signature = signatures[i]
+        for band in range(DEDUP_LSH_BANDS):
+            key = (band, signature[band * rows_per_band:(band + 1) * rows_per_band].tobytes())
+            bucket = buckets[key]
+            # 同じバケットの既存メンバーと推定Jaccard類似度を比較し、最初に一致したものとまとめる
+            for other in bucket:
+                if _find(parent, other) == _find(parent, i):
+                    break
+                if np.mean(signatures[other] == signature) >= DEDUP_JACCARD_THRESHOLD:
+                    union(other, i)
+                    break
+            bucket.append(i)
+
+    return [_find(parent, i) for i in range(len(texts))]
+
+
+def collapse_duplicates(db: Session, session_id: int | None = None):
+    """
+    未処理 (未ラベル・未ハッシュ) のコメントを重複グループにまとめる。
+    重複の判定は同じ Comment.session_id のコメント同士でのみ行う (session_id は app.models.comment_scope を参照)。
+    代表以外のコメントには duplicate_of に代表のIDを設定し、代表には duplicate_count にグループのコメント数を保存する。
+    label_comments / cluster_comments は代表コメントのみを処理し、結果は propagate_* で各メンバーに展開する。
+    """
+    comments = db.query(Comment).filter(
+        Comment.category == None,
+        Comment.text_hash == None,
+        Comment.duplicate_of == None,
+        Comment.session_id == session_id
+    ).order_by(Comment.id).all()
+
+    if not comments:
+        logger.info("重複判定すべき新規コメントはありません。")
+        return
+
+    groups = group_near_duplicates([c.text for c in comments])
+    group_sizes = defaultdict(int)
+    for representative_index in groups:
+        group_sizes[representative_index] += 1
+
+    for i, (comment, representative_index) in enumerate(zip(comments, groups)):
+        comment.text_hash = text_hash(comment.text)
+        if representative_index == i:
+            comment.duplicate_of = None
+            comment.duplicate_count = group_sizes[i]
+        else:
+            comment.duplicate_of = comments[representative_index].id
+            comment.duplicate_count = 1
+
+    try:
+        with metrics.span("db_commit"):
+            db.commit()
+        logger.info(f"重複コメントの集約が完了しました。{len(comments)} 件 -> 代表 {len(group_sizes)} 件")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"重複コメント集約結果のコミット中にエラーが発生しました: {e}", exc_info=True)
+
+
+def _copy_from_representative(db: Session, columns: list, *filters):
+    # UPDATE comments SET col = (SELECT rep.col FROM comments rep WHERE rep.id = comments.duplicate_of) ...
+    # 1回のUPDATE文でまとめて展開するため、メンバー数に関わらずクエリ数は一定
+    representative = aliased(Comment)
+    values = {
+        column: select(getattr(representative, column.key)).where(representative.id == Comment.duplicate_of).scalar_subquery()
+        for column in columns
+    }
+    updated = db.query(Comment).filter(Comment.duplicate_of != None, *filters).update(values, synchronize_session=False)
+    db.commit()
+    return updated
+
+
+def propagate_duplicate_labels(db: Session, session_id: int | None = None):
+    """代表コメントのLLMラベル (カテゴリ、危険性、感情、タグ) とラベル付けの状態を重複メンバーに展開する。"""
+    try:
+        # ラベルは一度付けば変わらないため、未ラベルのメンバーだけを更新する
+        updated = _copy_from_representative(
+            db, [Comment.category, Comment.danger, Comment.sentiment, Comment.tags, Comment.label_state, Comment.label_provider],
+            Comment.category == None, Comment.session_id == session_id
+        )
+        # 重複メンバーはLLMを呼ばずに代表のラベルを再利用したので、キャッシュヒットとして数える
+        metrics.inc("llm_cache_hits_total", updated, purpose="label")
+        logger.info(f"重複メンバー {updated} 件に代表コメントのラベルを展開しました。")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"重複メンバーへのラベル展開中にエラーが発生しました: {e}", exc_info=True)
+
+
+def propagate_duplicate_clusters(db: Session, session_id: int | None = None):
+    """代表コメントのクラスタIDと埋め込みベクトルを重複メンバーに展開する。"""
+    try:
+        updated = _copy_from_representative(db, [Comment.cluster_id, Comment.embedding], Comment.session_id == session_id)
+        logger.info(f"重複メンバー {updated} 件に代表コメントのクラスタを展開しました。")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"重複メンバーへのクラスタ展開中にエラーが発生しました: {e}", exc_info=True)
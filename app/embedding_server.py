@@ -0,0 +1,149 @@
+"""
+埋め込みベクトル計算用のローカルサーバー。
+
+uvicorn を複数ワーカーで起動すると、ワーカーごとに SentenceTransformer を読み込むためメモリ使用量が増える。
+このサーバーを1つ起動して EMBEDDING_SERVER_URL を設定すると、全ワーカーの app.cluster がこのサーバーに埋め込みの計算を依頼する。
+同時に届いたリクエストは、最大 EMBEDDING_MAX_BATCH_SIZE 件・最大 EMBEDDING_MAX_WAIT_MS ミリ秒の範囲でまとめて1回で計算する。
+
+使い方:
+    python -m app.embedding_server --port 8766                      # EMBEDDING_SERVER_URL=http://127.0.0.1:8766
+    python -m app.embedding_server --uds /tmp/embedding.sock         # EMBEDDING_SERVER_URL=unix:///tmp/embedding.sock
+"""
+import argparse
+import asyncio
+import base64
+import logging
+import time
+from typing import List
+
+import numpy as np
+from fastapi import FastAPI
+from pydantic import BaseModel
+
+from app.config import EMBEDDING_MODEL_NAME, EMBEDDING_MAX_BATCH_SIZE, EMBEDDING_MAX_WAIT_MS
+from app.cluster import get_model
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class EncodeRequest(BaseModel):
+    texts: List[str]
+
+
+class DynamicBatcher:
+    """
+    同時に届いた encode リクエストをキューに溜め、まとめてモデルに渡す。
+    最初のリクエストが届いてから max_wait 秒、またはテキスト数が max_batch_size に達するまで次のリクエストを待つ。
+    1件で max_batch_size を超えるリクエストは単独で計算する (モデルの encode が内部で分割する)。
+    """
+
+    def __init__(self, max_batch_size: int = EMBEDDING_MAX_BATCH_SIZE, max_wait_ms: float = EMBEDDING_MAX_WAIT_MS):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.stats = {"requests": 0, "texts": 0, "batches": 0, "encode_seconds": 0.0}
+        self._pending = None  # 前のバッチに入りきらなかったリクエスト
+
+    async def encode(self, texts: list) -> np.ndarray:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((texts, future))
+        return await future
+
+    async def _next_batch(self) -> list:
+        first = self._pending or await self.queue.get()
+        self._pending = None
+        batch = [first]
+        size = len(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if size + len(item[0]) > self.max_batch_size:
+                self._pending = item
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        model = get_model()
+        while True:
+            batch = await self._next_batch()
+            texts = [text for item_texts, _ in batch for text in item_texts]
+            started = time.perf_counter()
+            try:
+                # モデルの推論はCPUバウンドのため、イベントループを止めないよう別スレッドで実行する
+                embeddings = await loop.run_in_executor(None, lambda: model.encode(texts, convert_to_numpy=True))
+            except Exception as e:
+                logger.error(f"埋め込みの計算中にエラーが発生しました: {e}", exc_info=True)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.stats["requests"] += len(batch)
+            self.stats["texts"] += len(texts)
+            self.stats["batches"] += 1
+            self.stats["encode_seconds"] += time.perf_counter() - started
+
+            offset = 0
+            for item_texts, future in batch:
+                if not future.done():
+                    future.set_result(embeddings[offset:offset + len(item_texts)])
+                offset += len(item_texts)
+
+
+app = FastAPI()
+batcher = None
+
+
+@app.on_event("startup")
+async def on_startup():
+    global batcher
+    batcher = DynamicBatcher()
+    # 最初のリクエストを待たずにモデルを読み込んでおく
+    get_model()
+    asyncio.create_task(batcher.run())
+    logger.info(f"埋め込みサーバーを起動しました (モデル: {EMBEDDING_MODEL_NAME}, 最大バッチ: {batcher.max_batch_size}, 最大待ち時間: {batcher.max_wait * 1000:.0f} ms)。")
+
+
+@app.post("/encode")
+async def encode(request: EncodeRequest):
+    if not request.texts:
+        return {"dim": 0, "embeddings": ""}
+    embeddings = np.ascontiguousarray(await batcher.encode(request.texts), dtype=np.float32)
+    # JSONの数値リストより小さく、変換も速いため float32 のバイト列をBase64で返す
+    return {"dim": int(embeddings.shape[1]), "embeddings": base64.b64encode(embeddings.tobytes()).decode("ascii")}
+
+
+@app.get("/health")
+async def health():
+    stats = dict(batcher.stats)
+    stats["avg_batch_texts"] = round(stats["texts"] / stats["batches"], 2) if stats["batches"] else None
+    return {"model": EMBEDDING_MODEL_NAME, "queued": batcher.queue.qsize(), "stats": stats}
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="複数ワーカーで共有する埋め込みベクトル計算サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--uds", help="Unixソケットのパス (指定した場合は --host/--port を使わない)")
+    args = parser.parse_args()
+
+    if args.uds:
+        uvicorn.run(app, uds=args.uds, log_level="warning")
+    else:
+        uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
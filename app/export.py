@@ -0,0 +1,214 @@
+"""
+分析セッションのコメント (ラベル・タグ・クラスタID・重要度スコア) のエクスポート。
+
+コメントをIDの順に一定件数ずつ読み出して書き出すため、コメント数に関わらずメモリ使用量は一定になる。
+- CSV: チャンクごとに文字列を返すジェネレーター (StreamingResponse でそのまま送れる)
+- Parquet: pyarrow でバッチごとに書き込む。埋め込みベクトルは固定長の float32 リスト列として含められる
+
+使い方 (CLI):
+    python -m app.export 12 --format parquet --output session12.parquet --embeddings
+    python -m app.export 12 --format csv --output session12.csv
+"""
+import argparse
+import csv
+import io
+import pickle
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from app.models import Comment, AnalysisSession, comment_scope
+
+# 1回のクエリで読み出すコメント数
+EXPORT_BATCH_SIZE = 5000
+
+# LLMが付与するタグ (llm.py のプロンプトと同じ)。エクスポートではタグごとに1列にする
+TAG_NAMES = ["質問", "具体的", "インフラ", "緊急性"]
+
+CSV_COLUMNS = ["id", "text", "category", "danger", "sentiment", "cluster_id", "importance_score", "duplicate_of", "label_state"] + TAG_NAMES
+
+
+def session_comments(analysis_session: AnalysisSession):
+    # 分析セッションが対象とするコメントの絞り込み条件
+    return Comment.session_id == comment_scope(analysis_session)
+
+
+def iter_comment_batches(db: Session, criterion, include_embeddings: bool = False, batch_size: int = EXPORT_BATCH_SIZE):
+    """criterion に一致するコメントを、出力するカラムだけに絞って batch_size 件ずつ (IDのキーセット方式で) 返す。"""
+    columns = [
+        Comment.id, Comment.text, Comment.category, Comment.danger, Comment.sentiment,
+        Comment.cluster_id, Comment.importance_score, Comment.duplicate_of, Comment.label_state, Comment.tags
+    ]
+    if include_embeddings:
+        columns.append(Comment.embedding)
+    last_id = 0
+    while True:
+        rows = db.query(*columns).filter(
+            criterion, Comment.id > last_id
+        ).order_by(Comment.id).limit(batch_size).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1].id
+
+
+def _tag_values(row) -> list:
+    tags = row.tags or {}
+    return [tags.get(name) for name in TAG_NAMES]
+
+
+def iter_csv(db: Session, analysis_session: AnalysisSession, batch_size: int = EXPORT_BATCH_SIZE):
+    """CSVを文字列のチャンクとして返す。Excelで文字化けしないよう先頭にBOMを付ける。"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")
+    writer.writerow(CSV_COLUMNS)
+    for rows in iter_comment_batches(db, session_comments(analysis_session), batch_size=batch_size):
+        for row in rows:
+            writer.writerow([
+                row.id, row.text, row.category, row.danger, row.sentiment,
+                row.cluster_id, row.importance_score, row.duplicate_of, row.label_state
+            ] + _tag_values(row))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _parquet_schema(pa, embedding_dim: int | None):
+    fields = [
+        pa.field("id", pa.int64()),
+        pa.field("text", pa.string()),
+        pa.field("category", pa.string()),
+        pa.field("danger", pa.bool_()),
+        pa.field("sentiment", pa.int8()),
+        pa.field("cluster_id", pa.int32()),
+        pa.field("importance_score", pa.float32()),
+        pa.field("duplicate_of", pa.int64()),
+        pa.field("label_state", pa.string()),
+    ] + [pa.field(name, pa.int8()) for name in TAG_NAMES]
+    if embedding_dim is not None:
+        fields.append(pa.field("embedding", pa.list_(pa.float32(), embedding_dim)))
+    return pa.schema(fields)
+
+
+def _parquet_table(pa, schema, rows, embedding_dim: int | None):
+    columns = {
+        "id": [r.id for r in rows],
+        "text": [r.text for r in rows],
+        "category": [r.category for r in rows],
+        "danger": [r.danger for r in rows],
+        "sentiment": [r.sentiment for r in rows],
+        "cluster_id": [r.cluster_id for r in rows],
+        "importance_score": [r.importance_score for r in rows],
+        "duplicate_of": [r.duplicate_of for r in rows],
+        "label_state": [r.label_state for r in rows],
+    }
+    tag_rows = [_tag_values(r) for r in rows]
+    for i, name in enumerate(TAG_NAMES):
+        columns[name] = [values[i] for values in tag_rows]
+    arrays = [pa.array(columns[field.name], type=field.type) for field in schema if field.name != "embedding"]
+    if embedding_dim is not None:
+        # 埋め込みのないコメント (未クラスタリング) は null にする
+        flat = np.zeros((len(rows), embedding_dim), dtype=np.float32)
+        mask = np.ones(len(rows), dtype=bool)
+        for i, r in enumerate(rows):
+            if r.embedding is not None:
+                flat[i] = pickle.loads(r.embedding)
+                mask[i] = False
+        values = pa.array(flat.reshape(-1), type=pa.float32())
+        arrays.append(pa.FixedSizeListArray.from_arrays(values, embedding_dim, mask=pa.array(mask)))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _embedding_dim(db: Session, criterion) -> int | None:
+    row = db.query(Comment.embedding).filter(criterion, Comment.embedding != None).first()
+    return len(pickle.loads(row.embedding)) if row else None
+
+
+class _ChunkSink(io.RawIOBase):
+    # pyarrow が書き込んだバイト列を溜め、ストリーミング時にチャンクとして取り出すための書き込み専用ストリーム
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_batches(db: Session, criterion, destination, include_embeddings: bool = False, batch_size: int = EXPORT_BATCH_SIZE):
+    # 1バッチ書き込むごとに制御を返すジェネレーター (ストリーミング時は、その間に書き込まれたバイト列を送る)
+    import pyarrow as pa  # 任意の依存ライブラリのため、Parquet出力時にのみ読み込む
+    import pyarrow.parquet as pq
+
+    embedding_dim = _embedding_dim(db, criterion) if include_embeddings else None
+    schema = _parquet_schema(pa, embedding_dim)
+    with pq.ParquetWriter(destination, schema, compression="zstd") as writer:
+        for rows in iter_comment_batches(db, criterion, include_embeddings=embedding_dim is not None, batch_size=batch_size):
+            writer.write_table(_parquet_table(pa, schema, rows, embedding_dim))
+            yield
+
+
+def write_parquet(db: Session, analysis_session: AnalysisSession, destination, include_embeddings: bool = False,
+                  batch_size: int = EXPORT_BATCH_SIZE):
+    """Parquetを destination (ファイルパスまたは書き込み可能なストリーム) にバッチごとに書き込む。"""
+    for _ in parquet_batches(db, session_comments(analysis_session), destination, include_embeddings, batch_size):
+        pass
+
+
+def iter_parquet(db: Session, analysis_session: AnalysisSession, include_embeddings: bool = False, batch_size: int = EXPORT_BATCH_SIZE):
+    """Parquetをバイト列のチャンクとして返す (StreamingResponse 用)。"""
+    sink = _ChunkSink()
+    for _ in parquet_batches(db, session_comments(analysis_session), sink, include_embeddings, batch_size):
+        data = sink.drain()
+        if data:
+            yield data
+    # ParquetWriter を閉じたときに書き込まれるフッター
+    data = sink.drain()
+    if data:
+        yield data
+
+
+def main():
+    from app.config import SessionLocal
+
+    parser = argparse.ArgumentParser(description="分析セッションのコメントをCSVまたはParquetに書き出す")
+    parser.add_argument("session_id", type=int)
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--output", required=True, help="出力ファイルのパス")
+    parser.add_argument("--embeddings", action="store_true", help="埋め込みベクトルを含める (Parquetのみ)")
+    parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        analysis_session = db.get(AnalysisSession, args.session_id)
+        if analysis_session is None:
+            parser.error(f"分析セッションID {args.session_id} が見つかりません。")
+        if args.format == "csv":
+            with open(args.output, "w", encoding="utf-8", newline="") as f:
+                for chunk in iter_csv(db, analysis_session, args.batch_size):
+                    f.write(chunk)
+        else:
+            write_parquet(db, analysis_session, args.output, args.embeddings, args.batch_size)
+    finally:
+        db.close()
+    print(f"セッションID {args.session_id} のコメントを {args.output} に書き出しました。")
+
+
+if __name__ == "__main__":
+    main()
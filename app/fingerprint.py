@@ -0,0 +1,115 @@
+"""
+アップロードされたCSVの指紋 (ファイルのハッシュと行ごとのテキストハッシュ) による分析結果の再利用。
+
+同じエクスポートを2回アップロードした場合や、数行だけ増えたCSVを再エクスポートした場合に、パイプライン全体をやり直さない。
+- ファイル全体の SHA-256 が一致する分析済みのセッションがあれば、パイプラインを実行せずにそのセッションを返す
+- 行ごとには、本文が完全に一致するラベル付け済みのコメント (Comment.text_hash で検索し、本文を比較する) のラベルと埋め込みを写す。
+  LLM と埋め込みモデルには、一致しなかった行 (差分) だけを回す
+"""
+import hashlib
+import logging
+
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+
+from app.config import DEDUP_ENABLED
+from app.dedup import text_hash
+from app.models import AnalysisSession, Comment
+from app import metrics
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# ファイルのハッシュを計算するときの読み込み単位
+HASH_CHUNK_SIZE = 1024 * 1024
+# 再利用するラベルを検索する text_hash の件数 (IN 句の上限に収めるため分割する)
+REUSE_QUERY_CHUNK_SIZE = 500
+# 既存のコメントから写す列 (重要度スコアはタグからパイプラインで計算し直す)
+REUSED_COLUMNS = ("category", "danger", "sentiment", "tags", "label_state", "label_provider", "embedding")
+
+metrics.describe("uploads_reused_total", "counter", "内容が同じCSVのアップロードで既存の分析セッションを返した回数")
+
+
+def file_sha256(fileobj, destination=None) -> str:
+    """ファイルオブジェクトを読みながら SHA-256 を計算する。destination を渡した場合は読んだ内容をそこに書き出す。"""
+    digest = hashlib.sha256()
+    while True:
+        chunk = fileobj.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        if destination is not None:
+            destination.write(chunk)
+    return digest.hexdigest()
+
+
+def find_analyzed_session(db: Session, sha256: str) -> AnalysisSession | None:
+    """同じ内容のファイルを分析済みのセッション (完了したもののうち最新) を返す。"""
+    analysis_session = db.query(AnalysisSession).filter(
+        AnalysisSession.file_sha256 == sha256,
+        # /upload のセッションは完了後に保存されるため status が None
+        or_(AnalysisSession.status == None, AnalysisSession.status == "done")
+    ).order_by(AnalysisSession.id.desc()).first()
+    if analysis_session is not None:
+        metrics.inc("uploads_reused_total")
+    return analysis_session
+
+
+def reuse_previous_labels(db: Session, session_id: int | None = None) -> int:
+    """
+    未ラベルの新規コメントのうち、本文が完全に一致するラベル付け済みのコメントが (どのセッションにでも) あるものに、
+    そのコメントのラベルと埋め込みを写し、写した件数を返す。
+    写したコメントは label_state が "done" になるため、重複集約・LLMラベル付けの対象から外れ、クラスタリングでは保存済みの埋め込みを使う。
+    """
+    comments = db.query(Comment).filter(
+        Comment.category == None,
+        Comment.text_hash == None,
+        Comment.duplicate_of == None,
+        Comment.session_id == session_id
+    ).all()
+    if not comments:
+        return 0
+
+    hashes = {}
+    for comment in comments:
+        hashes.setdefault(text_hash(comment.text), []).append(comment)
+
+    # 同じ本文のコメントが複数ある場合は、最新のラベルを使う
+    sources = {}
+    keys = list(hashes)
+    for offset in range(0, len(keys), REUSE_QUERY_CHUNK_SIZE):
+        rows = db.query(Comment.text, *(getattr(Comment, column) for column in REUSED_COLUMNS)).filter(
+            Comment.text_hash.in_(keys[offset:offset + REUSE_QUERY_CHUNK_SIZE]),
+            Comment.category != None,
+            Comment.label_state == "done",
+        ).order_by(Comment.id).all()
+        for row in rows:
+            sources[row.text] = row
+
+    reused = 0
+    for key, group in hashes.items():
+        for comment in group:
+            source = sources.get(comment.text)
+            if source is not None:
+                for column in REUSED_COLUMNS:
+                    setattr(comment, column, getattr(source, column))
+                comment.text_hash = key
+                comment.duplicate_count = 1
+                reused += 1
+            elif not DEDUP_ENABLED:
+                # 重複集約を行わない場合も、次回以降のアップロードで検索できるようにハッシュを保存する
+                comment.text_hash = key
+
+    try:
+        with metrics.span("db_commit"):
+            db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"既存ラベルの再利用結果のコミット中にエラーが発生しました: {e}", exc_info=True)
+        return 0
+
+    # LLMを呼ばずに既存のラベルを再利用したので、キャッシュヒットとして数える
+    metrics.inc("llm_cache_hits_total", reused, purpose="label")
+    logger.info(f"新規コメント {len(comments)} 件のうち {reused} 件に、本文が一致する既存コメントのラベルと埋め込みを再利用しました。")
+    return reused
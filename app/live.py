@@ -0,0 +1,462 @@
+"""
+授業中のコメントのライブ分析。
+
+CSVを授業後にアップロードする代わりに、授業中に届いたコメントをその場で分析し、ダッシュボード (templates/app.js のライブ画面) に配信する。
+- コメントは POST /api/live/{session_id}/comments または WebSocket /ws/live/{session_id} で受け付け、すぐにDBに保存する
+- セッションごとのワーカーが、届いたコメントを最大 LIVE_BATCH_SIZE 件・最大 LIVE_BATCH_WAIT_MS ミリ秒の範囲でまとめ、
+  LLMラベル付け (同時に LIVE_LABEL_CONCURRENCY 件まで)、埋め込みの計算、クラスタの割り当て、DBへの保存を1バッチずつ行う
+- クラスタは HDBSCAN を実行し直さず、既存クラスタの重心とのコサイン類似度で割り当てる (LIVE_CLUSTER_SIMILARITY 未満なら新しいクラスタ)
+- PN比・緊急性・危険コメント数などの集計値はメモリ上で逐次更新し、受付時とバッチの処理後に購読中のダッシュボードへ送る
+
+受付を終了すると (POST /api/live/{session_id}/end)、通常のパイプラインでクラスタリングのやり直し・グラフ・ランキングを作成し、
+分析履歴に追加する。セッションの状態はプロセスのメモリ上にあるため、ライブセッションは1つのワーカープロセスで扱うこと
+(プロセスを再起動した場合は、最初のアクセス時にDBから集計値を復元し、未処理のコメントを処理し直す)。
+"""
+import asyncio
+import logging
+import pickle
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from sqlalchemy.orm import Session
+
+from app.config import (
+    SessionLocal, LIVE_BATCH_SIZE, LIVE_BATCH_WAIT_MS, LIVE_LABEL_CONCURRENCY, LIVE_CLUSTER_SIMILARITY,
+    LIVE_RECENT_COMMENTS, LIVE_TOP_CLUSTERS, LIVE_URGENCY_LEVEL,
+)
+from app.models import Comment, AnalysisSession
+from app.llm import request_labels
+from app.cluster import encode_texts
+from app.scoring import importance_from_tags
+from app.alerts import raise_alerts
+from app.pipeline import run_analysis_pipeline
+from app import metrics
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# ダッシュボード1つあたりの未送信メッセージの上限 (送信が追いつかない接続は古いメッセージから捨てる)
+SUBSCRIBER_QUEUE_SIZE = 100
+# ワーカーへの停止要求 (キューに入れる)
+_STOP = object()
+
+
+class IncrementalClusters:
+    """
+    クラスタごとに正規化した埋め込みベクトルの合計を持ち、新しいコメントを重心が最も近いクラスタに割り当てる。
+    """
+
+    def __init__(self, threshold: float = LIVE_CLUSTER_SIMILARITY):
+        self.threshold = threshold
+        self.ids = []
+        self.sums = []
+        self._centroids = None  # 正規化した重心 (len(ids) x dim)
+
+    @staticmethod
+    def _normalize(vector: np.ndarray) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _refresh(self, index: int):
+        self._centroids[index] = self._normalize(self.sums[index])
+
+    def add(self, cluster_id: int, vector: np.ndarray):
+        """cluster_id が決まっているコメントを重心に加える (DBからの復元用)。"""
+        vector = self._normalize(vector)
+        if cluster_id in self.ids:
+            index = self.ids.index(cluster_id)
+            self.sums[index] += vector
+            self._refresh(index)
+            return
+        self.ids.append(cluster_id)
+        self.sums.append(vector.copy())
+        self._centroids = vector[None, :].copy() if self._centroids is None else np.vstack([self._centroids, vector])
+
+    def assign(self, vector: np.ndarray) -> int:
+        """最も近いクラスタのIDを返す。類似度が閾値未満の場合は新しいクラスタを作る。"""
+        normalized = self._normalize(vector)
+        if self.ids:
+            similarities = self._centroids @ normalized
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                self.sums[best] += normalized
+                self._refresh(best)
+                return self.ids[best]
+        cluster_id = max(self.ids) + 1 if self.ids else 0
+        self.add(cluster_id, normalized)
+        return cluster_id
+
+
+class LiveCounters:
+    """ダッシュボードに表示する集計値 (受付件数、PN比、カテゴリ別の内訳、緊急・危険コメント数、タグの合計)。"""
+
+    def __init__(self):
+        self.received = 0
+        self.labeled = 0
+        self.failed = 0
+        self.positive = 0
+        self.negative = 0
+        self.danger = 0
+        self.urgent = 0
+        self.tag_sums = defaultdict(int)
+        self.categories = defaultdict(lambda: {"positive": 0, "negative": 0, "total": 0})
+
+    def add_labels(self, category: str | None, sentiment: int | None, danger: bool | None, tags: dict | None):
+        self.labeled += 1
+        if sentiment == 1:
+            self.positive += 1
+        elif sentiment == 0:
+            self.negative += 1
+        if danger:
+            self.danger += 1
+        tags = tags or {}
+        for tag_name, value in tags.items():
+            self.tag_sums[tag_name] += int(value or 0)
+        if int(tags.get("緊急性", 0) or 0) >= LIVE_URGENCY_LEVEL:
+            self.urgent += 1
+        if category is not None:
+            counts = self.categories[category]
+            counts["total"] += 1
+            if sentiment == 1:
+                counts["positive"] += 1
+            elif sentiment == 0:
+                counts["negative"] += 1
+
+    def to_dict(self) -> dict:
+        labeled_pn = self.positive + self.negative
+        return {
+            "received": self.received,
+            "labeled": self.labeled,
+            "failed": self.failed,
+            "pending": max(self.received - self.labeled - self.failed, 0),
+            "positive": self.positive,
+            "negative": self.negative,
+            "positive_percent": round(self.positive / labeled_pn * 100, 1) if labeled_pn else None,
+            "danger": self.danger,
+            "urgent": self.urgent,
+            "tag_sums": dict(self.tag_sums),
+            "categories": {category: dict(counts) for category, counts in sorted(self.categories.items())},
+        }
+
+
+def _comment_dict(comment_id: int, text: str, state: str, category=None, sentiment=None, danger=None, tags=None,
+                  cluster_id=None, importance_score=None) -> dict:
+    return {
+        "id": comment_id, "text": text, "state": state, "category": category, "sentiment": sentiment, "danger": danger,
+        "urgency": int((tags or {}).get("緊急性", 0) or 0), "tags": tags, "cluster_id": cluster_id, "importance_score": importance_score,
+    }
+
+
+class LiveSession:
+    """1つのライブセッションの受付キュー・集計値・クラスタと、購読中のダッシュボード。"""
+
+    def __init__(self, session_id: int, title: str):
+        self.session_id = session_id
+        self.title = title
+        self.queue = asyncio.Queue()
+        self.counters = LiveCounters()
+        self.clusters = IncrementalClusters()
+        self.cluster_info = {}
+        self.recent = deque(maxlen=LIVE_RECENT_COMMENTS)
+        self.subscribers = set()
+        self.worker = None
+        self._pending = None  # 前のバッチに入りきらなかったコメント
+        # 受付を終了した (LiveHub.end)。接続中の WebSocket から届いたコメントも受け付けない
+        self.stopped = False
+
+    # --- 復元・開始・停止 ---
+
+    def load(self, db: Session):
+        """DBに保存済みのコメントから集計値とクラスタを復元し、まだ処理していないコメントをキューに入れる。"""
+        rows = db.query(
+            Comment.id, Comment.text, Comment.label_state, Comment.category, Comment.sentiment, Comment.danger,
+            Comment.tags, Comment.cluster_id, Comment.importance_score, Comment.embedding
+        ).filter(Comment.session_id == self.session_id).order_by(Comment.id).all()
+        requeued = 0
+        for row in rows:
+            self.counters.received += 1
+            if row.embedding is None:
+                # 前回のプロセスで処理する前に停止した
+                self.queue.put_nowait((row.id, row.text, time.perf_counter()))
+                self.recent.append(_comment_dict(row.id, row.text, "pending"))
+                requeued += 1
+                continue
+            if row.label_state == "done":
+                self.counters.add_labels(row.category, row.sentiment, row.danger, row.tags)
+            else:
+                self.counters.failed += 1
+            if row.cluster_id is not None:
+                self.clusters.add(row.cluster_id, pickle.loads(row.embedding))
+                self._update_cluster_info(row.cluster_id, row.id, row.text, row.sentiment, row.tags, row.importance_score)
+            self.recent.append(_comment_dict(
+                row.id, row.text, row.label_state, row.category, row.sentiment, row.danger, row.tags, row.cluster_id, row.importance_score
+            ))
+        if rows:
+            logger.info(f"ライブセッションID {self.session_id} を復元しました (コメント {len(rows)} 件、未処理 {requeued} 件)。")
+
+    def start(self):
+        self.worker = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """受付済みのコメントをすべて処理してからワーカーを止める。"""
+        if self.worker is None:
+            return
+        await self.queue.put(_STOP)
+        await self.worker
+        self.worker = None
+
+    # --- 配信 ---
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    def publish(self, message: dict):
+        for queue in list(self.subscribers):
+            if queue.full():
+                # 送信が追いつかないダッシュボードには最新の状態を優先して送る (各メッセージに集計値全体を含む)
+                queue.get_nowait()
+            queue.put_nowait(message)
+
+    def top_clusters(self) -> list:
+        ranked = sorted(self.cluster_info.values(), key=lambda c: (-c["importance_total"], -c["size"], c["cluster_id"]))
+        return [dict(c) for c in ranked[:LIVE_TOP_CLUSTERS]]
+
+    def snapshot(self) -> dict:
+        return {
+            "type": "snapshot",
+            "session_id": self.session_id,
+            "title": self.title,
+            "counters": self.counters.to_dict(),
+            "clusters": self.top_clusters(),
+            "recent": list(self.recent),
+        }
+
+    # --- 受付 ---
+
+    def ingest(self, db: Session, texts: list) -> list:
+        """コメントをDBに保存してキューに入れ、受け付けたコメントIDを返す。受付を終了している場合は ValueError を送出する。"""
+        if self.stopped:
+            # 受付終了後のコメントは、実行中のパイプラインの対象にも、止めたワーカーの対象にもならない
+            raise ValueError(f"ライブセッションID {self.session_id} は受付を終了しています。")
+        texts = [str(t).strip() for t in texts if t is not None and str(t).strip()]
+        if not texts:
+            return []
+        received_at = time.perf_counter()
+        comments = [Comment(text=text, session_id=self.session_id, ingest_session_id=self.session_id) for text in texts]
+        db.add_all(comments)
+        db.commit()
+        for comment in comments:
+            self.queue.put_nowait((comment.id, comment.text, received_at))
+            self.recent.append(_comment_dict(comment.id, comment.text, "pending"))
+        self.counters.received += len(comments)
+        metrics.inc("live_comments_total", len(comments))
+        self.publish({
+            "type": "received",
+            "comments": [_comment_dict(c.id, c.text, "pending") for c in comments],
+            "counters": self.counters.to_dict(),
+        })
+        return [c.id for c in comments]
+
+    # --- バッチ処理 ---
+
+    async def _next_batch(self):
+        # 最初のコメントが届いてから LIVE_BATCH_WAIT_MS ミリ秒、または LIVE_BATCH_SIZE 件に達するまで待つ。停止要求の場合は None を返す
+        first = self._pending if self._pending is not None else await self.queue.get()
+        self._pending = None
+        if first is _STOP:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + LIVE_BATCH_WAIT_MS / 1000
+        while len(batch) < LIVE_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is _STOP:
+                # 停止要求は、このバッチを処理した後に受け取る
+                self._pending = item
+                break
+            batch.append(item)
+        return batch
+
+    async def run(self):
+        while True:
+            batch = await self._next_batch()
+            if batch is None:
+                return
+            try:
+                await self._process(batch)
+            except Exception as e:
+                # 1バッチの失敗でワーカーを止めない (未処理のコメントは受付終了時のパイプラインでラベル付けされる)
+                logger.error(f"ライブセッションID {self.session_id} のバッチ処理中にエラーが発生しました: {e}", exc_info=True)
+
+    async def _process(self, batch: list):
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(LIVE_LABEL_CONCURRENCY)
+
+        async def label(comment_id: int, text: str):
+            async with semaphore:
+                return await request_labels(comment_id, text)
+
+        results = await asyncio.gather(*(label(comment_id, text) for comment_id, text, _ in batch))
+        # 埋め込みの計算はCPUバウンド (または埋め込みサーバーへの同期リクエスト) のため、イベントループを止めないよう別スレッドで行う
+        embeddings = await asyncio.to_thread(encode_texts, [text for _, text, _ in batch])
+
+        mappings = []
+        updated = []
+        labeled = []
+        for (comment_id, text, _), (labels, attempts, error), embedding in zip(batch, results, embeddings):
+            cluster_id = self.clusters.assign(embedding)
+            mapping = {"id": comment_id, "cluster_id": cluster_id, "embedding": pickle.dumps(embedding), "label_attempts": attempts}
+            if labels is None:
+                mapping.update(label_state="failed", label_error=error)
+                self.counters.failed += 1
+                comment = _comment_dict(comment_id, text, "failed", cluster_id=cluster_id)
+            else:
+                score = importance_from_tags(labels["tags"])
+                mapping.update(labels, label_state="done", label_error=None, importance_score=score)
+                labeled.append((comment_id, text, labels))
+                self.counters.add_labels(labels["category"], labels["sentiment"], labels["danger"], labels["tags"])
+                comment = _comment_dict(
+                    comment_id, text, "done", labels["category"], labels["sentiment"], labels["danger"], labels["tags"], cluster_id, score
+                )
+            self._update_cluster_info(cluster_id, comment_id, text, comment["sentiment"], comment["tags"], comment["importance_score"])
+            mappings.append(mapping)
+            updated.append(comment)
+
+        db = SessionLocal()
+        try:
+            db.bulk_update_mappings(Comment, mappings)
+            db.commit()
+            raise_alerts(db, labeled, self.session_id)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"ライブセッションID {self.session_id} の分析結果の保存中にエラーが発生しました: {e}", exc_info=True)
+        finally:
+            db.close()
+
+        # 直近のコメント一覧の表示も更新する
+        by_id = {c["id"]: c for c in updated}
+        self.recent = deque((by_id.get(c["id"], c) for c in self.recent), maxlen=LIVE_RECENT_COMMENTS)
+        self.publish({
+            "type": "labeled",
+            "comments": updated,
+            "counters": self.counters.to_dict(),
+            "clusters": self.top_clusters(),
+        })
+        finished = time.perf_counter()
+        metrics.observe("live_batch_seconds", finished - started)
+        for _, _, received_at in batch:
+            metrics.observe("live_update_latency_seconds", finished - received_at)
+
+    def _update_cluster_info(self, cluster_id: int, comment_id: int, text: str, sentiment, tags, importance_score):
+        info = self.cluster_info.setdefault(cluster_id, {
+            "cluster_id": cluster_id, "size": 0, "representative_id": comment_id, "representative_text": text,
+            "representative_score": -1.0, "importance_total": 0.0, "positive": 0, "negative": 0, "urgent": 0,
+        })
+        info["size"] += 1
+        score = importance_score or 0.0
+        info["importance_total"] += score
+        if sentiment == 1:
+            info["positive"] += 1
+        elif sentiment == 0:
+            info["negative"] += 1
+        if int((tags or {}).get("緊急性", 0) or 0) >= LIVE_URGENCY_LEVEL:
+            info["urgent"] += 1
+        # 代表コメントはクラスタ内で重要度が最も高いコメント (同点は先に届いたコメント)
+        if score > info["representative_score"]:
+            info.update(representative_id=comment_id, representative_text=text, representative_score=score)
+
+
+class LiveHub:
+    """プロセス内のライブセッション (session_id -> LiveSession)。"""
+
+    def __init__(self):
+        self.sessions = {}
+
+    def create(self, db: Session, title: str | None = None) -> LiveSession:
+        title = title or f"ライブ {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+        analysis_session = AnalysisSession(csv_filename=title, status="live", live=True)
+        db.add(analysis_session)
+        db.commit()
+        live = LiveSession(analysis_session.id, title)
+        live.start()
+        self.sessions[analysis_session.id] = live
+        logger.info(f"ライブセッションID {analysis_session.id} を開始しました ({title})。")
+        return live
+
+    def get(self, db: Session, session_id: int) -> LiveSession:
+        """
+        受付中のライブセッションを返す。プロセスの再起動後はDBから復元する。
+        セッションが存在しない場合は LookupError、受付を終了している場合は ValueError を送出する。
+        """
+        live = self.sessions.get(session_id)
+        if live is not None:
+            return live
+        analysis_session = db.get(AnalysisSession, session_id)
+        if analysis_session is None or not analysis_session.live:
+            raise LookupError(f"ライブセッションID {session_id} が見つかりません。")
+        if analysis_session.status != "live":
+            raise ValueError(f"ライブセッションID {session_id} は受付を終了しています。")
+        live = LiveSession(session_id, analysis_session.csv_filename)
+        live.load(db)
+        live.start()
+        self.sessions[session_id] = live
+        return live
+
+    async def end(self, db: Session, session_id: int) -> AnalysisSession:
+        """
+        受付を終了し、受付済みのコメントの処理を待ってから通常のパイプラインで分析結果を作成する。
+        ライブ中のクラスタは暫定のため、ここで HDBSCAN によるクラスタリングをやり直す。ラベル付けに失敗したコメントもここで再試行する。
+        """
+        live = self.get(db, session_id)
+        analysis_session = db.get(AnalysisSession, session_id)
+        # パイプラインの実行中に新しいコメントを受け付けないよう、先に状態を変える
+        live.stopped = True
+        analysis_session.status = "running"
+        db.commit()
+        self.sessions.pop(session_id, None)
+        await live.stop()
+        try:
+            analysis_session = await run_analysis_pipeline(db, pd.DataFrame({"comment": []}), analysis_session.csv_filename, analysis_session)
+        except Exception:
+            db.rollback()
+            analysis_session.status = "failed"
+            db.commit()
+            live.publish({"type": "ended", "session_id": session_id, "status": "failed"})
+            raise
+        live.publish({"type": "ended", "session_id": session_id, "status": analysis_session.status})
+        logger.info(f"ライブセッションID {session_id} の受付を終了し、分析結果を保存しました。")
+        return analysis_session
+
+    def live_sessions(self, db: Session) -> list:
+        rows = db.query(AnalysisSession.id, AnalysisSession.csv_filename, AnalysisSession.created_at).filter(
+            AnalysisSession.live == True, AnalysisSession.status == "live"
+        ).order_by(AnalysisSession.created_at.desc()).all()
+        return [
+            {"session_id": row.id, "title": row.csv_filename, "created_at": row.created_at.isoformat() if row.created_at else None,
+             "received": self.sessions[row.id].counters.received if row.id in self.sessions else None}
+            for row in rows
+        ]
+
+    async def shutdown(self):
+        """アプリケーションの終了時にワーカーを止める (未処理のコメントは次回の起動後に処理し直す)。"""
+        for live in self.sessions.values():
+            if live.worker is not None:
+                live.worker.cancel()
+        self.sessions.clear()
+
+
+hub = LiveHub()
@@ -1,144 +1,306 @@
 import json
 import logging
 import asyncio
+from sqlalchemy import func, or_
 from sqlalchemy.orm import Session
 from app.models import Comment
-from app.config import GROQ_API_KEY , GROQ_MODEL_NAME 
-from groq import Groq # Groqクライアントライブラリをインポート
+from app.config import LLM_PARSE_RETRY_WAIT, LABEL_COMMIT_CHUNK_SIZE, PRIORITY_MIN_SCORE, PRIORITY_COMMIT_CHUNK_SIZE
+from app.providers import router, Deadline, LLMCallError # LLMプロバイダー (Groq / OpenAI互換 / ローカルモデル) の切り替え
+from app.priority import prescore_texts
+from app.alerts import raise_alerts
+from app import metrics
 
 # ロガーの設定
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Groqクライアントの初期化
-# GROQ_API_KEY は環境変数 'GROQ_API_KEY' から自動的に読み込まれるか、
-# client = Groq(api_key=GROQ_API_KEY) のように明示的に渡す
-client = Groq(api_key=GROQ_API_KEY)
+async def request_labels(comment_id: int, text: str, deadline: Deadline | None = None):
+    """
+    1件のコメントをLLMでラベル付けする。3回までリトライする。
+    (ラベル, 試行回数, 最後のエラー) を返す。ラベルは category / danger / sentiment / tags / label_provider の辞書で、すべて失敗した場合は None。
+    呼び出しが失敗した場合、他に使えるプロバイダーがあれば待たずにそのプロバイダーで再試行する。
+    deadline (パイプラインの時間予算) を使い切った場合は、それ以上LLMを呼ばずに None を返す。
+    """
+    prompt = f"""
+    以下のオンライン授業コメントを分類し、追加のタグを付与してください。必ずJSON形式で出力してください。
+    カテゴリ、危険性、感情、質問、具体的、インフラ、緊急性の全てのフィールドに、定義されたルールに従って値を割り当ててください。
 
-async def label_comments(db: Session):
-    comments_to_process = db.query(Comment).filter(Comment.category == None).all()
+    カテゴリ: 以下の厳密に4つのカテゴリのいずれかを選択してください。
+    - 講義内容: 講義の進め方、内容そのものに関するコメント。
+    - 授業資料: スライド、配布資料、教科書などに関するコメント。
+    - 運営: 授業の進行、受講者への連絡、システム利用など、講義内容や資料以外の運営全般に関するコメント。
+    - その他: 上記のカテゴリに該当しない、または判断が難しいコメント。
+
+    危険性: コメントが攻撃的、ハラスメント、暴言などを含む不適切な内容である場合は true、それ以外は false。
+    
+    感情: コメントがポジティブな表現を含んでいれば 1、ネガティブな表現を含んでいれば 0。感情が判断できない場合は 0 を返してください。
+
+    タグ: 以下のタグをワンホットエンコーディング形式 (0/1) で付与してください。緊急性は0〜3の数値で評価してください。
+    - 質問: 質問・疑問点の提示を含んでいれば 1、そうでなければ 0。
+    - 具体的: 具体的な改善提案や事例を含んでいれば 1、そうでなければ 0。
+    - インフラ: 通信・マイク・カメラなどの技術的問題に関する内容であれば 1、そうでなければ 0。
+    - 緊急性: 今すぐ対処すべき内容の緊急度を0（低）から3（高）の数値で評価してください。判断できない場合は0を返してください。
+
+    ---
+    コメント: {text}
+    ---
+    出力例:
+    {{
+        "カテゴリ": "講義内容",
+        "危険性": false,
+        "感情": 1,
+        "質問": 0,
+        "具体的": 1,
+        "インフラ": 0,
+        "緊急性": 2
+    }}
+    """
+    
+    llm_output_str = "" 
+    last_error = None
+    failed_providers = set() # この呼び出しで失敗したプロバイダー (次の試行では他のプロバイダーを優先する)
+    
+    attempts = 0
+    for attempt in range(3): # 3回までリトライ
+        llm_output_str = "" # リトライ時に前回の途中までのレスポンスが残らないようにする
+        if deadline is not None and deadline.expired():
+            last_error = "パイプラインの時間予算を使い切ったため中断しました"
+            break
+        provider = router.pick(failed_providers)
+        if provider is None:
+            # すべてのプロバイダーのサーキットブレーカーが開いている間は、APIを呼ばずに再開を待つ (時間予算の範囲内で)
+            wait = router.next_available_in()
+            if deadline is not None and wait >= deadline.remaining():
+                last_error = "LLMプロバイダーがすべて停止中で、時間予算内に再開しません"
+                break
+            logger.warning(f"LLMプロバイダーがすべて停止中のため、{wait:.1f} 秒待ちます (コメントID {comment_id})。")
+            await asyncio.sleep(wait)
+            provider = router.pick(failed_providers)
+            if provider is None:
+                continue
+        if attempts > 0:
+            metrics.inc("llm_retries_total", purpose="label")
+        attempts += 1
+        try:
+            # stream=True でAPIを呼び出し、ストリーミングされたテキスト断片から完全なレスポンスを構築する
+            # LLM_TIMEOUT で打ち切り、p95 を超えて遅い場合はヘッジリクエストを送る (応答したプロバイダーが返る)
+            provider, llm_output_str = await router.complete(
+                provider,
+                [{"role": "user", "content": prompt}],
+                temperature=0.7,
+                max_tokens=256,
+                json_mode=True,
+                purpose="label",
+                deadline=deadline,
+                exclude=failed_providers
+            )
+
+            logger.info(f"LLMからの生レスポンス (コメントID {comment_id}, {provider.name}): {llm_output_str}")
+            
+            result = json.loads(llm_output_str) # 完全なJSON文字列をパース
+            labels = {}
+            
+            if result.get('カテゴリ') is None:
+                logger.warning(f"コメントID {comment_id} のカテゴリ判定結果がNoneです。デフォルト値'その他'を設定します。")
+                labels['category'] = 'その他' # デフォルト値を設定
+            else:
+                labels['category'] = result.get('カテゴリ')
+
+            # 危険性、感情のNoneチェックと型変換
+            if result.get('危険性') is None:
+                logger.warning(f"コメントID {comment_id} の危険性判定結果がNoneです。デフォルト値Falseを設定します。")
+                labels['danger'] = False
+            else:
+                labels['danger'] = bool(result.get('危険性'))
+
+            if result.get('感情') is None:
+                logger.warning(f"コメントID {comment_id} の感情分類結果がNoneです。デフォルト値0を設定します。")
+                labels['sentiment'] = 0 # Noneの場合は0をデフォルトとする
+            else:
+                try:
+                    labels['sentiment'] = int(result.get('感情'))
+                except ValueError:
+                    logger.warning(f"コメントID {comment_id} の感情分類結果が予期せぬ値です: {result.get('感情')}。デフォルト値0を設定します。")
+                    labels['sentiment'] = 0 
+            
+            # タグのパースと保存
+            tags_data = {}
+            # get() を使ってキーが存在しない場合もエラーにならないようにデフォルト値を設定
+            tags_data['質問'] = int(result.get('質問', 0)) #
+            tags_data['具体的'] = int(result.get('具体的', 0)) #
+            tags_data['インフラ'] = int(result.get('インフラ', 0)) #
+            tags_data['緊急性'] = int(result.get('緊急性', 0)) #
+            labels['tags'] = tags_data # JSON型カラムに辞書を保存 [cite: 35]
+            labels['label_provider'] = provider.name
+            
+            return labels, attempts, None # 成功したらラベルを返して終了
+        except LLMCallError as e:
+            last_error = str(e)
+            failed_providers.add(e.provider.name)
+            logger.error(f"コメントID {comment_id} のLLM API ({e.provider.name}) 呼び出しに失敗しました (試行 {attempt+1}/{3}, {e.kind}): {e.original}")
+            if not e.retryable:
+                # 429 以外の 4xx (不正なリクエスト・認証エラーなど) は再試行しても結果が変わらない
+                break
+            # 他に使えるプロバイダーがある場合は待たずに切り替え、同じプロバイダーで再試行する場合だけエラーの種類に応じて待つ
+            if attempt < 2 and router.pick(failed_providers) is e.provider:
+                wait = e.backoff(attempt)
+                if deadline is not None:
+                    wait = min(wait, deadline.remaining())
+                await asyncio.sleep(wait)
+        except (json.JSONDecodeError, KeyError, ValueError, TypeError, AttributeError) as e:
+            # ローカルモデルなどが不正な形式を返した場合も、そのプロバイダーのエラーとして数える (サーキットブレーカーには含めない)
+            last_error = f"パースエラー ({provider.name}): {e}"
+            provider.stats.record_error(last_error)
+            failed_providers.add(provider.name)
+            metrics.inc("llm_requests_total", purpose="label", outcome="parse_error", provider=provider.name)
+            logger.error(f"コメントID {comment_id} のLLMレスポンスパースエラー (試行 {attempt+1}/{3}, {provider.name}): {e} - レスポンス: '{llm_output_str}'")
+            if attempt < 2 and router.pick(failed_providers) is provider:
+                await asyncio.sleep(LLM_PARSE_RETRY_WAIT)
+        except Exception as e:
+            last_error = f"{provider.name}: {type(e).__name__}: {e}"
+            logger.error(f"コメントID {comment_id} のLLM処理中に予期せぬエラーが発生しました (試行 {attempt+1}/{3}): {e} - レスポンス: '{llm_output_str}'", exc_info=True)
+
+    # リトライ回数を使い果たした場合 (または時間予算切れ・再試行できないエラー)
+    logger.error(f"コメントID {comment_id} のLLM処理が失敗しました (次回の実行で再試行します)。理由: {last_error}")
+    return None, attempts, last_error
+
+async def label_comment(comment: Comment, deadline: Deadline | None = None) -> bool:
+    """
+    1件のコメントをLLMでラベル付けし、カテゴリ・危険性・感情・タグとラベル付けの状態をコメントに設定する。
+    成功した場合は True、すべて失敗した場合は False を返す (DBへの保存は呼び出し側で行う)。
+    """
+    labels, attempts, error = await request_labels(comment.id, comment.text, deadline)
+    comment.label_attempts = (comment.label_attempts or 0) + attempts
+    if labels is None:
+        comment.label_state = "failed"
+        comment.label_error = error
+        return False
+    for attr, value in labels.items():
+        setattr(comment, attr, value)
+    comment.label_state = "done"
+    comment.label_error = None
+    return True
+
+def reset_stale_label_states(db: Session, session_id: int | None = None) -> int:
+    """
+    前回の実行が途中で中断された (プロセスの停止・タイムアウトなど) ために "in_flight" のまま残ったコメントを "pending" に戻す。
+    """
+    # 並列で処理中の他のバッチのセッションに影響しないよう、同じ Comment.session_id のコメントだけを戻す
+    # (同じスコープの実行は pipeline.scope_lock で直列化されるため、ここで戻すのは中断された実行のコメントだけ)
+    reset = db.query(Comment).filter(Comment.label_state == "in_flight", Comment.session_id == session_id).update(
+        {Comment.label_state: "pending"}, synchronize_session=False
+    )
+    db.commit()
+    if reset:
+        logger.info(f"中断された実行で処理中のままだったコメント {reset} 件を未処理に戻しました。")
+    return reset
+
+def get_label_queue_status(db: Session, session_id: int | None = None) -> dict:
+    """代表コメント (重複メンバー以外) のラベル付け状態ごとの件数と、失敗して再試行待ちのコメントを返す。"""
+    counts = {"pending": 0, "in_flight": 0, "done": 0, "failed": 0}
+    has_labels = Comment.category != None
+    rows = db.query(Comment.label_state, has_labels, func.count(Comment.id)).filter(
+        Comment.duplicate_of == None, Comment.session_id == session_id
+    ).group_by(Comment.label_state, has_labels).all()
+    for state, labeled, count in rows:
+        # ラベル付けの状態管理を導入する前のコメント (label_state が None) は、ラベルの有無で扱う
+        counts[state or ("done" if labeled else "pending")] += count
+    failed = db.query(Comment.id, Comment.text, Comment.label_attempts, Comment.label_error).filter(
+        Comment.label_state == "failed", Comment.duplicate_of == None, Comment.session_id == session_id
+    ).order_by(Comment.id).limit(100).all()
+    return {
+        "counts": counts,
+        "failed": [
+            {"id": row.id, "text": row.text, "attempts": row.label_attempts, "error": row.label_error}
+            for row in failed
+        ],
+    }
+
+async def label_comments(db: Session, session_id: int | None = None, deadline: Deadline | None = None, comment_ids: list | None = None):
+    """
+    未ラベルの代表コメントをLLMでラベル付けする。
+    LABEL_COMMIT_CHUNK_SIZE 件ごとに、対象を "in_flight" にしてからLLMを呼び、結果をまとめて書き込んでコミットする。
+    途中で中断しても書き込み済みのチャンクは "done" のまま残り、次回の実行では残りのコメントから再開する。
+    失敗したコメントは "failed" として残り、次回の実行で再試行される。
+    危険・緊急を示す語を含むコメント (priority.prescore が PRIORITY_MIN_SCORE 以上) を先に、PRIORITY_COMMIT_CHUNK_SIZE 件ごとにコミットし、
+    危険・緊急と判定されたコメントはコミットした時点でアラートを送る (パイプラインの完了を待たない)。
+    deadline (パイプラインの時間予算) を使い切った時点で残りのコメントは "pending" のまま残し、次回の実行で処理する。
+    comment_ids を渡した場合は、そのコメントだけをラベル付けする (近似分析モードのサンプル)。
+    """
+    reset_stale_label_states(db, session_id)
+
+    # 重複メンバー (duplicate_of が設定されたコメント) は代表コメントのラベルを展開するため、LLMには送らない
+    # 未処理のコメントを先に、前回失敗したコメントを後に処理する
+    query = db.query(Comment.id, Comment.text, Comment.label_attempts).filter(
+        Comment.category == None,
+        Comment.duplicate_of == None,
+        Comment.session_id == session_id,
+        or_(Comment.label_state == None, Comment.label_state.in_(["pending", "failed"]))
+    )
+    if comment_ids is not None:
+        query = query.filter(Comment.id.in_(comment_ids))
+    rows_to_process = query.order_by(Comment.label_state == "failed", Comment.id).all()
     
-    if not comments_to_process:
+    if not rows_to_process:
         logger.info("処理すべき新規コメントはありません。")
         return
 
-    logger.info(f"{len(comments_to_process)} 件のコメントをLLMでラベル付けします。")
+    # 事前スコアの高い (危険・緊急の可能性が高い) コメントを先頭に移す (同じスコアの中では上の並び順を保つ)
+    scores = prescore_texts([row.text for row in rows_to_process])
+    order = sorted(range(len(rows_to_process)), key=lambda i: -scores[i] if scores[i] >= PRIORITY_MIN_SCORE else 0.0)
+    rows_to_process = [rows_to_process[i] for i in order]
+    priority_count = int((scores >= PRIORITY_MIN_SCORE).sum())
+    # 優先するコメントは小さいチャンクでコミットし、残りは LABEL_COMMIT_CHUNK_SIZE 件ごとにコミットする
+    chunk_bounds = list(range(0, priority_count, max(PRIORITY_COMMIT_CHUNK_SIZE, 1)))
+    chunk_bounds += list(range(priority_count, len(rows_to_process), LABEL_COMMIT_CHUNK_SIZE)) + [len(rows_to_process)]
+
+    logger.info(f"{len(rows_to_process)} 件のコメントをLLMでラベル付けします (危険・緊急の可能性が高いため先に処理するコメント {priority_count} 件)。")
 
     # Groqで利用可能なモデル名に置き換える必要があります。
     # 例: "gemma2-9b-it", "llama3-8b-8192", "llama3-70b-8192", "mixtral-8x7b-32768" など
     # GroqCloudのウェブサイトで利用可能なモデルリストを確認してください。
-    
-    for comment in comments_to_process:
-        await asyncio.sleep(3) 
-        prompt = f"""
-        以下のオンライン授業コメントを分類し、追加のタグを付与してください。必ずJSON形式で出力してください。
-        カテゴリ、危険性、感情、質問、具体的、インフラ、緊急性の全てのフィールドに、定義されたルールに従って値を割り当ててください。
-
-        カテゴリ: 以下の厳密に4つのカテゴリのいずれかを選択してください。
-        - 講義内容: 講義の進め方、内容そのものに関するコメント。
-        - 授業資料: スライド、配布資料、教科書などに関するコメント。
-        - 運営: 授業の進行、受講者への連絡、システム利用など、講義内容や資料以外の運営全般に関するコメント。
-        - その他: 上記のカテゴリに該当しない、または判断が難しいコメント。
-
-        危険性: コメントが攻撃的、ハラスメント、暴言などを含む不適切な内容である場合は true、それ以外は false。
-        
-        感情: コメントがポジティブな表現を含んでいれば 1、ネガティブな表現を含んでいれば 0。感情が判断できない場合は 0 を返してください。
-
-        タグ: 以下のタグをワンホットエンコーディング形式 (0/1) で付与してください。緊急性は0〜3の数値で評価してください。
-        - 質問: 質問・疑問点の提示を含んでいれば 1、そうでなければ 0。
-        - 具体的: 具体的な改善提案や事例を含んでいれば 1、そうでなければ 0。
-        - インフラ: 通信・マイク・カメラなどの技術的問題に関する内容であれば 1、そうでなければ 0。
-        - 緊急性: 今すぐ対処すべき内容の緊急度を0（低）から3（高）の数値で評価してください。判断できない場合は0を返してください。
-
-        ---
-        コメント: {comment.text}
-        ---
-        出力例:
-        {{
-            "カテゴリ": "講義内容",
-            "危険性": false,
-            "感情": 1,
-            "質問": 0,
-            "具体的": 1,
-            "インフラ": 0,
-            "緊急性": 2
-        }}
-        """
-        
-        llm_output_str = "" 
-        
-        for attempt in range(3): # 3回までリトライ
-            try:
-                # Groqクライアントを使用してAPIを呼び出す
-                # stream=True を指定し、チャンクを受け取る
-                completion = client.chat.completions.create(
-                    model=GROQ_MODEL_NAME, 
-                    messages=[
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.7,
-                    max_tokens=256,
-                    response_format={"type": "json_object"},
-                    stream=True # ここでストリーミングを有効にする
-                )
-                
-                # ストリーミングされたチャンクを処理し、完全なレスポンスを構築する
-                for chunk in completion:
-                    if chunk.choices[0].delta.content:
-                        llm_output_str += chunk.choices[0].delta.content
-
-                logger.info(f"LLMからの生レスポンス (コメントID {comment.id}): {llm_output_str}")
-                
-                result = json.loads(llm_output_str) # 完全なJSON文字列をパース
-                
-                if result.get('カテゴリ') is None:
-                    logger.warning(f"コメントID {comment.id} のカテゴリ判定結果がNoneです。デフォルト値'その他'を設定します。")
-                    comment.category = 'その他' # デフォルト値を設定
-                else:
-                    comment.category = result.get('カテゴリ')
 
-                # 危険性、感情のNoneチェックと型変換
-                if result.get('危険性') is None:
-                    logger.warning(f"コメントID {comment.id} の危険性判定結果がNoneです。デフォルト値Falseを設定します。")
-                    comment.danger = False
-                else:
-                    comment.danger = bool(result.get('危険性'))
+    done_count = 0
+    failed_count = 0
+    for start, end in zip(chunk_bounds, chunk_bounds[1:]):
+        if deadline is not None and deadline.expired():
+            skipped = len(rows_to_process) - start
+            metrics.inc("llm_deadline_skipped_total", skipped, purpose="label")
+            logger.warning(f"パイプラインの時間予算を使い切ったため、残り {skipped} 件のラベル付けを次回の実行に回します。")
+            break
+        chunk = rows_to_process[start:end]
+        try:
+            db.query(Comment).filter(Comment.id.in_([row.id for row in chunk])).update(
+                {Comment.label_state: "in_flight"}, synchronize_session=False
+            )
+            db.commit()
 
-                if result.get('感情') is None:
-                    logger.warning(f"コメントID {comment.id} の感情分類結果がNoneです。デフォルト値0を設定します。")
-                    comment.sentiment = 0 # Noneの場合は0をデフォルトとする
+            mappings = []
+            labeled = []
+            for row in chunk:
+                if deadline is not None and deadline.expired():
+                    # このチャンクの未処理分は "in_flight" から "pending" に戻す
+                    mappings.append({"id": row.id, "label_state": "pending"})
+                    metrics.inc("llm_deadline_skipped_total", purpose="label")
+                    continue
+                labels, attempts, error = await request_labels(row.id, row.text, deadline)
+                mapping = {"id": row.id, "label_attempts": (row.label_attempts or 0) + attempts}
+                if labels is None:
+                    mapping.update(label_state="failed", label_error=error)
+                    failed_count += 1
                 else:
-                    try:
-                        comment.sentiment = int(result.get('感情'))
-                    except ValueError:
-                        logger.warning(f"コメントID {comment.id} の感情分類結果が予期せぬ値です: {result.get('感情')}。デフォルト値0を設定します。")
-                        comment.sentiment = 0 
-                
-                # タグのパースと保存
-                tags_data = {}
-                # get() を使ってキーが存在しない場合もエラーにならないようにデフォルト値を設定
-                tags_data['質問'] = int(result.get('質問', 0)) #
-                tags_data['具体的'] = int(result.get('具体的', 0)) #
-                tags_data['インフラ'] = int(result.get('インフラ', 0)) #
-                tags_data['緊急性'] = int(result.get('緊急性', 0)) #
-                comment.tags = tags_data # JSON型カラムに辞書を保存 [cite: 35]
-                
-                db.add(comment)
-                break # 成功したらループを抜ける
-            except (json.JSONDecodeError, KeyError) as e:
-                logger.error(f"コメントID {comment.id} のLLMレスポンスパースエラー (試行 {attempt+1}/{3}): {e} - レスポンス: '{llm_output_str}'")
-                if attempt < 2:
-                    await asyncio.sleep(2)
-            except Exception as e:
-                logger.error(f"コメントID {comment.id} のGroq API処理中に予期せぬエラーが発生しました (試行 {attempt+1}/{3}): {e} - レスポンス: '{llm_output_str}'", exc_info=True)
-                if attempt < 2:
-                    await asyncio.sleep(10)
-        else: # リトライ回数を使い果たした場合
-            logger.error(f"コメントID {comment.id} のLLM処理が複数回失敗したためスキップします。最終レスポンス: '{llm_output_str}'")
-            
-    try:
-        db.commit()
-        logger.info("LLMによるコメントのラベル付けが完了しました。")
-    except Exception as e:
-        db.rollback()
-        logger.error(f"コメントのLLMラベル付け結果のコミット中にエラーが発生しました: {e}", exc_info=True)
+                    mapping.update(labels, label_state="done", label_error=None)
+                    labeled.append((row.id, row.text, labels))
+                    done_count += 1
+                mappings.append(mapping)
+
+            db.bulk_update_mappings(Comment, mappings)
+            with metrics.span("db_commit"):
+                db.commit()
+            raise_alerts(db, labeled, session_id)
+            logger.info(f"LLMラベル付けの進捗: {start + len(chunk)}/{len(rows_to_process)} 件 (成功 {done_count} 件、失敗 {failed_count} 件)")
+        except Exception as e:
+            db.rollback()
+            logger.error(f"コメントのLLMラベル付け結果のコミット中にエラーが発生しました: {e}", exc_info=True)
+
+    logger.info(f"LLMによるコメントのラベル付けが完了しました。成功 {done_count} 件、失敗 {failed_count} 件 (失敗分は次回の実行で再試行します)")
@@ -1,16 +1,26 @@
-from fastapi import FastAPI, UploadFile, File, Request, HTTPException, Depends
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, UploadFile, File, Form, Request, HTTPException, Depends, Query, WebSocket, WebSocketDisconnect, BackgroundTasks
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.templating import Jinja2Templates
-import os, shutil, pandas as pd
-from sqlalchemy.orm import Session
-from app.config import SessionLocal, UPLOAD_DIR, engine
-from app.models import Comment, Base, AnalysisSession
-from app.crud import save_comments_from_csv
-from app.llm import label_comments
-from app.cluster import cluster_comments
-from app.scoring import calculate_importance_scores
-from app.analyze import generate_pn_charts, get_top_clusters_and_comments, get_comments_in_cluster, generate_ai_analysis_comment
+import os, shutil, json, asyncio, tempfile, pandas as pd
+from sqlalchemy import or_
+from sqlalchemy.orm import Session, defer
+from app.config import SessionLocal, UPLOAD_DIR, engine, DEBUG, GZIP_MINIMUM_SIZE, UPLOAD_REUSE_ENABLED, APPROXIMATE_MIN_COMMENTS, APPROXIMATE_REFINE
+from app.models import Comment, Base, AnalysisSession, upgrade_schema, comment_scope
+from app.pipeline import run_analysis_pipeline, refine_approximate_session
+from app.analyze import get_comments_in_cluster, stream_ai_analysis_comment
+from app.llm import get_label_queue_status
+from app.providers import router as llm_router
+from app.batch import collect_csv_files, new_batch_id, start_batch, get_job, batch_progress
+from app.export import iter_csv, iter_parquet
+from app.live import hub as live_hub
+from app.topics import topic_trends, topic_detail
+from app.terms import analyze_terms
+from app.alerts import hub as alert_hub, list_alerts
+from app.fingerprint import file_sha256, find_analyzed_session
+from app.archive import SIDECAR_FIELDS, session_results, save_session_result, get_archived_comments_in_cluster, iter_archived_csv, iter_archived_parquet
+from app import metrics
 import logging
 from typing import List, Dict, Optional, Any
 from collections import defaultdict
@@ -24,6 +34,7 @@ from app.schemas import (
     AnalysisSessionListItem,
     PnChartsResult,
     ClusterDetailsResponse, TopClusterResult,
+    LiveSessionCreate, LiveCommentsIn,
     )
 
 from typing import List, Dict, Optional, Any # 念のため Dict, Any も確認
@@ -44,6 +55,27 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 app.mount("/static", StaticFiles(directory="templates"), name="static")
 
+# グラフ画像 (Base64) やランキングを含むJSONレスポンスを圧縮する (Server-Sent Events は圧縮されない)
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
+
+# リクエストごとにSQLクエリ数と合計時間を数え、デバッグモードではレスポンスヘッダーで返す
+@app.middleware("http")
+async def count_db_queries(request: Request, call_next):
+    with metrics.collect_query_stats() as query_stats:
+        response = await call_next(request)
+    if DEBUG:
+        response.headers["X-DB-Query-Count"] = str(query_stats.count)
+        response.headers["X-DB-Query-Time-Ms"] = f"{query_stats.seconds * 1000:.1f}"
+    return response
+
+def _completed_sessions(db: Session):
+    # バッチアップロードで実行中・失敗したセッションは、履歴や最新の分析結果に含めない
+    return db.query(AnalysisSession).filter(or_(AnalysisSession.status == None, AnalysisSession.status == "done"))
+
+def _summary_only(query):
+    # 履歴一覧・時系列グラフではグラフ画像やランキングを使わないため、圧縮カラムを読み込まない (展開の処理も省く)
+    return query.options(*(defer(getattr(AnalysisSession, field)) for field in SIDECAR_FIELDS + ["keywords"]))
+
 def get_db():
     db = SessionLocal()
     try:
@@ -60,17 +92,29 @@ async def upload_form(request: Request):
     return templates.TemplateResponse("upload.html", {"request": request})
 
 @app.post("/upload")
-async def handle_upload(file: UploadFile = File(...), db: Session = Depends(get_db)):
+async def handle_upload(background_tasks: BackgroundTasks, file: UploadFile = File(...), approximate: Optional[bool] = Form(None),
+                        db: Session = Depends(get_db)):
     if not file.filename.endswith(".csv"):
         raise HTTPException(status_code=400, detail="CSVファイルのみアップロード可能です。")
 
-    filepath = os.path.join(UPLOAD_DIR, file.filename)
+    # 保存しながら内容の SHA-256 を計算し、同じファイル名の別のファイルを上書きしないようハッシュを付けた名前で保存する
+    filename = os.path.basename(file.filename)
     try:
-        with open(filepath, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        fd, partial_path = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=".partial")
+        with os.fdopen(fd, "wb") as buffer:
+            sha256 = file_sha256(file.file, buffer)
+        filepath = os.path.join(UPLOAD_DIR, f"{sha256[:16]}_{filename}")
+        os.replace(partial_path, filepath)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"ファイルの保存中にエラーが発生しました: {e}")
 
+    if UPLOAD_REUSE_ENABLED:
+        # 同じ内容のファイルを分析済みの場合は、パイプラインを実行せずにそのセッションを返す
+        existing_session = find_analyzed_session(db, sha256)
+        if existing_session is not None:
+            logger.info(f"{filename} は分析セッションID {existing_session.id} と同じ内容のため、その分析結果を返します。")
+            return RedirectResponse(url=f"/?session_id={existing_session.id}", status_code=303)
+
     try:
         df = pd.read_csv(filepath)
         if df.empty or df.iloc[:, 0].isnull().all():
@@ -80,73 +124,12 @@ async def handle_upload(file: UploadFile = File(...), db: Session = Depends(get_
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"CSVファイルの読み込み中にエラーが発生しました。フォーマットを確認してください: {e}")
 
-    try:
-        saved_count = save_comments_from_csv(db, df)
-        
-        logger.info("LLMによるラベル付けを開始します。")
-        await label_comments(db)
-        logger.info("LLMによるラベル付けが完了しました。")
-
-        logger.info("コメントのクラスタリングを開始します。")
-        logger.debug(f"cluster_comments の型: {type(cluster_comments)}")
-        await cluster_comments(db)
-        logger.info("コメントのクラスタリングが完了しました。")
+    # 近似分析モード: 指定がない場合はコメント数が APPROXIMATE_MIN_COMMENTS 以上のときに使う
+    if approximate is None:
+        approximate = APPROXIMATE_MIN_COMMENTS > 0 and len(df) >= APPROXIMATE_MIN_COMMENTS
 
-        logger.debug("calculate_importance_scores を呼び出す直前です。")
-        await calculate_importance_scores(db) 
-        logger.info("重要度スコアの計算が完了しました。")
-
-        # --- 分析結果を取得し、AnalysisSession に保存するロジック ---
-        logger.info("分析結果の最終取得と保存を開始します。")
-        
-        # PN比グラフデータを取得
-        # generate_pn_chartsは同期関数だが、Pydanticスキーマに合うように辞書を構築
-        pn_charts_data_raw = generate_pn_charts(db)
-        
-        # 重要度ランキングデータを取得
-        top_clusters_ranking_raw = await get_top_clusters_and_comments(db)
-        
-        # AI分析コメントを取得
-        ai_analysis_comment_text = await generate_ai_analysis_comment(db)
-
-        # 総コメント数を取得
-        total_comments_count = db.query(Comment).count()
-        
-        # 全体PN比のパーセンテージを計算 (時系列グラフ用)
-        total_pos = db.query(Comment).filter(Comment.sentiment == 1).count()
-        total_neg = db.query(Comment).filter(Comment.sentiment == 0).count()
-        overall_pos_percent = (total_pos / total_comments_count * 100) if total_comments_count > 0 else 0.0
-        overall_neg_percent = (total_neg / total_comments_count * 100) if total_comments_count > 0 else 0.0
-
-        # カテゴリ別PN比のパーセンテージを計算 (時系列グラフ用)
-        category_sentiment_percents = {}
-        categories = db.query(Comment.category).distinct().filter(Comment.category != None).all()
-        for category_tuple in categories:
-            category = category_tuple.category
-            cat_total = db.query(Comment).filter(Comment.category == category).count()
-            cat_pos = db.query(Comment).filter(Comment.sentiment == 1, Comment.category == category).count()
-            cat_pos_percent = (cat_pos / cat_total * 100) if cat_total > 0 else 0.0
-            category_sentiment_percents[category] = cat_pos_percent # カテゴリ別のポジティブ比率のみを保存
-
-        # 危険コメント数を取得
-        dangerous_comment_count = db.query(Comment).filter(Comment.danger == True).count()
-
-        # AnalysisSession オブジェクトを作成し、データベースに保存
-        new_analysis_session = AnalysisSession(
-            csv_filename=file.filename,
-            total_comments=total_comments_count,
-            total_pn_chart_base64=pn_charts_data_raw["total_pn_chart"],
-            category_pn_charts_base64=pn_charts_data_raw["category_pn_charts"],
-            top_clusters_data=top_clusters_ranking_raw,
-            ai_analysis_comment=ai_analysis_comment_text,
-            overall_positive_percent=overall_pos_percent,
-            overall_negative_percent=overall_neg_percent,
-            category_sentiment_percents=category_sentiment_percents,
-            dangerous_comment_count=dangerous_comment_count
-        )
-        db.add(new_analysis_session)
-        db.commit()
-        logger.info(f"分析セッションID {new_analysis_session.id} をデータベースに保存しました。")
+    try:
+        new_analysis_session = await run_analysis_pipeline(db, df, file.filename, file_sha256=sha256, approximate=approximate)
 
     except TypeError as te:
         logger.error(f"分析パイプライン実行中にTypeErrorが発生しました: {te}. 関数が非同期関数として認識されていない可能性があります。", exc_info=True)
@@ -155,7 +138,46 @@ async def handle_upload(file: UploadFile = File(...), db: Session = Depends(get_
         logger.error(f"分析パイプライン実行中に予期せぬエラーが発生しました: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"コメントの処理中にエラーが発生しました: {e}")
     
-    return RedirectResponse(url="/", status_code=303)
+    if approximate and APPROXIMATE_REFINE:
+        # 近似の結果を返した後、残りのコメントのラベル付けを続けて全件の集計値に置き換える
+        background_tasks.add_task(refine_approximate_session, new_analysis_session.id)
+
+    # 作成したセッションIDをクエリに付けて返し、フロントエンドがAI分析コメントのストリームに接続できるようにする
+    return RedirectResponse(url=f"/?session_id={new_analysis_session.id}", status_code=303)
+
+# 複数のCSVファイル、またはCSVをまとめたzipファイルを受け取り、ファイルごとの分析をバックグラウンドで並列に実行する
+# 進捗は返却した batch_id を使って /api/batch/{batch_id} で確認する
+@app.post("/api/batch_upload")
+async def handle_batch_upload(files: List[UploadFile] = File(...)):
+    batch_id = new_batch_id()
+    batch_dir = os.path.join(UPLOAD_DIR, f"batch_{batch_id}")
+    os.makedirs(batch_dir, exist_ok=True)
+
+    paths = []
+    for upload in files:
+        filename = os.path.basename(upload.filename or "")
+        if not filename.lower().endswith((".csv", ".zip")):
+            raise HTTPException(status_code=400, detail=f"CSVファイルまたはzipファイルのみアップロード可能です: {filename}")
+        filepath = os.path.join(batch_dir, filename)
+        try:
+            with open(filepath, "wb") as buffer:
+                shutil.copyfileobj(upload.file, buffer)
+            paths.extend(collect_csv_files(filepath, os.path.join(batch_dir, os.path.splitext(filename)[0])))
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"ファイルの保存・展開中にエラーが発生しました ({filename}): {e}")
+
+    if not paths:
+        raise HTTPException(status_code=400, detail="CSVファイルが含まれていません。")
+
+    job = start_batch(paths, batch_id)
+    return {"batch_id": job.batch_id, "total_files": len(paths)}
+
+@app.get("/api/batch/{batch_id}")
+async def get_batch_progress(batch_id: str):
+    job = get_job(batch_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+    return batch_progress(job)
 
 # --- 分析結果提供用のAPIエンドポイント ---
 # response_model を追加して、スキーマに準拠したレスポンスを強制する
@@ -168,38 +190,62 @@ async def get_analysis_results(session_id: int | None = None, db: Session = Depe
             analysis_session = db.query(AnalysisSession).filter(AnalysisSession.id == session_id).first()
             if not analysis_session:
                 raise HTTPException(status_code=404, detail="Analysis session not found")
-            
-            # Pydanticスキーマに合うようにデータを整形して返す
-            return AnalysisResult(
-                pn_charts=PnChartsResult(
-                    total_pn_chart=analysis_session.total_pn_chart_base64,
-                    category_pn_charts=analysis_session.category_pn_charts_base64
-                ),
-                top_clusters=analysis_session.top_clusters_data # ORMモードで自動変換されることを期待
-            )
         else:
             # 最新の分析結果を取得 (履歴から取得)
-            latest_session = db.query(AnalysisSession).order_by(AnalysisSession.created_at.desc()).first()
-            if not latest_session:
+            analysis_session = _completed_sessions(db).order_by(AnalysisSession.created_at.desc()).first()
+            if not analysis_session:
                 raise HTTPException(status_code=404, detail="No analysis results found. Please upload a CSV first.")
-            
-            return AnalysisResult(
-                pn_charts=PnChartsResult(
-                    total_pn_chart=latest_session.total_pn_chart_base64,
-                    category_pn_charts=latest_session.category_pn_charts_base64
-                ),
-                top_clusters=latest_session.top_clusters_data # ORMモードで自動変換されることを期待
-            )
+
+        # アーカイブ済みのセッションはグラフ・ランキングをアーカイブのファイルから読む
+        results = session_results(analysis_session)
+        # Pydanticスキーマに合うようにデータを整形して返す
+        return AnalysisResult(
+            pn_charts=PnChartsResult(
+                total_pn_chart=results["total_pn_chart_base64"],
+                category_pn_charts=results["category_pn_charts_base64"]
+            ),
+            top_clusters=results["top_clusters_data"], # ORMモードで自動変換されることを期待
+            approximation=analysis_session.approximation
+        )
     except Exception as e:
         logger.error(f"API /api/analysis_results 処理中にエラーが発生しました: {e}", exc_info=True)
+        if isinstance(e, HTTPException):
+            raise e
         raise HTTPException(status_code=500, detail=f"分析結果の取得中にエラーが発生しました: {e}")
 
 @app.get("/api/cluster_details/{cluster_id}", response_model=ClusterDetailsResponse) # response_model を新しいスキーマに変更
-async def get_cluster_details_api(cluster_id: int, session_id: int | None = None, db: Session = Depends(get_db)):
-    logger.info(f"API: /api/cluster_details/{cluster_id} が呼び出されました。Session ID: {session_id}")
+async def get_cluster_details_api(
+    cluster_id: int,
+    session_id: int | None = None,
+    limit: int = Query(50, ge=1, le=500), # 1ページあたりのコメント数
+    cursor: str | None = None, # 前のページのレスポンスの next_cursor
+    category: str | None = None,
+    sentiment: int | None = None,
+    danger: bool | None = None,
+    db: Session = Depends(get_db)
+):
+    logger.info(f"API: /api/cluster_details/{cluster_id} が呼び出されました。Session ID: {session_id}, cursor: {cursor}")
     try:
+        if session_id is None:
+            # セッション指定がない場合は、最新の分析結果 (/api/analysis_results と同じセッション) のクラスタを返す
+            latest_session = _completed_sessions(db).order_by(AnalysisSession.created_at.desc()).first()
+            session_id = latest_session.id if latest_session else None
+        analysis_session = db.get(AnalysisSession, session_id) if session_id is not None else None
         # get_comments_in_cluster は既に辞書を返します
-        details = get_comments_in_cluster(db, cluster_id)
+        try:
+            if analysis_session is not None and analysis_session.archived_at is not None:
+                # アーカイブ済みのセッションはParquetファイルから読み取る
+                details = get_archived_comments_in_cluster(
+                    analysis_session, cluster_id, limit=limit, cursor=cursor,
+                    category=category, sentiment=sentiment, danger=danger
+                )
+            else:
+                details = get_comments_in_cluster(
+                    db, cluster_id, session_id, limit=limit, cursor=cursor,
+                    category=category, sentiment=sentiment, danger=danger
+                )
+        except ValueError as ve:
+            raise HTTPException(status_code=400, detail=str(ve))
         
         # ClusterDetailsResponse スキーマのインスタンスとして返す
         return ClusterDetailsResponse(**details) # ここで辞書をスキーマに変換
@@ -217,22 +263,142 @@ async def get_ai_analysis_comment_api(session_id: int | None = None, db: Session
             analysis_session = db.query(AnalysisSession).filter(AnalysisSession.id == session_id).first()
             if not analysis_session:
                 raise HTTPException(status_code=404, detail="Analysis session not found")
-            return AiAnalysisCommentResult(comment=analysis_session.ai_analysis_comment)
         else:
-            latest_session = db.query(AnalysisSession).order_by(AnalysisSession.created_at.desc()).first()
-            if not latest_session:
+            analysis_session = _completed_sessions(db).order_by(AnalysisSession.created_at.desc()).first()
+            if not analysis_session:
                 raise HTTPException(status_code=404, detail="No analysis results found. Please upload a CSV first.")
-            return AiAnalysisCommentResult(comment=latest_session.ai_analysis_comment)
+        # 未生成 (ストリーミング中・未接続) の場合は空文字を返す
+        return AiAnalysisCommentResult(comment=session_results(analysis_session)["ai_analysis_comment"] or "")
     except Exception as e:
         logger.error(f"API /api/ai_analysis_comment 処理中にエラーが発生しました: {e}", exc_info=True)
+        if isinstance(e, HTTPException):
+            raise e
         raise HTTPException(status_code=500, detail=f"AI分析コメントの取得中にエラーが発生しました: {e}")
 
+# LLMラベル付けの進捗 (状態ごとの件数) と、失敗して次回の実行で再試行されるコメントの一覧
+# session_id を指定した場合は、そのセッション (バッチアップロード) のコメントの状態を返す
+@app.get("/api/labeling/status")
+async def get_labeling_status_api(session_id: int | None = None, db: Session = Depends(get_db)):
+    scope = None
+    if session_id is not None:
+        analysis_session = db.get(AnalysisSession, session_id)
+        if not analysis_session:
+            raise HTTPException(status_code=404, detail="Analysis session not found")
+        scope = comment_scope(analysis_session)
+    status = get_label_queue_status(db, scope)
+    # サーキットブレーカーの状態 (障害中でラベル付けが止まっているかどうか)
+    status["llm"] = llm_router.status()
+    return status
+
+# LLMプロバイダーごとの応答時間・エラー率と、現在優先して使われる順序
+@app.get("/api/llm/providers")
+async def get_llm_providers_api():
+    return {"order": [p.name for p in llm_router.candidates()], "providers": llm_router.status()}
+
+# アラートのストリームで、新しいアラートがない間に接続維持のコメント行を送る間隔 (秒)
+ALERT_STREAM_PING_SECONDS = 15
+
+def _sse_event(event: str, data: Dict[str, Any]) -> str:
+    # Server-Sent Events の1イベント分の文字列 (改行を含むテキストも安全に送れるよう data はJSONにする)
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# AI分析コメントを生成しながら Server-Sent Events でブラウザに送るエンドポイント
+# 生成が完了した時点でテキストを AnalysisSession (アーカイブ済みの場合はサイドカーファイル) に保存する。既に保存済みの場合はその内容をそのまま送る。
+@app.get("/api/ai_analysis_comment/stream")
+async def stream_ai_analysis_comment_api(session_id: int, db: Session = Depends(get_db)):
+    logger.info(f"API: /api/ai_analysis_comment/stream が呼び出されました。Session ID: {session_id}")
+    if not db.query(AnalysisSession.id).filter(AnalysisSession.id == session_id).first():
+        raise HTTPException(status_code=404, detail="Analysis session not found")
+
+    async def event_stream():
+        # レスポンスのストリーミング中も使えるよう、依存性注入とは別にセッションを開く
+        stream_db = SessionLocal()
+        try:
+            analysis_session = stream_db.query(AnalysisSession).filter(AnalysisSession.id == session_id).first()
+            saved_comment = session_results(analysis_session)["ai_analysis_comment"]
+            if saved_comment:
+                yield _sse_event("token", {"text": saved_comment})
+                yield _sse_event("done", {})
+                return
+            if analysis_session.archived_at is not None and analysis_session.summary_inputs is None:
+                # 集計値を保存していないアーカイブ済みのセッションはコメントがDBにないため、新たに生成できない
+                yield _sse_event("error", {"detail": "アーカイブ済みの分析セッションのため、AI分析コメントを生成できません。"})
+                return
+
+            tokens = []
+            try:
+                async for token in stream_ai_analysis_comment(stream_db, session_id, analysis_session.summary_inputs):
+                    tokens.append(token)
+                    yield _sse_event("token", {"text": token})
+            except Exception as e:
+                logger.error(f"AI分析コメントのストリーミング中にエラーが発生しました: {e}", exc_info=True)
+                yield _sse_event("error", {"detail": "AI分析コメントの生成に失敗しました。詳細についてはログを確認してください。"})
+                return
+
+            # アーカイブ済みのセッションはサイドカーファイルに保存する (DBのカラムはアーカイブ時に空にしている)
+            save_session_result(analysis_session, "ai_analysis_comment", "".join(tokens))
+            stream_db.commit()
+            logger.info(f"分析セッションID {session_id} のAI分析コメントを保存しました。")
+            yield _sse_event("done", {})
+        finally:
+            stream_db.close()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# 危険・緊急と判定されたコメントのアラート (ラベル付けの結果をコミットした時点で作成される、app/alerts.py)
+@app.get("/api/alerts")
+async def get_alerts(since_id: int = 0, session_id: Optional[int] = None, limit: int = Query(100, ge=1, le=1000),
+                     db: Session = Depends(get_db)):
+    return list_alerts(db, since_id, session_id, limit)
+
+# アラートを Server-Sent Events で送る。接続時に since_id (または再接続時の Last-Event-ID) より後のアラートを送ってから、新しいアラートを待つ
+@app.get("/api/alerts/stream")
+async def stream_alerts(request: Request, since_id: Optional[int] = None, session_id: Optional[int] = None):
+    last_id = since_id if since_id is not None else int(request.headers.get("last-event-id") or 0)
+
+    async def event_stream():
+        nonlocal last_id
+        # 取りこぼさないよう、過去分を読む前に購読を始める
+        queue = alert_hub.subscribe()
+        try:
+            stream_db = SessionLocal()
+            try:
+                backlog = list_alerts(stream_db, last_id, session_id, limit=1000)
+            finally:
+                stream_db.close()
+            for alert in backlog:
+                last_id = alert["id"]
+                yield f"id: {alert['id']}\n" + _sse_event("alert", alert)
+            while not await request.is_disconnected():
+                try:
+                    alert = await asyncio.wait_for(queue.get(), ALERT_STREAM_PING_SECONDS)
+                except asyncio.TimeoutError:
+                    # プロキシに接続を切られないよう、コメント行を送る
+                    yield ": ping\n\n"
+                    continue
+                if alert["id"] <= last_id or (session_id is not None and alert["session_id"] != session_id):
+                    continue
+                last_id = alert["id"]
+                yield f"id: {alert['id']}\n" + _sse_event("alert", alert)
+        finally:
+            alert_hub.unsubscribe(queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # 新規追加APIエンドポイント: 履歴リスト取得
 @app.get("/api/analysis_sessions", response_model=List[AnalysisSessionListItem])
 async def get_analysis_sessions_list(db: Session = Depends(get_db)):
     logger.info("API: /api/analysis_sessions が呼び出されました。")
     try:
-        sessions = db.query(AnalysisSession).order_by(AnalysisSession.created_at.desc()).all()
+        sessions = _summary_only(_completed_sessions(db)).order_by(AnalysisSession.created_at.desc()).all()
         # ORMモードが有効なため、直接リストを返すことでPydanticが自動変換する
         return sessions 
     except Exception as e:
@@ -244,7 +410,7 @@ async def get_analysis_sessions_list(db: Session = Depends(get_db)):
 async def get_time_series_data(db: Session = Depends(get_db)):
     logger.info("API: /api/time_series_data が呼び出されました。")
     try:
-        sessions = db.query(AnalysisSession).order_by(AnalysisSession.created_at.asc()).all()
+        sessions = _summary_only(_completed_sessions(db)).order_by(AnalysisSession.created_at.asc()).all()
 
         dates = []
         overall_positive_percents = []
@@ -268,6 +434,190 @@ async def get_time_series_data(db: Session = Depends(get_db)):
         logger.error(f"API /api/time_series_data 処理中にエラーが発生しました: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"時系列データの取得中にエラーが発生しました: {e}")
 
+# 講義をまたいだトピックの推移 (パイプラインで保存したスナップショットから返し、コメントの再埋め込みはしない)
+@app.get("/api/topics/trends")
+async def get_topic_trends(limit: int = Query(10, ge=1, le=100), sort: str = Query("total", pattern="^(total|growth)$"),
+                           min_sessions: int = Query(1, ge=1), db: Session = Depends(get_db)):
+    return {"sort": sort, "topics": topic_trends(db, limit=limit, sort=sort, min_sessions=min_sessions)}
+
+@app.get("/api/topics/{topic_id}")
+async def get_topic(topic_id: int, db: Session = Depends(get_db)):
+    detail = topic_detail(db, topic_id)
+    if detail is None:
+        raise HTTPException(status_code=404, detail="Topic not found")
+    return detail
+
+# 分析セッションのコメント (ラベル・タグ・クラスタID・重要度スコア) をCSVまたはParquetでダウンロードする
+# コメントを一定件数ずつ読み出して送るため、コメント数が多くてもメモリ使用量は増えない
+@app.get("/api/analysis_sessions/{session_id}/export")
+async def export_session_comments(session_id: int, format: str = Query("csv", pattern="^(csv|parquet)$"),
+                                  embeddings: bool = False, db: Session = Depends(get_db)):
+    if not db.get(AnalysisSession, session_id):
+        raise HTTPException(status_code=404, detail="Analysis session not found")
+
+    def stream():
+        # レスポンスのストリーミング中も使えるよう、依存性注入とは別にセッションを開く
+        export_db = SessionLocal()
+        try:
+            analysis_session = export_db.get(AnalysisSession, session_id)
+            if analysis_session.archived_at is not None:
+                # アーカイブ済みのセッションはParquetファイルから書き出す
+                if format == "csv":
+                    for chunk in iter_archived_csv(analysis_session):
+                        yield chunk.encode("utf-8")
+                else:
+                    yield from iter_archived_parquet(analysis_session)
+            elif format == "csv":
+                for chunk in iter_csv(export_db, analysis_session):
+                    yield chunk.encode("utf-8")
+            else:
+                yield from iter_parquet(export_db, analysis_session, include_embeddings=embeddings)
+        finally:
+            export_db.close()
+
+    media_type = "text/csv; charset=utf-8" if format == "csv" else "application/vnd.apache.parquet"
+    return StreamingResponse(
+        stream(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="session_{session_id}.{format}"'},
+    )
+
+# セッションのキーワード (全体・クラスタ別・カテゴリ別の TF-IDF 上位語)。パイプラインで保存した結果を返す
+# 用語分析の前に作成されたセッションは、コメントが残っていればここで計算して保存する
+@app.get("/api/analysis_sessions/{session_id}/keywords")
+async def get_session_keywords(session_id: int, cluster_id: Optional[int] = None, category: Optional[str] = None,
+                               db: Session = Depends(get_db)):
+    analysis_session = db.get(AnalysisSession, session_id)
+    if analysis_session is None:
+        raise HTTPException(status_code=404, detail="Analysis session not found")
+    keywords = analysis_session.keywords
+    if keywords is None:
+        if analysis_session.archived_at is not None or analysis_session.status not in (None, "done"):
+            raise HTTPException(status_code=404, detail="Keywords are not available for this session")
+        keywords = analyze_terms(db, analysis_session) or {"overall": [], "clusters": {}, "categories": {}}
+    if cluster_id is not None:
+        return {"cluster_id": cluster_id, "keywords": keywords["clusters"].get(str(cluster_id), [])}
+    if category is not None:
+        return {"category": category, "keywords": keywords["categories"].get(category, [])}
+    return keywords
+
+# --- ライブセッション (授業中のコメントの逐次分析、app/live.py) ---
+def _live_session_or_error(db: Session, session_id: int):
+    try:
+        return live_hub.get(db, session_id)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.post("/api/live/sessions")
+async def create_live_session(body: LiveSessionCreate, db: Session = Depends(get_db)):
+    live = live_hub.create(db, body.title)
+    return {"session_id": live.session_id, "title": live.title}
+
+@app.get("/api/live/sessions")
+async def list_live_sessions(db: Session = Depends(get_db)):
+    return live_hub.live_sessions(db)
+
+# WebSocket に接続できない環境向け: 現在の集計値・上位クラスタ・直近のコメントを返す
+@app.get("/api/live/{session_id}")
+async def get_live_snapshot(session_id: int, db: Session = Depends(get_db)):
+    return _live_session_or_error(db, session_id).snapshot()
+
+@app.post("/api/live/{session_id}/comments", status_code=202)
+async def post_live_comments(session_id: int, body: LiveCommentsIn, db: Session = Depends(get_db)):
+    texts = body.texts or ([body.text] if body.text else [])
+    live = _live_session_or_error(db, session_id)
+    try:
+        comment_ids = live.ingest(db, texts)
+    except ValueError as e:
+        # 受付の終了処理が始まった
+        raise HTTPException(status_code=409, detail=str(e))
+    if not comment_ids:
+        raise HTTPException(status_code=400, detail="コメントが空です。")
+    return {"accepted": len(comment_ids), "comment_ids": comment_ids}
+
+# 受付を終了し、通常のパイプラインでクラスタリングのやり直し・グラフ・ランキングを作成する (分析履歴に追加される)
+@app.post("/api/live/{session_id}/end")
+async def end_live_session(session_id: int, db: Session = Depends(get_db)):
+    _live_session_or_error(db, session_id)
+    try:
+        analysis_session = await live_hub.end(db, session_id)
+    except Exception as e:
+        logger.error(f"ライブセッションID {session_id} の終了処理中にエラーが発生しました: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"ライブセッションの分析中にエラーが発生しました: {e}")
+    return {"session_id": analysis_session.id, "status": analysis_session.status, "total_comments": analysis_session.total_comments}
+
+# ダッシュボードとの双方向の接続: 接続時に snapshot、その後は received / labeled / ended のメッセージを送る
+# クライアントから {"text": "..."} または {"texts": [...]} を送ると、コメントとして受け付ける (受付の終了後は error を返す)
+@app.websocket("/ws/live/{session_id}")
+async def live_websocket(websocket: WebSocket, session_id: int):
+    db = SessionLocal()
+    try:
+        try:
+            live = live_hub.get(db, session_id)
+        except (LookupError, ValueError) as e:
+            await websocket.accept()
+            await websocket.send_json({"type": "error", "detail": str(e)})
+            await websocket.close(code=1008)
+            return
+        await websocket.accept()
+        queue = live.subscribe()
+
+        async def receive_comments():
+            while True:
+                try:
+                    data = await websocket.receive_json()
+                except (ValueError, KeyError):
+                    # JSONでないメッセージは無視する
+                    continue
+                if not isinstance(data, dict):
+                    continue
+                try:
+                    # REST (_live_session_or_error) と同じく、受付を終了したセッションにはコメントを追加しない
+                    live_hub.get(db, session_id).ingest(db, data.get("texts") or ([data["text"]] if data.get("text") else []))
+                except (LookupError, ValueError) as e:
+                    # 送信は接続のメッセージと同じキューから行う (送信を1つのタスクにまとめる)
+                    if queue.full():
+                        queue.get_nowait()
+                    queue.put_nowait({"type": "error", "detail": str(e)})
+
+        receiver = asyncio.create_task(receive_comments())
+        try:
+            await websocket.send_json(live.snapshot())
+            while True:
+                next_message = asyncio.create_task(queue.get())
+                done, _ = await asyncio.wait({next_message, receiver}, return_when=asyncio.FIRST_COMPLETED)
+                if receiver in done:
+                    # 切断された (receive_json が WebSocketDisconnect を送出した)
+                    next_message.cancel()
+                    receiver.exception()
+                    break
+                message = next_message.result()
+                await websocket.send_json(message)
+                if message["type"] == "ended":
+                    await websocket.close()
+                    break
+        finally:
+            receiver.cancel()
+            live.unsubscribe(queue)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        db.close()
+
+# パイプラインのステージ処理時間・LLM呼び出しなどのメトリクスを Prometheus 形式で公開する
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.on_event("startup")
 def on_startup():
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    Base.metadata.create_all(bind=engine)
+    upgrade_schema(engine) # 既存DBに追加カラムを反映
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    # ライブセッションのワーカーを止め、LLM APIクライアントの keep-alive 接続を閉じる
+    await live_hub.shutdown()
+    await llm_router.aclose()
\ No newline at end of file
@@ -0,0 +1,220 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import defaultdict
+
+# パイプラインの計測用の軽量なメトリクス集計
+# - プロセス全体のカウンタ/ヒストグラム: /metrics で Prometheus テキスト形式として公開する
+# - セッション単位の内訳: collect_stage_timings() の中で計測した値を AnalysisSession.stage_timings に保存する
+
+# 処理時間ヒストグラムのバケット (秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+_lock = threading.Lock()
+_counters = defaultdict(float)  # (name, labels) -> 値
+_histograms = {}  # (name, labels) -> {"buckets": [...], "sum": float, "count": int}
+_descriptions = {}  # name -> (type, help)
+
+# 現在のパイプライン実行 (アップロード1件) の計測値。contextvars なので非同期タスクごとに独立する
+_current_timings = contextvars.ContextVar("stage_timings", default=None)
+# 現在実行中のステージ名 (DBクエリをステージ別に数えるため)
+_current_stage = contextvars.ContextVar("current_stage", default=None)
+# 現在のHTTPリクエストのDBクエリ数と合計時間
+_current_query_stats = contextvars.ContextVar("query_stats", default=None)
+
+
+def describe(name: str, metric_type: str, help_text: str):
+    _descriptions[name] = (metric_type, help_text)
+
+
+describe("pipeline_stage_seconds", "histogram", "パイプライン各ステージの処理時間 (秒)")
+describe("llm_request_seconds", "histogram", "LLM API 呼び出し1回あたりの処理時間 (秒)")
+describe("llm_requests_total", "counter", "LLM API 呼び出し回数")
+describe("llm_retries_total", "counter", "LLM API 呼び出しのリトライ回数")
+describe("llm_tokens_total", "counter", "LLM API で消費したトークン数")
+describe("llm_hedged_requests_total", "counter", "p95 の応答時間を超えたために送ったヘッジリクエスト数")
+describe("llm_hedge_wins_total", "counter", "ヘッジリクエストの方が先に返った回数")
+describe("llm_hedge_skipped_total", "counter", "ヘッジ先のプロバイダーにすぐ使えるレート制限の枠がないため、ヘッジを送らなかった回数")
+describe("llm_circuit_opened_total", "counter", "サーキットブレーカーが開いた (プロバイダーへの呼び出しを止めた) 回数")
+describe("llm_deadline_skipped_total", "counter", "パイプラインの時間予算切れで次回の実行に回したコメント数")
+describe("llm_cache_hits_total", "counter", "LLM を呼ばずに既存の結果を再利用した件数")
+describe("embedding_requests_total", "counter", "埋め込み計算の呼び出し回数 (埋め込みサーバー / プロセス内のモデル別)")
+describe("embedding_cache_hits_total", "counter", "埋め込みを計算せずに保存済みの埋め込みを再利用したコメント数")
+describe("comments_ingested_total", "counter", "CSVから取り込んだコメント数")
+describe("live_comments_total", "counter", "ライブセッションで受け付けたコメント数")
+describe("live_batch_seconds", "histogram", "ライブセッションの1バッチ (ラベル付け・埋め込み・クラスタ割り当て・保存) の処理時間 (秒)")
+describe("live_update_latency_seconds", "histogram", "ライブセッションでコメントを受け付けてから分析結果を配信するまでの時間 (秒)")
+describe("db_queries_total", "counter", "実行したSQLクエリ数 (ステージ別)")
+describe("db_query_seconds_total", "counter", "SQLクエリの合計実行時間 (秒、ステージ別)")
+describe("db_slow_queries_total", "counter", "閾値を超えた遅いSQLクエリ数")
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class StageTimings:
+    """1回のパイプライン実行におけるステージ別処理時間とカウンタの合計。"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages = defaultdict(float)
+        self.counters = defaultdict(float)
+        self.stage_queries = defaultdict(int)
+        self.stage_query_seconds = defaultdict(float)
+
+    def to_dict(self) -> dict:
+        return {
+            "total_seconds": round(time.perf_counter() - self.started_at, 4),
+            "stages": {stage: round(seconds, 4) for stage, seconds in self.stages.items()},
+            "counters": dict(self.counters),
+            "db_queries": dict(self.stage_queries),
+            "db_query_seconds": {stage: round(seconds, 4) for stage, seconds in self.stage_query_seconds.items()},
+        }
+
+
+class QueryStats:
+    """1回のHTTPリクエストで実行したSQLクエリ数と合計時間。"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+@contextmanager
+def collect_query_stats():
+    stats = QueryStats()
+    token = _current_query_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_query_stats.reset(token)
+
+
+def record_db_query(seconds: float):
+    """SQLクエリ1回分を記録する (app.config のエンジンのイベントフックから呼ばれる)。"""
+    stage = _current_stage.get() or "none"
+    inc("db_queries_total", stage=stage)
+    inc("db_query_seconds_total", seconds, stage=stage)
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.stage_queries[stage] += 1
+        timings.stage_query_seconds[stage] += seconds
+    stats = _current_query_stats.get()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += seconds
+
+
+@contextmanager
+def collect_stage_timings():
+    timings = StageTimings()
+    token = _current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _current_timings.reset(token)
+
+
+def inc(name: str, value: float = 1, **labels):
+    with _lock:
+        _counters[(name, _label_key(labels))] += value
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.counters[name] += value
+
+
+def observe(name: str, value: float, **labels):
+    key = (name, _label_key(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * len(DEFAULT_BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(DEFAULT_BUCKETS):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+@contextmanager
+def span(stage: str):
+    """
+    ステージの処理時間を計測する (同期・非同期どちらの関数の中でも with で使える)。
+    スパンは入れ子にできる (例: db_commit は各ステージの中でも計測される) ため、内訳の合計は total_seconds と一致しない。
+    """
+    start = time.perf_counter()
+    stage_token = _current_stage.set(stage)
+    try:
+        yield
+    finally:
+        _current_stage.reset(stage_token)
+        elapsed = time.perf_counter() - start
+        observe("pipeline_stage_seconds", elapsed, stage=stage)
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.stages[stage] += elapsed
+
+
+def record_llm_usage(usage, purpose: str):
+    # Groq/OpenAI 互換APIの usage (prompt_tokens / completion_tokens) をカウンタに加算する
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+    completion_tokens = getattr(usage, "completion_tokens", None) or 0
+    inc("llm_tokens_total", prompt_tokens, purpose=purpose, kind="prompt")
+    inc("llm_tokens_total", completion_tokens, purpose=purpose, kind="completion")
+
+
+def snapshot() -> dict:
+    """現在のカウンタとヒストグラム (合計・件数) を辞書で返す。ベンチマーク結果の保存用。"""
+    with _lock:
+        result = {}
+        for (name, labels), value in _counters.items():
+            result[name + _format_labels(labels)] = value
+        for (name, labels), histogram in _histograms.items():
+            result[name + "_sum" + _format_labels(labels)] = histogram["sum"]
+            result[name + "_count" + _format_labels(labels)] = histogram["count"]
+        return result
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [
+        f'{k}="' + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for k, v in pairs
+    ]
+    return "{" + ",".join(escaped) + "}"
+
+
+def render_prometheus() -> str:
+    """メトリクスを Prometheus のテキスト形式 (version 0.0.4) に変換する。"""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: {"buckets": list(v["buckets"]), "sum": v["sum"], "count": v["count"]} for k, v in _histograms.items()}
+
+    by_name = defaultdict(list)
+    for (name, labels), value in counters.items():
+        by_name[name].append((labels, value))
+    for (name, labels), histogram in histograms.items():
+        by_name[name].append((labels, histogram))
+
+    lines = []
+    for name in sorted(by_name):
+        metric_type, help_text = _descriptions.get(name, ("untyped", ""))
+        if help_text:
+            lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+            if isinstance(value, dict):
+                for bound, bucket_count in zip(DEFAULT_BUCKETS, value["buckets"]):
+                    lines.append(f"{name}_bucket{_format_labels(labels, (('le', str(bound)),))} {bucket_count}")
+                lines.append(f"{name}_bucket{_format_labels(labels, (('le', '+Inf'),))} {value['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {value['sum']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value['count']}")
+            else:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
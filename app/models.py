@@ -1,9 +1,53 @@
-from sqlalchemy import Column, Integer, String, Boolean, Float, JSON, create_engine, LargeBinary, DateTime
+import json
+import zlib
+
+from sqlalchemy import Column, Integer, String, Boolean, Float, JSON, create_engine, LargeBinary, DateTime, Index, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.sql import func as sa_func # SQLAlchemyのfuncをインポートし、名前が衝突しないように別名をつける
 
 Base = declarative_base()
 
+
+# 圧縮して保存するカラム型 (グラフ画像のBase64文字列や重要度ランキングのJSONなど、大きな値を保存するカラム用)
+# 値は zlib で圧縮したバイト列として保存する。Base64文字列も圧縮によって元のPNGとほぼ同じサイズになる
+class CompressedText(TypeDecorator):
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return zlib.compress(value.encode("utf-8"))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            # 圧縮前の形式で保存された行 (compress_session_blobs で移行する前のデータ)
+            return value
+        return zlib.decompress(value).decode("utf-8")
+
+    def parse_legacy(self, raw: str):
+        return raw
+
+
+class CompressedJSON(CompressedText):
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return super().process_bind_param(json.dumps(value, ensure_ascii=False), dialect)
+
+    def process_result_value(self, value, dialect):
+        value = super().process_result_value(value, dialect)
+        return json.loads(value) if value is not None else None
+
+    def parse_legacy(self, raw: str):
+        return json.loads(raw)
+
+
 class Comment(Base):
     __tablename__ = "comments"
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -15,6 +59,33 @@ class Comment(Base):
     cluster_id = Column(Integer)
     tags = Column(JSON)
     importance_score = Column(Float)
+    # 重複コメント集約用 (dedup.py)
+    # 正規化テキストのハッシュ
+    text_hash = Column(String, index=True)
+    # 近似重複グループの代表コメントID (代表コメント自身は None)
+    duplicate_of = Column(Integer, index=True)
+    # 代表コメントがまとめているコメント数 (自身を含む)
+    duplicate_count = Column(Integer, default=1)
+    # LLMラベル付けの進捗 (llm.py)
+    # "pending" (未処理) / "in_flight" (処理中) / "done" (完了) / "failed" (失敗、次回の実行で再試行)
+    label_state = Column(String, index=True, default="pending")
+    # LLM呼び出しの累計試行回数
+    label_attempts = Column(Integer, default=0)
+    # 最後に失敗したときのエラー内容
+    label_error = Column(String)
+    # ラベルを付けたLLMプロバイダー (providers.py の "groq" / "openai" / "local")。ローカルモデルのラベルは精度が低い
+    label_provider = Column(String)
+    # バッチアップロード (batch.py) で取り込んだコメントの分析セッションID
+    # /upload で取り込んだコメントは None で、これまでどおり全アップロード分をまとめて分析する
+    session_id = Column(Integer, index=True)
+    # コメントを取り込んだ分析セッションID (アーカイブ (archive.py) でセッションごとに書き出す単位)
+    # バッチのコメントは取り込み時に、/upload のコメントはセッション保存時に設定する
+    ingest_session_id = Column(Integer, index=True)
+
+    __table_args__ = (
+        # クラスタ詳細のページ送り (cluster_id で絞り込み、重要度順に並べる) 用
+        Index("ix_comments_cluster_importance", "cluster_id", "importance_score", "id"),
+    )
 
 # ★★★ ここから新しいモデルを追加 ★★★
 class AnalysisSession(Base):
@@ -27,13 +98,13 @@ class AnalysisSession(Base):
     # 関連するコメントの総数
     total_comments = Column(Integer)
     # 全体PN比グラフのBase64文字列
-    total_pn_chart_base64 = Column(String)
+    total_pn_chart_base64 = Column(CompressedText)
     # カテゴリ別PN比グラフのBase64文字列 (JSON形式で辞書として保存)
-    category_pn_charts_base64 = Column(JSON)
+    category_pn_charts_base64 = Column(CompressedJSON)
     # 重要度上位クラスタのデータ (JSON形式でリストとして保存)
-    top_clusters_data = Column(JSON)
+    top_clusters_data = Column(CompressedJSON)
     # AI分析コメント
-    ai_analysis_comment = Column(String)
+    ai_analysis_comment = Column(CompressedText)
     # ポジティブ、ネガティブのパーセンテージを数値で保存 (時系列グラフ用)
     overall_positive_percent = Column(Float)
     overall_negative_percent = Column(Float)
@@ -41,3 +112,189 @@ class AnalysisSession(Base):
     category_sentiment_percents = Column(JSON)
     # その他の概要情報 (例: 危険コメント数など、必要に応じて追加)
     dangerous_comment_count = Column(Integer)
+    # パイプラインのステージ別処理時間とカウンタ (metrics.StageTimings.to_dict() の内容)
+    stage_timings = Column(JSON)
+    # cluster_first パイプラインのラベル付け集計 (LLM呼び出し数、展開件数、例コメントと medoid のラベル一致率)
+    label_agreement = Column(JSON)
+    # パイプラインの実行状態 ("running" / "done" / "failed")。/upload のセッションは完了後に保存されるため None
+    status = Column(String)
+    # バッチアップロードのジョブID (/upload のセッションは None)
+    # バッチのセッションは、そのセッションで取り込んだコメント (Comment.session_id) だけを分析する
+    batch_id = Column(String, index=True)
+    # ライブセッション (live.py、授業中にコメントを受け付けて逐次分析する) の場合は True
+    # ライブセッションは、そのセッションで受け付けたコメント (Comment.session_id) だけを分析する。受付中の status は "live"
+    live = Column(Boolean)
+    # アーカイブ (archive.py) した日時と書き出し先のディレクトリ
+    # アーカイブ済みのセッションのコメントとグラフはParquet/JSONファイルから読み取り専用で参照する (時系列グラフ用の数値はDBに残す)
+    archived_at = Column(DateTime)
+    archive_path = Column(String)
+    # AI分析コメントのプロンプトに使う集計値 (analyze.summary_inputs の戻り値)。パイプラインで計算済みの値を保存し、生成時にコメントを集計し直さない
+    summary_inputs = Column(JSON)
+    # 用語分析 (terms.py) の結果: 全体・クラスタ別・カテゴリ別の TF-IDF 上位語。表示時に計算し直さないよう保存する
+    keywords = Column(CompressedJSON)
+    # このセッションで取り込んだコメントのうち、用語の文書頻度 (TermStat) に加えた文書数 (None は未集計)
+    term_documents = Column(Integer)
+    # 分析したCSVファイルの SHA-256 (fingerprint.py)。同じ内容のファイルがアップロードされた場合はこのセッションを返す
+    file_sha256 = Column(String, index=True)
+    # 近似分析モード (approximate.py) の推定の詳細 (サンプル数、層の数、信頼区間、バックグラウンドでの精緻化の状態)。通常の分析は None
+    approximation = Column(JSON)
+
+
+# 用語ごとの文書頻度 (terms.py)。セッションごとに取り込んだコメントの分だけ加算し、IDF の計算に使う
+class TermStat(Base):
+    __tablename__ = "term_stats"
+    term = Column(String, primary_key=True)
+    # この用語を含むコメント数 (全セッションの累計)
+    document_count = Column(Integer, nullable=False, default=0)
+
+
+# 危険・緊急と判定されたコメントのアラート (alerts.py)。ラベル付けの結果をコミットした時点で作成する
+class Alert(Base):
+    __tablename__ = "alerts"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    comment_id = Column(Integer, nullable=False, index=True)
+    # コメントを取り込んだ分析セッション (Comment.ingest_session_id。/upload のコメントはセッションの作成時に設定する)
+    session_id = Column(Integer, index=True)
+    # アラートの種類 (["danger"], ["urgent"] または両方)
+    kinds = Column(JSON, nullable=False)
+    urgency = Column(Integer)
+    category = Column(String)
+    text = Column(String)
+    created_at = Column(DateTime, server_default=sa_func.now())
+
+
+# AI分析コメントのキャッシュ (analyze.stream_ai_analysis_comment)
+# 集計値とプロンプトのバージョンのダイジェストが同じ場合は、LLMを呼ばずに保存済みのコメントを返す
+class SummaryCache(Base):
+    __tablename__ = "summary_cache"
+    # summary_digest() の SHA-256 (16進数)
+    digest = Column(String(64), primary_key=True)
+    prompt_version = Column(String, nullable=False)
+    summary = Column(CompressedText, nullable=False)
+    # 生成したLLMプロバイダー
+    provider = Column(String)
+    created_at = Column(DateTime, server_default=sa_func.now())
+
+
+# クラスタ単位の集計値 (scoring.py の calculate_cluster_stats で重要度スコア計算後に一括で作成する)
+# ランキング・クラスタ詳細・AI分析コメントはコメントを読み直さずにこのテーブルを参照する
+class ClusterStat(Base):
+    __tablename__ = "cluster_stats"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # 集計を作成した分析セッションID (パイプライン実行中でセッション保存前の行は None)
+    session_id = Column(Integer, index=True)
+    cluster_id = Column(Integer, nullable=False)
+    # クラスタのコメント数
+    size = Column(Integer, nullable=False)
+    # 重要度スコアの平均・最大値 (スコアのないコメントは除く)
+    avg_importance = Column(Float)
+    max_importance = Column(Float)
+    # タグごとの合計値 ({"質問": 3, "緊急性": 7, ...})
+    tag_sums = Column(JSON)
+    # 感情の内訳
+    positive_count = Column(Integer, default=0)
+    negative_count = Column(Integer, default=0)
+    # 重心に最も近いコメントのID (ノイズクラスタ -1 は None)
+    medoid_comment_id = Column(Integer)
+    # 重要度の高い順のコメントID (先頭が代表コメント)
+    top_comment_ids = Column(JSON)
+    # 埋め込みベクトルの重心 (Comment.embedding と同じく pickle した numpy 配列、ノイズクラスタ -1 は None)
+    centroid = Column(LargeBinary)
+
+
+# セッションをまたいで追跡するトピック (topics.py)。各セッションのクラスタの重心を既存トピックの重心と照合し、同じ話題に同じIDを付ける
+class Topic(Base):
+    __tablename__ = "topics"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # 表示用のラベル (これまでで最も大きいクラスタの代表コメント)
+    label = Column(String)
+    # 正規化した埋め込みベクトルの重心 (pickle した float32 の numpy 配列)。照合したクラスタのコメント数で重み付けして更新する
+    centroid = Column(LargeBinary, nullable=False)
+    # これまでに照合したコメント数・セッション数と、ラベルにしたクラスタのコメント数
+    total_comments = Column(Integer, default=0)
+    session_count = Column(Integer, default=0)
+    label_cluster_size = Column(Integer, default=0)
+    first_session_id = Column(Integer)
+    last_session_id = Column(Integer)
+    created_at = Column(DateTime, server_default=sa_func.now())
+
+
+# トピックのセッションごとの集計 (トピックの時系列)。トレンドのAPIはこのテーブルだけを参照する
+class TopicSnapshot(Base):
+    __tablename__ = "topic_snapshots"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    topic_id = Column(Integer, nullable=False, index=True)
+    session_id = Column(Integer, nullable=False, index=True)
+    # 時系列の横軸 (AnalysisSession.created_at の写し)
+    session_created_at = Column(DateTime)
+    # このセッションでトピックに照合したクラスタ (HDBSCAN が1つの話題を複数のクラスタに分けた場合は複数)
+    cluster_ids = Column(JSON)
+    comment_count = Column(Integer, nullable=False)
+    # セッションのコメント数に対する割合 (%)
+    share = Column(Float)
+    positive_count = Column(Integer, default=0)
+    negative_count = Column(Integer, default=0)
+    avg_importance = Column(Float)
+    # トピックの重心とのコサイン類似度 (新しく作ったトピックは 1.0)
+    similarity = Column(Float)
+
+
+def comment_scope(analysis_session) -> int | None:
+    """
+    分析セッションが対象とするコメントの Comment.session_id を返す。
+    バッチとライブのセッションはそのセッションIDのコメント、/upload のセッション (または None) は session_id が None のコメントを対象とする。
+    """
+    if analysis_session is not None and (analysis_session.batch_id is not None or analysis_session.live):
+        return analysis_session.id
+    return None
+
+
+def upgrade_schema(engine):
+    """
+    既存のデータベースに、モデルに追加されたカラムとインデックスを反映する。
+    create_all は既存テーブルを変更しないため、不足しているカラムを ALTER TABLE で追加する。
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+    compress_session_blobs(engine)
+
+
+# SQLite の PRAGMA user_version に記録するスキーマのバージョン (compress_session_blobs の移行が済んだら 1)
+COMPRESSED_BLOBS_SCHEMA_VERSION = 1
+
+
+def compress_session_blobs(engine):
+    """
+    圧縮カラム型 (CompressedText / CompressedJSON) の導入前に文字列で保存された行を圧縮形式に書き換える。
+    SQLite はカラムの宣言型に関わらずバイト列を保存できるため、既存のカラムのまま値だけを置き換える。
+    起動のたびにテーブルを走査しないよう、移行後は PRAGMA user_version に記録して次回からは何もしない。
+    SQLite 以外のデータベースは圧縮カラム型の導入後に作られたものだけを想定し、移行しない
+    (文字列の値が残っていても CompressedText は読み取り時にそのまま返す)。
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    table = AnalysisSession.__table__
+    columns = [c for c in table.columns if isinstance(c.type, CompressedText)]
+    with engine.begin() as conn:
+        if conn.execute(text("PRAGMA user_version")).scalar() >= COMPRESSED_BLOBS_SCHEMA_VERSION:
+            return
+        for column in columns:
+            rows = conn.execute(
+                text(f"SELECT id, {column.name} FROM {table.name} WHERE typeof({column.name}) = 'text'")
+            ).all()
+            for row_id, raw in rows:
+                conn.execute(
+                    table.update().where(table.c.id == row_id).values({column.name: column.type.parse_legacy(raw)})
+                )
+        conn.execute(text(f"PRAGMA user_version = {COMPRESSED_BLOBS_SCHEMA_VERSION}"))
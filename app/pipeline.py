@@ -0,0 +1,331 @@
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager
+from datetime import datetime
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+from app.config import SessionLocal, DEDUP_ENABLED, PIPELINE_MODE, PIPELINE_DEADLINE_SECONDS, UPLOAD_REUSE_ENABLED
+from app.models import Comment, AnalysisSession, ClusterStat, comment_scope
+from app.crud import save_comments_from_csv
+from app.dedup import collapse_duplicates, propagate_duplicate_labels, propagate_duplicate_clusters
+from app.fingerprint import reuse_previous_labels
+from app.llm import label_comments
+from app.providers import Deadline
+from app.cluster import cluster_comments
+from app.cluster_first import label_clusters_by_exemplars
+from app.scoring import calculate_importance_scores, calculate_cluster_stats
+from app.analyze import generate_pn_charts, get_top_clusters_and_comments, count_sentiments, summary_inputs
+from app.approximate import draw_sample, estimate, estimated_counts
+from app.topics import track_topics
+from app.terms import analyze_terms
+from app.alerts import attach_alerts
+from app import metrics
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 同じスコープ (Comment.session_id) のコメントを扱う実行を直列化するロック
+# /upload のパイプラインと近似分析の精緻化は、どちらも共有の None スコープのコメントをラベル付け・集計するため、並行して実行しない
+# (バッチはスレッドごとのイベントループで実行するが、スコープはセッションIDで一意のため、1つのロックを複数のループで使うことはない)
+_scope_locks: dict = {}
+_scope_users: dict = {}  # スコープごとのロックを保持中・待機中の実行の数 (0 になったらロックを破棄する)
+_scope_locks_guard = threading.Lock()
+
+
+@asynccontextmanager
+async def scope_lock(scope: int | None):
+    """スコープのロックを取得する。同じスコープの別の実行が終わるまで待つ。"""
+    with _scope_locks_guard:
+        lock = _scope_locks.setdefault(scope, asyncio.Lock())
+        _scope_users[scope] = _scope_users.get(scope, 0) + 1
+    try:
+        async with lock:
+            yield
+    finally:
+        with _scope_locks_guard:
+            _scope_users[scope] -= 1
+            if not _scope_users[scope]:
+                del _scope_users[scope]
+                del _scope_locks[scope]
+
+
+def scope_contended(scope: int | None) -> bool:
+    """同じスコープの別の実行がロックを待っているかどうか。"""
+    return _scope_users.get(scope, 0) > 1
+
+
+class _YieldingDeadline(Deadline):
+    """同じスコープの別の実行がロックを待っている間は期限切れとして扱う (精緻化のラベル付けを中断してロックを譲るため)。"""
+
+    def __init__(self, scope: int | None):
+        super().__init__(None)
+        self.scope = scope
+
+    def expired(self) -> bool:
+        return scope_contended(self.scope) or super().expired()
+
+
+async def collect_session_results(db: Session, scope: int | None, approximation: dict | None = None) -> dict:
+    """
+    PN比グラフ・重要度ランキング・感情の集計値を作成し、AnalysisSession に保存する値の辞書を返す。
+    approximation (近似分析モードの推定) を渡した場合は、PN比・カテゴリ別PN比とAI分析コメント用の集計値に推定値を使う。
+    """
+    # PN比グラフデータを取得
+    with metrics.span("charting"):
+        pn_charts_data_raw = generate_pn_charts(db, scope)
+
+    # 重要度ランキングデータを取得
+    with metrics.span("ranking"):
+        top_clusters_ranking_raw = await get_top_clusters_and_comments(db, session_id=scope)
+
+    with metrics.span("summary_stats"):
+        # 全体とカテゴリ別の感情の件数を1回のクエリで取得する
+        overall_counts, category_counts = count_sentiments(db, scope)
+        if approximation is not None:
+            # 近似分析ではラベル付けしたのはサンプルだけのため、推定した割合を件数に換算して使う
+            overall_counts, category_counts = estimated_counts(approximation)
+        total_comments_count = overall_counts["total"]
+
+        # 全体PN比のパーセンテージを計算 (時系列グラフ用)
+        total_pos = overall_counts["positive"]
+        total_neg = overall_counts["negative"]
+        overall_pos_percent = (total_pos / total_comments_count * 100) if total_comments_count > 0 else 0.0
+        overall_neg_percent = (total_neg / total_comments_count * 100) if total_comments_count > 0 else 0.0
+
+        # カテゴリ別PN比のパーセンテージを計算 (時系列グラフ用)
+        category_sentiment_percents = {}
+        for category, counts in category_counts.items():
+            cat_pos_percent = (counts["positive"] / counts["total"] * 100) if counts["total"] > 0 else 0.0
+            category_sentiment_percents[category] = cat_pos_percent # カテゴリ別のポジティブ比率のみを保存
+        if approximation is not None:
+            # 件数への換算による丸めを避け、推定値をそのまま保存する
+            overall_pos_percent = (approximation["overall"]["positive"] or {}).get("estimate", 0.0)
+            overall_neg_percent = (approximation["overall"]["negative"] or {}).get("estimate", 0.0)
+            category_sentiment_percents = {
+                category: intervals["positive"]["estimate"] for category, intervals in approximation["categories"].items() if intervals["positive"]
+            }
+
+        # 危険コメント数を取得 (近似分析ではサンプル中に見つかった件数)
+        dangerous_comment_count = db.query(Comment).filter(Comment.danger == True, Comment.session_id == scope).count()
+
+    return dict(
+        total_comments=total_comments_count,
+        total_pn_chart_base64=pn_charts_data_raw["total_pn_chart"],
+        category_pn_charts_base64=pn_charts_data_raw["category_pn_charts"],
+        top_clusters_data=top_clusters_ranking_raw,
+        overall_positive_percent=overall_pos_percent,
+        overall_negative_percent=overall_neg_percent,
+        category_sentiment_percents=category_sentiment_percents,
+        dangerous_comment_count=dangerous_comment_count,
+        # AI分析コメントの生成時に集計し直さないよう、プロンプトに使う集計値を保存する
+        summary_inputs=summary_inputs(overall_counts, category_counts, top_clusters_ranking_raw)
+    )
+
+def _attach_cluster_stats(db: Session, analysis_session: AnalysisSession):
+    # /upload のパイプラインで作成したクラスタ別集計 (session_id が None) をセッションに紐付ける (古い集計は置き換える)
+    db.query(ClusterStat).filter(ClusterStat.session_id == analysis_session.id).delete(synchronize_session=False)
+    db.query(ClusterStat).filter(ClusterStat.session_id == None).update(
+        {ClusterStat.session_id: analysis_session.id}, synchronize_session=False
+    )
+
+async def run_analysis_pipeline(db: Session, df, csv_filename: str, analysis_session: AnalysisSession | None = None,
+                                file_sha256: str | None = None, approximate: bool = False) -> AnalysisSession:
+    """
+    読み込み済みのCSV (DataFrame) に対して分析パイプライン全体を実行し、作成した AnalysisSession を返す。
+    取り込み → 重複集約 → LLMラベル付け → クラスタリング → 重要度スコア → グラフ・ランキング → セッション保存
+    PIPELINE_MODE が "cluster_first" の場合は、クラスタリングを先に行い、クラスタの例コメントだけをLLMでラベル付けする。
+    各ステージの処理時間は metrics に記録され、AnalysisSession.stage_timings にも保存される。
+    AI分析コメントはここでは生成しない (/api/ai_analysis_comment/stream で生成する)。
+
+    analysis_session を渡した場合 (バッチアップロード) は、そのセッションで取り込んだコメントだけを分析し、結果をそのセッションに保存する。
+    渡さない場合 (/upload) は、これまでどおり /upload で取り込んだ全コメントを分析し、新しいセッションを作成する。
+    file_sha256 (CSVファイルの SHA-256) はセッションに保存し、同じ内容のファイルが再びアップロードされた場合の照合に使う。
+    approximate=True (近似分析モード) の場合は、クラスタリングの後にクラスタ別の層化抽出でサンプルだけをLLMでラベル付けし、
+    PN比とカテゴリ別PN比をサンプルから推定する (信頼区間は AnalysisSession.approximation に保存する)。
+    残りのコメントは refine_approximate_session でラベル付けし、正確な値に置き換えられる。
+    同じスコープの実行 (/upload のパイプラインと近似分析の精緻化) は scope_lock で直列化する。
+    """
+    async with scope_lock(comment_scope(analysis_session)):
+        return await _run_analysis_pipeline(db, df, csv_filename, analysis_session, file_sha256, approximate)
+
+
+async def _run_analysis_pipeline(db: Session, df, csv_filename: str, analysis_session: AnalysisSession | None,
+                                 file_sha256: str | None, approximate: bool) -> AnalysisSession:
+    # run_analysis_pipeline の本体 (スコープのロックを取得した状態で呼ぶ)
+    scope = comment_scope(analysis_session)
+    # LLMラベル付けに使える時間の予算 (超えた分のコメントは未ラベルのまま残し、次回の実行で処理する)
+    deadline = Deadline(PIPELINE_DEADLINE_SECONDS)
+    with metrics.collect_stage_timings() as stage_timings:
+        with metrics.span("ingest"):
+            saved_count = save_comments_from_csv(db, df, scope)
+        logger.info(f"{saved_count} 件のコメントを取り込みました。")
+
+        if UPLOAD_REUSE_ENABLED:
+            # 本文が既存のラベル付け済みコメントと一致する行はラベルと埋め込みを再利用し、差分だけをLLM・埋め込みに回す
+            with metrics.span("reuse"):
+                reuse_previous_labels(db, scope)
+
+        if DEDUP_ENABLED:
+            # 完全一致・近似重複のコメントをまとめ、代表コメントだけをLLMとクラスタリングに回す
+            with metrics.span("dedup"):
+                collapse_duplicates(db, scope)
+
+        label_agreement = None
+        approximation = None
+        if approximate:
+            logger.info("近似分析モード: コメントのクラスタリングを開始します。")
+            await cluster_comments(db, labeled_only=False, session_id=scope)
+            if DEDUP_ENABLED:
+                propagate_duplicate_clusters(db, scope)
+
+            with metrics.span("labeling"):
+                sample = draw_sample(db, scope)
+                await label_comments(db, scope, deadline, comment_ids=sample["sample_ids"])
+                if DEDUP_ENABLED:
+                    propagate_duplicate_labels(db, scope)
+                approximation = estimate(db, sample)
+            logger.info(f"近似分析モード: サンプル {approximation['labeled_comments']} 件のラベルからPN比を推定しました。")
+        elif PIPELINE_MODE == "cluster_first":
+            logger.info("コメントのクラスタリングを開始します。")
+            await cluster_comments(db, labeled_only=False, session_id=scope)
+            if DEDUP_ENABLED:
+                propagate_duplicate_clusters(db, scope)
+            logger.info("コメントのクラスタリングが完了しました。")
+
+            logger.info("クラスタ単位のLLMラベル付けを開始します。")
+            with metrics.span("labeling"):
+                label_agreement = await label_clusters_by_exemplars(db, scope, deadline)
+                if DEDUP_ENABLED:
+                    propagate_duplicate_labels(db, scope)
+            logger.info("LLMによるラベル付けが完了しました。")
+        else:
+            logger.info("LLMによるラベル付けを開始します。")
+            with metrics.span("labeling"):
+                await label_comments(db, scope, deadline)
+                if DEDUP_ENABLED:
+                    propagate_duplicate_labels(db, scope)
+            logger.info("LLMによるラベル付けが完了しました。")
+
+            logger.info("コメントのクラスタリングを開始します。")
+            # cluster_comments の中で embedding / clustering のスパンを計測する
+            await cluster_comments(db, session_id=scope)
+            if DEDUP_ENABLED:
+                propagate_duplicate_clusters(db, scope)
+            logger.info("コメントのクラスタリングが完了しました。")
+
+        with metrics.span("scoring"):
+            await calculate_importance_scores(db, scope)
+            # ランキング・クラスタ詳細・AI分析コメントが参照するクラスタ別集計を作成する
+            calculate_cluster_stats(db, scope)
+        logger.info("重要度スコアの計算が完了しました。")
+
+        # --- 分析結果を取得し、AnalysisSession に保存するロジック ---
+        logger.info("分析結果の最終取得と保存を開始します。")
+        results = await collect_session_results(db, scope, approximation)
+        # AI分析コメントはブラウザが /api/ai_analysis_comment/stream に接続して生成・保存する
+        results.update(ai_analysis_comment=None, stage_timings=stage_timings.to_dict(), label_agreement=label_agreement, approximation=approximation)
+        if file_sha256 is not None:
+            results["file_sha256"] = file_sha256
+        if analysis_session is None:
+            analysis_session = AnalysisSession(csv_filename=csv_filename, **results)
+            db.add(analysis_session)
+            db.flush()
+            _attach_cluster_stats(db, analysis_session)
+            # このパイプラインで取り込んだコメント (取り込み元のセッションが未設定のもの) をセッションに紐付ける
+            db.query(Comment).filter(Comment.session_id == None, Comment.ingest_session_id == None).update(
+                {Comment.ingest_session_id: analysis_session.id}, synchronize_session=False
+            )
+            # ラベル付けの途中で送ったアラート (セッションの作成前のため未設定) もセッションに紐付ける
+            attach_alerts(db, analysis_session.id)
+        else:
+            for key, value in results.items():
+                setattr(analysis_session, key, value)
+            analysis_session.status = "done"
+        with metrics.span("db_commit"):
+            db.commit()
+    logger.info(f"分析セッションID {analysis_session.id} をデータベースに保存しました。処理時間: {analysis_session.stage_timings['total_seconds']} 秒")
+
+    # クラスタを講義をまたいだトピックに照合する (失敗しても分析結果は保存済みのため、ログに残して続ける)
+    try:
+        with metrics.span("topics"):
+            track_topics(db, analysis_session)
+    except Exception as e:
+        logger.error(f"分析セッションID {analysis_session.id} のトピック照合中にエラーが発生しました: {e}", exc_info=True)
+
+    # 全体・クラスタ別・カテゴリ別のキーワードを計算して保存する (表示時に計算し直さないため)
+    try:
+        with metrics.span("terms"):
+            analyze_terms(db, analysis_session)
+    except Exception as e:
+        logger.error(f"分析セッションID {analysis_session.id} の用語分析中にエラーが発生しました: {e}", exc_info=True)
+    return analysis_session
+
+
+def _newer_session_exists(db: Session, analysis_session: AnalysisSession) -> bool:
+    # /upload のセッションは共有の None スコープの累積コメントを集計するため、後から作成されたセッションがあれば、その集計が新しい
+    if comment_scope(analysis_session) is not None:
+        return False
+    return db.query(AnalysisSession.id).filter(
+        AnalysisSession.id > analysis_session.id, AnalysisSession.batch_id == None,
+        or_(AnalysisSession.live == None, AnalysisSession.live == False)
+    ).first() is not None
+
+
+async def refine_approximate_session(session_id: int):
+    """
+    近似分析モードのセッションの残りのコメントをLLMでラベル付けし、重要度スコア・クラスタ別集計・グラフ・ランキングを作り直して、
+    推定値を全件の集計値に置き換える。/upload のレスポンスを返した後にバックグラウンドで実行する (DBセッションはここで開く)。
+    推定の詳細 (AnalysisSession.approximation) は比較用に残し、refined を True にする。
+    同じスコープの実行とは scope_lock で直列化する。/upload の別の実行がロックを待っている場合は、ラベル付けを中断して譲り、
+    共有の None スコープに新しいセッションが作成された場合は、そのセッションのコメントを古いセッションに集計しないよう精緻化をやめる
+    (ラベル付けできなかったコメントは "pending" のまま残り、新しいセッションの実行で処理される)。
+    """
+    db = SessionLocal()
+    try:
+        analysis_session = db.get(AnalysisSession, session_id)
+        if analysis_session is None or not analysis_session.approximation:
+            return
+        scope = comment_scope(analysis_session)
+        async with scope_lock(scope):
+            if _newer_session_exists(db, analysis_session):
+                logger.info(f"近似分析の分析セッションID {session_id} より新しいセッションがあるため、精緻化を行いません。")
+                return
+            logger.info(f"近似分析の分析セッションID {session_id} の残りのコメントのラベル付けを開始します。")
+            with metrics.collect_stage_timings() as stage_timings:
+                with metrics.span("labeling"):
+                    await label_comments(db, scope, _YieldingDeadline(scope))
+                    if DEDUP_ENABLED:
+                        propagate_duplicate_labels(db, scope)
+                if scope_contended(scope):
+                    logger.info(f"同じスコープの別の実行が待っているため、近似分析の分析セッションID {session_id} の精緻化を中断します。")
+                    return
+                with metrics.span("scoring"):
+                    await calculate_importance_scores(db, scope)
+                    calculate_cluster_stats(db, scope)
+                results = await collect_session_results(db, scope)
+                if scope is None:
+                    _attach_cluster_stats(db, analysis_session)
+                for key, value in results.items():
+                    setattr(analysis_session, key, value)
+                # 集計値が変わったため、AI分析コメントは次回の表示時に生成し直す
+                analysis_session.ai_analysis_comment = None
+                analysis_session.approximation = {
+                    **analysis_session.approximation, "refined": True, "refined_at": datetime.now().isoformat(),
+                    "refine_seconds": stage_timings.to_dict()["total_seconds"],
+                }
+                with metrics.span("db_commit"):
+                    db.commit()
+            logger.info(f"近似分析の分析セッションID {session_id} を全件のラベルで更新しました。")
+
+            # カテゴリ別のキーワードはラベルに依存するため作り直す
+            try:
+                analyze_terms(db, analysis_session)
+            except Exception as e:
+                logger.error(f"分析セッションID {session_id} の用語分析中にエラーが発生しました: {e}", exc_info=True)
+    except Exception as e:
+        db.rollback()
+        logger.error(f"近似分析の分析セッションID {session_id} の精緻化中にエラーが発生しました: {e}", exc_info=True)
+    finally:
+        db.close()
@@ -0,0 +1,56 @@
+"""
+LLMラベル付けの優先度 (ローカルの簡易な事前スコア)。
+
+label_comments は主キー順にコメントをラベル付けするため、CSVの末尾にある暴言や「音が聞こえない」などの障害報告は、
+それまでの全件のラベル付けが終わるまで危険・緊急と判定されない。
+ここではLLMを呼ばずに、危険・緊急を示す語を含むコメントに事前スコアを付け、スコアの高いコメントから先にラベル付けする。
+スコアは並び順にだけ使い、ラベル (危険性・緊急性) はLLMの判定結果をそのまま使う。
+"""
+import re
+import unicodedata
+
+import numpy as np
+
+from app.config import PRIORITY_EXTRA_KEYWORDS
+
+# 危険性 (攻撃的な表現・ハラスメント) を示す語と重み
+DANGER_KEYWORDS = {
+    "死ね": 3.0, "殺す": 3.0, "殺し": 3.0, "消えろ": 3.0, "ハラスメント": 3.0, "セクハラ": 3.0, "パワハラ": 3.0, "アカハラ": 3.0,
+    "きもい": 2.0, "キモい": 2.0, "うざい": 2.0, "ウザい": 2.0, "バカ": 2.0, "馬鹿": 2.0, "アホ": 2.0, "クソ": 2.0, "くそ": 1.5,
+    "無能": 2.0, "ふざけるな": 2.0, "最悪": 1.0, "暴言": 2.0, "差別": 2.0, "脅": 2.0,
+    "ゴミ": 2.0, "資格がない": 2.0, "二度と": 1.5, "返金": 1.5, "無意味": 1.5, "無駄": 1.0, "ひどい": 1.0, "するな": 1.5, "しろ。": 1.0,
+}
+# 緊急性 (授業中に対処が必要な障害・トラブル) を示す語と重み
+URGENT_KEYWORDS = {
+    "聞こえない": 3.0, "聞こえません": 3.0, "音が出": 2.0, "音声が": 1.5, "映らない": 3.0, "映っていない": 3.0, "見えない": 2.0, "見えません": 2.0,
+    "止まっ": 2.0, "固まっ": 2.0, "落ちた": 2.0, "落ちて": 2.0, "落ちる": 2.0, "切れた": 2.0, "途切れ": 2.0, "繋がらない": 3.0, "つながらない": 3.0,
+    "入れない": 3.0, "入れません": 3.0, "ログインでき": 3.0, "エラー": 1.5, "画面共有": 1.5, "ハウリング": 2.0, "ミュート": 1.5,
+    "至急": 3.0, "緊急": 3.0, "早急": 2.0, "急ぎ": 2.0, "今すぐ": 2.0, "助けて": 2.0,
+    "切断": 2.0, "フリーズ": 2.0, "強制終了": 2.0, "動作せず": 2.0, "開けません": 2.0, "失敗します": 1.5, "認識されず": 2.0, "聞き取れ": 1.5,
+    "聞き取りづらい": 1.5, "不安定": 1.0, "カクつ": 1.0, "遅延": 1.0, "消えました": 1.5, "破損": 1.5, "リンクが間違": 1.5,
+}
+
+
+def _keyword_pattern(weights: dict):
+    # 長い語から順に照合し、正規化 (NFKC) 後の表記で一致させる
+    words = sorted({unicodedata.normalize("NFKC", word) for word in weights}, key=len, reverse=True)
+    return re.compile("|".join(re.escape(word) for word in words))
+
+
+_KEYWORD_WEIGHTS = {unicodedata.normalize("NFKC", word): weight for word, weight in {**DANGER_KEYWORDS, **URGENT_KEYWORDS}.items()}
+_KEYWORD_WEIGHTS.update({unicodedata.normalize("NFKC", word): 2.0 for word in PRIORITY_EXTRA_KEYWORDS})
+_KEYWORD_PATTERN = _keyword_pattern(_KEYWORD_WEIGHTS)
+
+
+def prescore(text: str) -> float:
+    """コメント1件の事前スコア (含まれる危険・緊急の語の重みの合計、同じ語は1回だけ数える)。0 は優先しない。"""
+    matches = set(_KEYWORD_PATTERN.findall(unicodedata.normalize("NFKC", text or "")))
+    score = sum(_KEYWORD_WEIGHTS[word] for word in matches)
+    # 「！」や「?」の連続は切迫した報告に多い
+    if score and re.search(r"[!?！？]{2,}", text or ""):
+        score += 0.5
+    return score
+
+
+def prescore_texts(texts: list) -> np.ndarray:
+    return np.array([prescore(text) for text in texts], dtype=np.float32)
@@ -0,0 +1,562 @@
+"""
+LLMプロバイダーの切り替え (ラベル付けとAI分析コメントの生成で共通)。
+
+LLM_PROVIDERS に指定した順 (例: "groq,local") でプロバイダーを使い分ける。
+- groq: Groq API (従来どおり)
+- openai: 任意の OpenAI 互換エンドポイント (OPENAI_COMPAT_*)
+- local: ローカルのCPUモデル (llama.cpp の llama-server など、OpenAI 互換APIを持つサーバー。LOCAL_LLM_*)
+
+プロバイダーごとに応答時間とエラー率の指数移動平均を記録し、エラー率または応答時間が閾値を超えたプロバイダーは
+後回しにする (LLM_ROUTER_*)。呼び出しが失敗した場合は、待たずに次のプロバイダーで再試行できる。
+これにより、Groq が遅い・停止している間も、ローカルモデルで (精度は下がるが) ラベル付けを続けられる。
+
+呼び出しの信頼性:
+- 1回の呼び出しは LLM_TIMEOUT 秒で打ち切る (SDKの自動リトライは使わず、再試行は呼び出し側がエラーの種類に応じて行う)
+- プロバイダーの応答時間の p95 を超えても終わらない呼び出しには、同じリクエストをもう1つ送り (ヘッジ)、先に返った方を使う
+  (時間はレート制限の待ちを終えて送信した時点から数え、ヘッジ先にすぐ使えるレート制限の枠がない場合は送らない)
+- 連続で失敗したプロバイダーはサーキットブレーカーで一定時間呼び出しを止め、障害中のAPIにリクエストを送り続けないようにする
+- APIクライアント (httpx の接続プール) はプロバイダーとイベントループごとに1つ作って使い回し、keep-alive で接続を再利用する
+"""
+import logging
+import random
+import threading
+import time
+import asyncio
+from collections import deque
+
+import httpx
+from groq import AsyncGroq
+from openai import AsyncOpenAI
+
+from app.config import (
+    LLM_PROVIDERS, GROQ_API_KEY, GROQ_MODEL_NAME, GROQ_BASE_URL, LLM_REQUESTS_PER_MINUTE,
+    OPENAI_COMPAT_BASE_URL, OPENAI_COMPAT_API_KEY, OPENAI_COMPAT_MODEL, OPENAI_COMPAT_REQUESTS_PER_MINUTE,
+    LOCAL_LLM_BASE_URL, LOCAL_LLM_MODEL,
+    LLM_ROUTER_MAX_ERROR_RATE, LLM_ROUTER_MAX_LATENCY, LLM_ROUTER_PROBE_INTERVAL,
+    LLM_TIMEOUT, LLM_MAX_CONNECTIONS, LLM_KEEPALIVE_EXPIRY, LLM_ERROR_RETRY_WAIT, LLM_HEDGE_ENABLED, LLM_HEDGE_MIN_SAMPLES,
+    LLM_BREAKER_FAILURE_THRESHOLD, LLM_BREAKER_COOLDOWN,
+)
+from app import metrics
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 応答時間・エラー率の指数移動平均の重み (直近の呼び出しの影響の大きさ)
+EWMA_ALPHA = 0.2
+# ヘッジの判断に使う応答時間の件数 (直近の成功した呼び出し)
+LATENCY_WINDOW = 200
+# サーキットブレーカーの試験の呼び出しの結果を待つ間、呼び出せるようになったかを確かめる間隔 (秒)
+PROBE_POLL_INTERVAL = 1.0
+
+
+class RateLimiter:
+    """
+    プロセス内のすべてのスレッド・イベントループで共有するLLM呼び出しのレート制限。
+    呼び出しごとに次の送信時刻を予約し、その時刻まで非同期に待つ (バッチアップロードの並列ワーカー間でAPIの上限を分け合う)。
+    """
+
+    def __init__(self, requests_per_minute: float):
+        self.interval = 60 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    async def acquire(self):
+        if self.interval <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            try:
+                await asyncio.sleep(slot - now)
+            except asyncio.CancelledError:
+                # 送信前に取り消された場合は予約を返す
+                self.release(slot)
+                raise
+
+    def try_acquire(self) -> bool:
+        """待たずに使える枠がある場合だけ予約して True を返す (ヘッジリクエスト用)。"""
+        if self.interval <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if self._next_slot > now:
+                return False
+            self._next_slot = now + self.interval
+            return True
+
+    def release(self, slot: float):
+        """
+        使わなかった予約を返す。後に別の予約がある場合は、その予約の待ち時間を変えないよう返さない
+        (後の呼び出しはすでにその時刻まで待っているため)。
+        """
+        with self._lock:
+            if self._next_slot == slot + self.interval:
+                self._next_slot = slot
+
+
+class Deadline:
+    """パイプライン1回分の時間予算。seconds が None または 0 以下の場合は無制限。"""
+
+    def __init__(self, seconds: float | None = None):
+        self.expires_at = time.monotonic() + seconds if seconds and seconds > 0 else None
+
+    def remaining(self) -> float:
+        if self.expires_at is None:
+            return float("inf")
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, limit: float = LLM_TIMEOUT) -> float:
+        """1回の呼び出しのタイムアウト (LLM_TIMEOUT と残り時間の短い方)。"""
+        return min(limit, self.remaining())
+
+
+class LLMCallError(Exception):
+    """
+    プロバイダー呼び出しの失敗。kind はエラーの種類で、再試行するか・どれだけ待つかを決めるのに使う。
+    "timeout" / "rate_limit" / "server" / "connection" は再試行する。"client" (429 以外の 4xx) は再試行しない。
+    "circuit_open" はサーキットブレーカーが呼び出しを通さなかった場合 (APIは呼んでいない)。
+    """
+
+    def __init__(self, provider, kind: str, original: Exception, retry_after: float | None = None):
+        super().__init__(f"{provider.name}: {kind}: {type(original).__name__}: {original}")
+        self.provider = provider
+        self.kind = kind
+        self.original = original
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.kind != "client"
+
+    def backoff(self, attempt: int) -> float:
+        """同じプロバイダーで再試行する前に待つ秒数。"""
+        if self.kind in ("timeout", "circuit_open"):
+            return 0.0
+        if self.kind == "rate_limit":
+            return self.retry_after if self.retry_after is not None else LLM_ERROR_RETRY_WAIT
+        # 接続エラー・サーバーエラーは指数的に延ばし、並列ワーカーの再試行が重ならないようにばらつきを加える
+        return min(LLM_ERROR_RETRY_WAIT, LLM_ERROR_RETRY_WAIT / 4 * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def classify_error(provider, error: Exception) -> LLMCallError:
+    # Groq と OpenAI のSDKは例外クラスが別々なので、HTTPステータスとクラス名で判別する
+    if isinstance(error, LLMCallError):
+        return error
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)) or "Timeout" in type(error).__name__:
+        return LLMCallError(provider, "timeout", error)
+    status = getattr(error, "status_code", None)
+    if status == 429:
+        retry_after = None
+        response = getattr(error, "response", None)
+        try:
+            retry_after = float(response.headers.get("retry-after")) if response is not None else None
+        except (TypeError, ValueError):
+            pass
+        return LLMCallError(provider, "rate_limit", error, retry_after)
+    if status is not None and (status >= 500 or status in (408, 409)):
+        return LLMCallError(provider, "server", error)
+    if status is not None and 400 <= status < 500:
+        return LLMCallError(provider, "client", error)
+    return LLMCallError(provider, "connection", error)
+
+
+class CircuitBreaker:
+    """
+    連続で LLM_BREAKER_FAILURE_THRESHOLD 回失敗すると "open" になり、LLM_BREAKER_COOLDOWN 秒間そのプロバイダーを使わない。
+    時間が過ぎると "half_open" になり、試験の呼び出しを1つだけ通す。成功すれば "closed"、失敗すればすぐに "open" に戻る。
+    試験の呼び出しの結果が出るまで、他の呼び出しは通さない (probe_timeout 秒たっても結果が出ない場合は次の呼び出しを試験にする)。
+    """
+
+    def __init__(self, failure_threshold: int = LLM_BREAKER_FAILURE_THRESHOLD, cooldown: float = LLM_BREAKER_COOLDOWN,
+                 probe_timeout: float = LLM_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+        self._lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.open_until = None
+        self.opened_count = 0
+        self._probe_started = None  # "half_open" で通した試験の呼び出しの開始時刻
+
+    def _probing(self, now: float) -> bool:
+        return self._probe_started is not None and now - self._probe_started < self.probe_timeout
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self.open_until is None:
+                return "closed"
+            return "open" if time.monotonic() < self.open_until else "half_open"
+
+    def available(self) -> bool:
+        """呼び出せる状態かどうか ("closed"、または試験の呼び出しを通していない "half_open")。"""
+        with self._lock:
+            now = time.monotonic()
+            return self.open_until is None or (now >= self.open_until and not self._probing(now))
+
+    def admit(self) -> str | None:
+        """
+        呼び出しを始める前に呼ぶ。"closed" なら "closed" を、"half_open" で試験の呼び出しとして通す場合は "probe" を返し、
+        呼び出せない場合 ("open"、または試験の呼び出しの結果待ち) は None を返す。
+        """
+        with self._lock:
+            if self.open_until is None:
+                return "closed"
+            now = time.monotonic()
+            if now < self.open_until or self._probing(now):
+                return None
+            self._probe_started = now
+            return "probe"
+
+    def release_probe(self):
+        """試験の呼び出しが結果を出さずに取り消された場合に、次の呼び出しを試験として通せるようにする。"""
+        with self._lock:
+            self._probe_started = None
+
+    def retry_in(self) -> float:
+        with self._lock:
+            if self.open_until is None:
+                return 0.0
+            now = time.monotonic()
+            if self._probing(now):
+                # 試験の呼び出しの結果を待つ (結果が出たかどうかを短い間隔で確かめる)
+                return min(PROBE_POLL_INTERVAL, self._probe_started + self.probe_timeout - now)
+            return max(self.open_until - now, 0.0)
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.open_until = None
+            self._probe_started = None
+
+    def record_failure(self) -> bool:
+        """失敗を記録し、このときに "open" になった場合は True を返す。"""
+        with self._lock:
+            self.consecutive_failures += 1
+            self._probe_started = None
+            half_open = self.open_until is not None and time.monotonic() >= self.open_until
+            if half_open or (self.open_until is None and self.consecutive_failures >= self.failure_threshold):
+                self.open_until = time.monotonic() + self.cooldown
+                self.opened_count += 1
+                return True
+            return False
+
+
+class ProviderStats:
+    """プロバイダーの応答時間とエラー率 (指数移動平均)、直近の応答時間、呼び出し回数。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = None  # 成功した呼び出しの応答時間 (秒)
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.last_error = None
+        self.last_request_at = None
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def record_success(self, seconds: float):
+        with self._lock:
+            self.requests += 1
+            self.last_request_at = time.monotonic()
+            self._latencies.append(seconds)
+            self.latency = seconds if self.latency is None else (1 - EWMA_ALPHA) * self.latency + EWMA_ALPHA * seconds
+            self.error_rate = (1 - EWMA_ALPHA) * self.error_rate
+
+    def record_error(self, error: str):
+        with self._lock:
+            self.requests += 1
+            self.errors += 1
+            self.last_error = error
+            self.last_request_at = time.monotonic()
+            self.error_rate = (1 - EWMA_ALPHA) * self.error_rate + EWMA_ALPHA
+
+    def percentile(self, q: float) -> float | None:
+        """直近の成功した呼び出しの応答時間のパーセンタイル (件数が LLM_HEDGE_MIN_SAMPLES 未満の場合は None)。"""
+        with self._lock:
+            if len(self._latencies) < LLM_HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def is_healthy(self) -> bool:
+        with self._lock:
+            if self.error_rate <= LLM_ROUTER_MAX_ERROR_RATE and (self.latency is None or self.latency <= LLM_ROUTER_MAX_LATENCY):
+                return True
+            # しばらく呼んでいないプロバイダーは、回復しているか確かめるために1回だけ使う
+            return self.last_request_at is None or time.monotonic() - self.last_request_at >= LLM_ROUTER_PROBE_INTERVAL
+
+    def to_dict(self) -> dict:
+        p95 = self.percentile(0.95)
+        with self._lock:
+            return {
+                "latency_seconds": round(self.latency, 3) if self.latency is not None else None,
+                "p95_latency_seconds": round(p95, 3) if p95 is not None else None,
+                "error_rate": round(self.error_rate, 3),
+                "requests": self.requests,
+                "errors": self.errors,
+                "last_error": self.last_error,
+            }
+
+
+class LLMProvider:
+    """チャット補完APIのプロバイダー。astream はレスポンスのテキスト断片を順に返す。"""
+
+    # ローカルモデル (精度が低い代替) かどうか
+    local = False
+
+    def __init__(self, name: str, model: str, requests_per_minute: float = 0):
+        self.name = name
+        self.model = model
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self.stats = ProviderStats()
+        self.breaker = CircuitBreaker()
+        # イベントループごとのAPIクライアント (httpx の接続はイベントループをまたいで使えないため、
+        # uvicorn のループとバッチのワーカースレッドのループでそれぞれ接続プールを持つ)
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+
+    def _create_client(self, http_client: httpx.AsyncClient):
+        raise NotImplementedError
+
+    @property
+    def async_client(self):
+        loop = asyncio.get_running_loop()
+        with self._clients_lock:
+            client = self._clients.get(loop)
+            if client is None:
+                # 閉じられたループ (aclose を呼ばずに終わったワーカー) のクライアントは参照を外す
+                for closed_loop in [l for l in self._clients if l.is_closed()]:
+                    del self._clients[closed_loop]
+                http_client = httpx.AsyncClient(
+                    timeout=LLM_TIMEOUT,
+                    limits=httpx.Limits(
+                        max_connections=LLM_MAX_CONNECTIONS,
+                        max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+                    ),
+                )
+                client = self._create_client(http_client)
+                self._clients[loop] = client
+            return client
+
+    async def aclose(self):
+        """現在のイベントループのAPIクライアントの接続プールを閉じる。"""
+        with self._clients_lock:
+            client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
+
+    def _request_args(self, messages: list, temperature: float, max_tokens: int, json_mode: bool) -> dict:
+        args = dict(model=self.model, messages=messages, temperature=temperature, max_tokens=max_tokens, stream=True)
+        if json_mode:
+            args["response_format"] = {"type": "json_object"}
+        return args
+
+    def _usage(self, chunk):
+        return getattr(chunk, "usage", None)
+
+    async def astream(self, messages: list, temperature: float, max_tokens: int, json_mode: bool = False, purpose: str = "summary"):
+        completion = await self.async_client.chat.completions.create(**self._request_args(messages, temperature, max_tokens, json_mode))
+        async for chunk in completion:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            metrics.record_llm_usage(self._usage(chunk), purpose)
+
+    async def acomplete(self, messages: list, temperature: float, max_tokens: int, json_mode: bool = False, purpose: str = "label") -> str:
+        """ストリーミングで受け取ったレスポンス全体を返す。"""
+        pieces = []
+        async for piece in self.astream(messages, temperature, max_tokens, json_mode, purpose):
+            pieces.append(piece)
+        return "".join(pieces)
+
+    def record_success(self, seconds: float):
+        self.stats.record_success(seconds)
+        self.breaker.record_success()
+
+    def record_failure(self, error: LLMCallError):
+        self.stats.record_error(str(error))
+        # 再試行しても結果が変わらない 4xx はAPIの障害ではないため、ブレーカーの判定に含めない
+        if error.retryable and self.breaker.record_failure():
+            metrics.inc("llm_circuit_opened_total", provider=self.name)
+            logger.warning(f"LLMプロバイダー {self.name} が連続して失敗したため、{self.breaker.cooldown:.0f} 秒間呼び出しを止めます: {error}")
+
+
+# SDKの自動リトライは無効にし、再試行はエラーの種類に応じて呼び出し側で行う
+# timeout は接続・チャンク受信ごとのタイムアウト (呼び出し全体の打ち切りは LLMRouter.complete の asyncio.wait_for で行う)
+class GroqProvider(LLMProvider):
+    def __init__(self):
+        super().__init__("groq", GROQ_MODEL_NAME, LLM_REQUESTS_PER_MINUTE)
+
+    def _create_client(self, http_client: httpx.AsyncClient):
+        return AsyncGroq(api_key=GROQ_API_KEY, base_url=GROQ_BASE_URL, timeout=LLM_TIMEOUT, max_retries=0, http_client=http_client)
+
+    def _usage(self, chunk):
+        # Groq は最後のチャンクの x_groq.usage にトークン数を載せる
+        return getattr(getattr(chunk, "x_groq", None), "usage", None)
+
+
+class OpenAICompatibleProvider(LLMProvider):
+    def __init__(self, name: str, base_url: str, api_key: str | None, model: str, requests_per_minute: float = 0, local: bool = False):
+        super().__init__(name, model, requests_per_minute)
+        self.local = local
+        self.base_url = base_url
+        self.api_key = api_key
+
+    def _create_client(self, http_client: httpx.AsyncClient):
+        # llama.cpp などのローカルサーバーはAPIキーを検証しないが、クライアントの初期化には値が必要
+        return AsyncOpenAI(api_key=self.api_key or "not-needed", base_url=self.base_url, timeout=LLM_TIMEOUT, max_retries=0,
+                           http_client=http_client)
+
+
+def create_provider(name: str) -> LLMProvider:
+    if name == "groq":
+        return GroqProvider()
+    if name == "openai":
+        return OpenAICompatibleProvider("openai", OPENAI_COMPAT_BASE_URL, OPENAI_COMPAT_API_KEY, OPENAI_COMPAT_MODEL,
+                                        OPENAI_COMPAT_REQUESTS_PER_MINUTE)
+    if name == "local":
+        return OpenAICompatibleProvider("local", LOCAL_LLM_BASE_URL, None, LOCAL_LLM_MODEL, local=True)
+    raise ValueError(f"未対応のLLMプロバイダーです: {name} (groq / openai / local のいずれかを指定してください)")
+
+
+class LLMRouter:
+    """
+    設定順のプロバイダーから、応答時間・エラー率が閾値以内のものを優先して選ぶ。
+    すべてが閾値を超えている場合は、エラー率・応答時間が最も小さいプロバイダーを選ぶ。
+    サーキットブレーカーが "open" のプロバイダーは選ばない。
+    """
+
+    def __init__(self, providers: list):
+        if not providers:
+            raise ValueError("LLMプロバイダーが1つも設定されていません (LLM_PROVIDERS)。")
+        self.providers = providers
+
+    def candidates(self) -> list:
+        available = [p for p in self.providers if p.breaker.available()]
+        healthy = [p for p in available if p.stats.is_healthy()]
+        unhealthy = sorted(
+            (p for p in available if p not in healthy),
+            key=lambda p: (p.stats.error_rate, p.stats.latency or 0.0)
+        )
+        return healthy + unhealthy
+
+    def pick(self, exclude: set = frozenset()) -> LLMProvider | None:
+        """
+        exclude (この呼び出しで既に失敗したプロバイダー名) 以外で最も優先度の高いプロバイダーを返す。
+        すべて exclude に含まれる場合はその中で最も優先度の高いものを、すべてのブレーカーが "open" の場合は None を返す。
+        """
+        candidates = self.candidates()
+        for provider in candidates:
+            if provider.name not in exclude:
+                return provider
+        return candidates[0] if candidates else None
+
+    def next_available_in(self) -> float:
+        """いずれかのプロバイダーのブレーカーが "half_open" になるまでの秒数。"""
+        return min(p.breaker.retry_in() for p in self.providers)
+
+    async def _call(self, provider: LLMProvider, admission: str, messages: list, temperature: float, max_tokens: int,
+                    json_mode: bool, purpose: str, timeout: float):
+        # レート制限の枠とサーキットブレーカーの許可は呼び出し側 (complete) で取得済み
+        started = time.perf_counter()
+        try:
+            text = await asyncio.wait_for(provider.acomplete(messages, temperature, max_tokens, json_mode, purpose), timeout)
+        except asyncio.CancelledError:
+            # ヘッジで先に他方が返ったために取り消された場合は、成功・失敗のどちらにも数えない
+            if admission == "probe":
+                provider.breaker.release_probe()
+            raise
+        except Exception as e:
+            error = classify_error(provider, e)
+            provider.record_failure(error)
+            metrics.inc("llm_requests_total", purpose=purpose, outcome=error.kind, provider=provider.name)
+            raise error from e
+        elapsed = time.perf_counter() - started
+        provider.record_success(elapsed)
+        metrics.observe("llm_request_seconds", elapsed, purpose=purpose, provider=provider.name)
+        metrics.inc("llm_requests_total", purpose=purpose, outcome="success", provider=provider.name)
+        return provider, text
+
+    async def complete(self, provider: LLMProvider, messages: list, temperature: float, max_tokens: int,
+                       json_mode: bool = False, purpose: str = "label", deadline: Deadline | None = None,
+                       exclude: set = frozenset()):
+        """
+        provider でリクエストを送り、(応答したプロバイダー, レスポンス全体) を返す。失敗した場合は LLMCallError を送出する。
+        p95 の応答時間を過ぎても返らない場合は、他のプロバイダー (なければ同じプロバイダー) にも同じリクエストを送り、先に成功した方を使う。
+        ヘッジまでの時間はレート制限の待ちを終えてリクエストを送った時点から数え (p95 も送信からの応答時間)、
+        ヘッジ先のプロバイダーに待たずに使えるレート制限の枠がない場合はヘッジしない。
+        """
+        deadline = deadline or Deadline()
+        args = (messages, temperature, max_tokens, json_mode, purpose)
+        admission = provider.breaker.admit()
+        if admission is None:
+            # 選んだ後に他の呼び出しが "half_open" の試験の呼び出しを始めた (またはブレーカーが開いた)
+            raise LLMCallError(provider, "circuit_open", RuntimeError("サーキットブレーカーが開いています"))
+        try:
+            await provider.rate_limiter.acquire()
+        except asyncio.CancelledError:
+            if admission == "probe":
+                provider.breaker.release_probe()
+            raise
+        primary = asyncio.create_task(self._call(provider, admission, *args, deadline.timeout()))
+        hedge_delay = provider.stats.percentile(0.95) if LLM_HEDGE_ENABLED else None
+        if hedge_delay is None or hedge_delay >= deadline.timeout():
+            return await primary
+
+        done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+        if done:
+            return primary.result()
+
+        hedge_provider = self.pick(set(exclude) | {provider.name}) or provider
+        hedge_admission = hedge_provider.breaker.admit()
+        if hedge_admission is None:
+            return await primary
+        if not hedge_provider.rate_limiter.try_acquire():
+            # ヘッジのためにレート制限の枠を待つと、後続の呼び出しの枠を奪ってスループットが下がる
+            if hedge_admission == "probe":
+                hedge_provider.breaker.release_probe()
+            metrics.inc("llm_hedge_skipped_total", purpose=purpose, provider=hedge_provider.name)
+            return await primary
+        metrics.inc("llm_hedged_requests_total", purpose=purpose, provider=hedge_provider.name)
+        hedge = asyncio.create_task(self._call(hedge_provider, hedge_admission, *args, deadline.timeout()))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            metrics.inc("llm_hedge_wins_total", purpose=purpose, provider=hedge_provider.name)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def status(self) -> list:
+        return [
+            {
+                "name": p.name, "model": p.model, "local": p.local, "healthy": p.stats.is_healthy(),
+                "circuit": p.breaker.state, "circuit_retry_in_seconds": round(p.breaker.retry_in(), 1),
+                "consecutive_failures": p.breaker.consecutive_failures,
+                **p.stats.to_dict(),
+            }
+            for p in self.providers
+        ]
+
+    async def aclose(self):
+        """現在のイベントループで使ったすべてのプロバイダーの接続プールを閉じる (ワーカーのループやアプリケーションの終了時)。"""
+        for provider in self.providers:
+            await provider.aclose()
+
+
+router = LLMRouter([create_provider(name.strip()) for name in LLM_PROVIDERS.split(",") if name.strip()])
@@ -34,6 +34,7 @@ class TopClusterResult(BaseModel):
     score: float
     representative_text: str
     tags: Optional[Dict[str, Any]] = None # List[str] から Optional[Dict[str, Any]] に変更
+    tag_sums: Optional[Dict[str, Any]] = None # クラスタ内のタグごとの合計値 (ClusterStat.tag_sums)
     comment_count: int
     comments_examples: List[ClusterCommentDetail]
 
@@ -62,6 +63,7 @@ class AnalysisSessionBase(BaseModel):
 class AnalysisResult(BaseModel):
     pn_charts: PnChartsResult
     top_clusters: List[TopClusterResult]
+    approximation: Optional[Dict[str, Any]] = None # 近似分析モードの推定の詳細 (信頼区間など)。通常の分析は None
 
 # APIから返されるAI分析コメント
 class AiAnalysisCommentResult(BaseModel):
@@ -82,6 +84,10 @@ class AnalysisSessionListItem(BaseModel):
     overall_positive_percent: float
     overall_negative_percent: float
     dangerous_comment_count: int
+    stage_timings: Optional[Dict[str, Any]] = None # ステージ別処理時間の内訳
+    label_agreement: Optional[Dict[str, Any]] = None # cluster_first パイプラインのラベル一致率など
+    approximation: Optional[Dict[str, Any]] = None # 近似分析モードの推定の詳細 (信頼区間など)
+    archived_at: Optional[datetime] = None # アーカイブ済みの場合はその日時 (コメントは読み取り専用)
 
     class Config:
         orm_mode = True
@@ -90,6 +96,16 @@ class ClusterDetailsResponse(BaseModel):
     cluster_id: int
     representative_text: str
     comments: List[ClusterCommentDetail] # ClusterCommentDetail は既に定義済み
+    total_count: Optional[int] = None # 条件に一致するコメント数 (最初のページのみ)
+    next_cursor: Optional[str] = None # 次のページを取得するためのカーソル (最後のページでは None)
 
     class Config:
-        orm_mode = True # ORMモデルのインスタンスを直接扱う場合
\ No newline at end of file
+        orm_mode = True # ORMモデルのインスタンスを直接扱う場合
+# ライブセッションの作成 (POST /api/live/sessions)
+class LiveSessionCreate(BaseModel):
+    title: Optional[str] = None # 省略した場合は開始日時から作る
+
+# ライブセッションへのコメントの投稿 (POST /api/live/{session_id}/comments)。1件は text、まとめて送る場合は texts
+class LiveCommentsIn(BaseModel):
+    text: Optional[str] = None
+    texts: Optional[List[str]] = None
@@ -1,12 +1,26 @@
 import logging
+import pickle
+from collections import defaultdict
+import numpy as np
 from sqlalchemy.orm import Session
-from app.models import Comment
+from app.models import Comment, ClusterStat
+from app import metrics
 
 # ロガーの設定
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-async def calculate_importance_scores(db: Session):
+# ClusterStat.top_comment_ids に保存するコメント数 (ランキングの例コメントと代表コメントに使う)
+TOP_COMMENTS_PER_CLUSTER = 5
+
+def importance_from_tags(tags: dict | None) -> float:
+    """タグから重要度スコアを求める (calculate_importance_scores と同じ式。ライブセッションでコメントごとに使う)。"""
+    if not tags:
+        return 0.0
+    urgency = int(tags.get('緊急性', 0))
+    return float(urgency * (int(tags.get('質問', 0)) + int(tags.get('インフラ', 0)) + int(tags.get('具体的', 0))))
+
+async def calculate_importance_scores(db: Session, session_id: int | None = None):
     """
     データベース内のコメントに対して重要度スコアを計算し、保存する。
     重要度 = 緊急性 × (質問 + インフラ + 具体的)
@@ -15,7 +29,7 @@ async def calculate_importance_scores(db: Session):
 
     # タグが設定されている（または設定されるべき）コメントを取得
     # LLM処理が完了したコメントを対象とします。
-    comments_to_score = db.query(Comment).filter(Comment.sentiment != None).all()
+    comments_to_score = db.query(Comment).filter(Comment.sentiment != None, Comment.session_id == session_id).all()
 
     if not comments_to_score:
         logger.info("スコアを計算すべきコメントがありません。")
@@ -56,8 +70,73 @@ async def calculate_importance_scores(db: Session):
             logger.warning(f"コメントID {comment.id} にタグデータがないため、重要度スコアを0に設定しました。")
 
     try:
-        db.commit() # すべての更新をまとめてコミット
+        with metrics.span("db_commit"):
+            db.commit() # すべての更新をまとめてコミット
         logger.info(f"重要度スコアの計算が完了しました。{updated_count} 件のコメントが更新されました。")
     except Exception as e:
         db.rollback() # コミット中にエラーが発生したらロールバック
-        logger.error(f"重要度スコア結果のコミット中にエラーが発生しました: {e}", exc_info=True)
\ No newline at end of file
+        logger.error(f"重要度スコア結果のコミット中にエラーが発生しました: {e}", exc_info=True)
+
+def calculate_cluster_stats(db: Session, session_id: int | None = None):
+    """
+    クラスタごとの集計値 (コメント数、重要度の平均・最大、タグ合計、感情の内訳、medoid、重心) を ClusterStat に保存する。
+    重要度スコアの計算後に1回だけ実行する。作成した行は session_id が None の「実行中」の集計として保存され、
+    パイプラインが AnalysisSession を保存するときにそのセッションIDが設定される。
+    バッチのセッション (session_id を指定) では、そのセッションのコメントだけを集計し、最初からセッションIDを設定する。
+    """
+    logger.info("クラスタ別集計の作成を開始します。")
+    rows = db.query(
+        Comment.id, Comment.cluster_id, Comment.importance_score, Comment.tags, Comment.sentiment, Comment.embedding
+    ).filter(Comment.cluster_id != None, Comment.session_id == session_id).all()
+
+    members = defaultdict(list)
+    for row in rows:
+        members[row.cluster_id].append(row)
+
+    # 前回の実行が途中で失敗した場合に残った「実行中」の集計 (またはこのセッションの古い集計) を削除する
+    db.query(ClusterStat).filter(ClusterStat.session_id == session_id).delete(synchronize_session=False)
+
+    for cluster_id, cluster_rows in members.items():
+        scores = [r.importance_score for r in cluster_rows if r.importance_score is not None]
+        tag_sums = defaultdict(int)
+        for r in cluster_rows:
+            for tag_name, tag_value in (r.tags or {}).items():
+                tag_sums[tag_name] += int(tag_value or 0)
+
+        # 重要度の高い順 (同点はID順)。get_comments_in_cluster の並び順と同じ
+        ranked = sorted(
+            (r for r in cluster_rows if r.importance_score is not None),
+            key=lambda r: (-r.importance_score, r.id)
+        ) or sorted(cluster_rows, key=lambda r: r.id)
+
+        medoid_comment_id = None
+        centroid = None
+        embedded = [r for r in cluster_rows if r.embedding is not None]
+        if cluster_id != -1 and embedded:
+            vectors = np.vstack([pickle.loads(r.embedding) for r in embedded]).astype(np.float32)
+            mean = vectors.mean(axis=0)
+            normalized = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            medoid_comment_id = embedded[int(np.argmax(normalized @ mean))].id
+            centroid = pickle.dumps(mean)
+
+        db.add(ClusterStat(
+            session_id=session_id,
+            cluster_id=cluster_id,
+            size=len(cluster_rows),
+            avg_importance=sum(scores) / len(scores) if scores else None,
+            max_importance=max(scores) if scores else None,
+            tag_sums=dict(tag_sums),
+            positive_count=sum(1 for r in cluster_rows if r.sentiment == 1),
+            negative_count=sum(1 for r in cluster_rows if r.sentiment == 0),
+            medoid_comment_id=medoid_comment_id,
+            top_comment_ids=[r.id for r in ranked[:TOP_COMMENTS_PER_CLUSTER]],
+            centroid=centroid
+        ))
+
+    try:
+        with metrics.span("db_commit"):
+            db.commit()
+        logger.info(f"クラスタ別集計の作成が完了しました。{len(members)} 件のクラスタ")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"クラスタ別集計のコミット中にエラーが発生しました: {e}", exc_info=True)
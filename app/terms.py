@@ -0,0 +1,317 @@
+"""
+コメントの用語分析 (キーワード抽出)。
+
+分析パイプラインの最後に、セッションのコメントを日本語の用語に分割して疎な文書-用語行列 (scipy.sparse の CSR) を作り、
+全体・クラスタ別・カテゴリ別の TF-IDF 上位語を AnalysisSession.keywords に保存する。
+- 用語の分割は janome (インストールされている場合) の形態素解析、なければ文字種ごとの簡易な分割 (漢字は2-gram、カタカナ・英数字は語のまま) を使う
+- IDF の文書頻度は TermStat に全セッションの累計として持ち、セッションで取り込んだコメントの分だけ加算する (comments テーブル全体から作り直さない)
+- クラスタ別・カテゴリ別の集計は、グループ x 文書の疎行列と文書-用語行列の積で一度に計算する
+
+使い方 (CLI):
+    python -m app.terms --backfill        # 用語分析をしていない既存のセッションを作成順に処理する
+    python -m app.terms --session 12      # セッションのキーワードを計算し直す
+    python -m app.terms --reset --backfill  # TERMS_TOKENIZER を変えた場合などに文書頻度を作り直す
+"""
+import argparse
+import logging
+import re
+import threading
+import unicodedata
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+from app.config import TERMS_TOKENIZER, TERMS_TOP_K
+from app.models import AnalysisSession, Comment, TermStat, comment_scope
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# TermStat を読み書きするときの IN 句1回あたりの用語数
+TERM_QUERY_CHUNK_SIZE = 500
+
+# janome の品詞のうちキーワードにするもの (大分類) と、除外する細分類
+_CONTENT_POS = {"名詞", "動詞", "形容詞"}
+_EXCLUDED_POS_DETAIL = {"非自立", "代名詞", "数", "接尾", "副詞可能"}
+# 品詞では除けない、どのコメントにも現れる語
+_STOPWORDS = {"する", "ある", "いる", "なる", "れる", "られる", "できる", "思う", "いう", "こと", "もの", "よう", "ため", "それ", "これ", "ところ", "とき"}
+
+# 文字2-gramで分割するときの文字種 (英数字・カタカナ・漢字の連続)。ひらがなは助詞や活用語尾が大半のため用語にしない
+_BIGRAM_RUN_PATTERN = re.compile(r"[a-z0-9][a-z0-9_\-]*|[ァ-ヺー]+|[㐀-鿿々]+")
+# 1文字の漢字の後に続くと活用語の語幹とみなすひらがな (助詞の「が・を・は・の・も・で・と・へ・や・か」は除く)
+_OKURIGANA_PATTERN = re.compile(r"[ぁ-ゖ](?<![がをはのもでとへやか])")
+
+_janome_tokenizer = None
+_janome_lock = threading.Lock()
+
+
+def _get_janome():
+    """janome の Tokenizer を返す (辞書の読み込みに時間がかかるため、最初の呼び出しで1回だけ作成する)。"""
+    global _janome_tokenizer
+    if _janome_tokenizer is None:
+        with _janome_lock:
+            if _janome_tokenizer is None:
+                from janome.tokenizer import Tokenizer  # 任意の依存ライブラリのため、使うときにのみ読み込む
+                _janome_tokenizer = Tokenizer()
+    return _janome_tokenizer
+
+
+def resolve_tokenizer(name: str = TERMS_TOKENIZER) -> str:
+    """使用する分割方法 ("janome" または "bigram") を返す。janome がインストールされていない場合は "bigram" にする。"""
+    if name == "bigram":
+        return "bigram"
+    try:
+        import janome  # noqa: F401
+        return "janome"
+    except ImportError:
+        if name == "janome":
+            logger.warning("janome がインストールされていないため、文字2-gramで用語を分割します。")
+        return "bigram"
+
+
+def _normalize(text: str) -> str:
+    # 全角英数字・半角カナを揃え、英字は小文字にする
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+def _janome_terms(text: str) -> list:
+    terms = []
+    for token in _get_janome().tokenize(_normalize(text)):
+        pos = token.part_of_speech.split(",")
+        if pos[0] not in _CONTENT_POS or pos[1] in _EXCLUDED_POS_DETAIL:
+            continue
+        term = token.base_form if token.base_form != "*" else token.surface
+        if term in _STOPWORDS or (len(term) < 2 and not re.match(r"[㐀-鿿]", term)):
+            continue
+        terms.append(term)
+    return terms
+
+
+def _bigram_terms(text: str) -> list:
+    terms = []
+    text = _normalize(text)
+    for match in _BIGRAM_RUN_PATTERN.finditer(text):
+        run = match.group()
+        is_kanji = re.match(r"[㐀-鿿]", run) is not None
+        if len(run) > 2 and is_kanji:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+        elif len(run) >= 2:
+            # 英数字・カタカナの語と2文字の漢字語はそのまま1語にする
+            terms.append(run)
+        elif is_kanji and not _OKURIGANA_PATTERN.match(text, match.end()):
+            # 1文字の漢字は、送り仮名が続くもの (「小さい」の「小」などの活用語の語幹) を除いて1語にする (「音が」の「音」は残す)
+            terms.append(run)
+    return terms
+
+
+def tokenize(text: str, tokenizer: str | None = None) -> list:
+    """コメント1件を用語のリストに分割する。"""
+    if (tokenizer or resolve_tokenizer()) == "janome":
+        return _janome_terms(text)
+    return _bigram_terms(text)
+
+
+def _load_document_counts(db: Session, terms: list) -> dict:
+    counts = {}
+    for start in range(0, len(terms), TERM_QUERY_CHUNK_SIZE):
+        chunk = terms[start:start + TERM_QUERY_CHUNK_SIZE]
+        counts.update(db.query(TermStat.term, TermStat.document_count).filter(TermStat.term.in_(chunk)).all())
+    return counts
+
+
+def _upsert_document_counts(db: Session):
+    """用語の文書頻度を加算する INSERT ... ON CONFLICT DO UPDATE 文 (SQLite と PostgreSQL)。"""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    statement = insert(TermStat)
+    return statement.on_conflict_do_update(
+        index_elements=[TermStat.term],
+        set_={"document_count": TermStat.document_count + statement.excluded.document_count},
+    )
+
+
+def _update_document_counts(db: Session, terms: np.ndarray, new_counts: np.ndarray):
+    """
+    このセッションで取り込んだコメントの文書頻度を TermStat に加算する。
+    並列に処理している他のセッション (バッチのワーカー、別のスコープの /upload) と同じ用語を同時に加算しても
+    更新が失われないよう、読み込んだ値を書き戻さずに1文の upsert で加算する。
+    """
+    values = [{"term": term, "document_count": int(count)} for term, count in zip(terms[new_counts > 0], new_counts[new_counts > 0])]
+    statement = _upsert_document_counts(db)
+    for start in range(0, len(values), TERM_QUERY_CHUNK_SIZE):
+        db.execute(statement, values[start:start + TERM_QUERY_CHUNK_SIZE])
+
+
+def _top_terms(scores: sparse.csr_matrix, doc_counts: sparse.csr_matrix, terms: np.ndarray, min_docs: np.ndarray, top_k: int) -> list:
+    """
+    グループ (行) ごとに、min_docs 件以上のコメントに現れる用語を TF-IDF の高い順に top_k 件返す。
+    scores と doc_counts は同じ行列の積から作るため非ゼロの位置が同じで、インデックスを整列すれば data をそのまま対応付けられる。
+    """
+    scores.sort_indices()
+    doc_counts.sort_indices()
+    results = []
+    for row in range(scores.shape[0]):
+        start, end = scores.indptr[row], scores.indptr[row + 1]
+        columns = scores.indices[start:end]
+        values = scores.data[start:end]
+        counts = doc_counts.data[start:end]
+        keep = counts >= min_docs[row]
+        columns, values, counts = columns[keep], values[keep], counts[keep]
+        if len(columns) > top_k:
+            best = np.argpartition(-values, top_k)[:top_k]
+            columns, values, counts = columns[best], values[best], counts[best]
+        order = np.lexsort((terms[columns], -values))
+        norm = np.linalg.norm(values) or 1.0
+        results.append([
+            {"term": str(terms[columns[i]]), "score": round(float(values[i] / norm), 4), "comments": int(counts[i])}
+            for i in order
+        ])
+    return results
+
+
+def _group_matrix(labels: list) -> tuple:
+    """文書ごとのグループ名からグループ x 文書の疎行列 (所属していれば 1) とグループ名のリストを作る (None のグループは除く)。"""
+    names = sorted({label for label in labels if label is not None}, key=str)
+    index = {name: i for i, name in enumerate(names)}
+    rows, columns = [], []
+    for doc, label in enumerate(labels):
+        if label is not None:
+            rows.append(index[label])
+            columns.append(doc)
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)), shape=(len(names), len(labels)))
+    return matrix, names
+
+
+def analyze_terms(db: Session, analysis_session: AnalysisSession, top_k: int = TERMS_TOP_K) -> dict | None:
+    """
+    セッションのコメントのキーワード (全体・クラスタ別・カテゴリ別の TF-IDF 上位語) を計算して AnalysisSession.keywords に保存し、返す。
+    このセッションで取り込んだコメントの文書頻度は、まだ加算していない場合だけ TermStat に加える。コメントがない場合は None を返す。
+    """
+    scope = comment_scope(analysis_session)
+    rows = db.query(Comment.id, Comment.text, Comment.cluster_id, Comment.category, Comment.ingest_session_id).filter(
+        Comment.session_id == scope
+    ).order_by(Comment.id).all()
+    if not rows:
+        return None
+
+    tokenizer = resolve_tokenizer()
+    # 同じ本文 (重複コメント) は1回だけ分割し、コメントごとの行は行のインデックスで複製する
+    unique_texts = {}
+    text_index = np.array([unique_texts.setdefault(r.text, len(unique_texts)) for r in rows])
+    vectorizer = CountVectorizer(analyzer=lambda text: tokenize(text, tokenizer), dtype=np.float32)
+    try:
+        unique_matrix = vectorizer.fit_transform(list(unique_texts))
+    except ValueError:
+        # 用語が1つもない (記号だけのコメントなど)
+        logger.info(f"分析セッションID {analysis_session.id} のコメントには用語がありません。")
+        unique_matrix = None
+
+    keywords = {"tokenizer": tokenizer, "documents": len(rows), "overall": [], "clusters": {}, "categories": {}}
+    try:
+        if unique_matrix is not None:
+            matrix = unique_matrix[text_index].tocsr()
+            presence = matrix.copy()
+            presence.data[:] = 1.0
+            terms = vectorizer.get_feature_names_out()
+
+            # 文書頻度の更新は、このセッションで取り込んだコメントの分だけ (再計算のときは加算しない)
+            if analysis_session.term_documents is None:
+                ingested = np.array([r.ingest_session_id == analysis_session.id for r in rows])
+                new_counts = np.asarray(presence[ingested].sum(axis=0)).ravel() if ingested.any() else np.zeros(len(terms))
+                _update_document_counts(db, terms, new_counts)
+                analysis_session.term_documents = int(ingested.sum())
+                db.flush()
+            # IDF には加算後の値 (他のセッションが加算した分を含む) を使う
+            document_counts = _load_document_counts(db, terms.tolist())
+            total_documents = db.query(func.sum(AnalysisSession.term_documents)).scalar() or 0
+
+            # 平滑化した IDF (scikit-learn の TfidfVectorizer と同じ式)
+            df = np.array([document_counts.get(term, 0) for term in terms], dtype=np.float64)
+            idf = np.log((1 + total_documents) / (1 + df)) + 1
+            idf_matrix = sparse.diags(idf.astype(np.float32))
+
+            cluster_groups, cluster_ids = _group_matrix([r.cluster_id if r.cluster_id not in (None, -1) else None for r in rows])
+            category_groups, categories = _group_matrix([r.category for r in rows])
+            overall_group = sparse.csr_matrix(np.ones((1, len(rows)), dtype=np.float32))
+            groups = sparse.vstack([overall_group, cluster_groups, category_groups]).tocsr()
+
+            # グループ x 用語の出現回数 (対数で抑えた TF) と、用語を含むコメント数を一度に計算する
+            term_frequency = (groups @ matrix).tocsr()
+            term_frequency.data = np.log1p(term_frequency.data)
+            scores = (term_frequency @ idf_matrix).tocsr()
+            doc_counts = (groups @ presence).tocsr()
+            # 2件以上のコメントに現れる用語だけをキーワードにする (1件だけのグループは1件)
+            group_sizes = np.asarray(groups.sum(axis=1)).ravel()
+            top = _top_terms(scores, doc_counts, terms, np.minimum(group_sizes, 2), top_k)
+
+            keywords["overall"] = top[0]
+            keywords["clusters"] = {str(cluster_id): top[1 + i] for i, cluster_id in enumerate(cluster_ids)}
+            keywords["categories"] = {category: top[1 + len(cluster_ids) + i] for i, category in enumerate(categories)}
+            keywords["vocabulary"] = len(terms)
+        analysis_session.keywords = keywords
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    logger.info(
+        f"分析セッションID {analysis_session.id} の用語分析が完了しました "
+        f"(コメント {len(rows)} 件、用語 {keywords.get('vocabulary', 0)} 語、分割: {tokenizer})。"
+    )
+    return keywords
+
+
+def backfill(db: Session) -> int:
+    """用語分析をしていない既存のセッション (アーカイブ済みを除く) を作成順に処理し、処理したセッション数を返す。"""
+    sessions = db.query(AnalysisSession).filter(
+        or_(AnalysisSession.status == None, AnalysisSession.status == "done"),
+        AnalysisSession.archived_at == None,
+        AnalysisSession.term_documents == None
+    ).order_by(AnalysisSession.created_at, AnalysisSession.id).all()
+    for analysis_session in sessions:
+        analyze_terms(db, analysis_session)
+    return len(sessions)
+
+
+def main():
+    from app.config import engine, SessionLocal
+    from app.models import Base, upgrade_schema
+
+    parser = argparse.ArgumentParser(description="分析セッションのコメントからキーワード (TF-IDF 上位語) を抽出する")
+    parser.add_argument("--session", type=int, help="キーワードを計算し直すセッションID")
+    parser.add_argument("--backfill", action="store_true", help="用語分析をしていない既存のセッションを作成順に処理する")
+    parser.add_argument("--reset", action="store_true", help="用語の文書頻度と各セッションの集計済みの印を削除する")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    upgrade_schema(engine)
+
+    db = SessionLocal()
+    try:
+        if args.reset:
+            db.query(TermStat).delete(synchronize_session=False)
+            db.query(AnalysisSession).update({AnalysisSession.term_documents: None}, synchronize_session=False)
+            db.commit()
+            print("用語の文書頻度を削除しました。")
+        if args.backfill:
+            print(f"{backfill(db)} 件のセッションを処理しました (用語数: {db.query(TermStat).count()})。")
+        if args.session is not None:
+            analysis_session = db.get(AnalysisSession, args.session)
+            if analysis_session is None:
+                parser.error(f"分析セッションが見つかりません: {args.session}")
+            keywords = analyze_terms(db, analysis_session)
+            for item in (keywords or {}).get("overall", []):
+                print(f"{item['term']}\t{item['score']}\t{item['comments']}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""
+セッション (講義) をまたいだトピックの追跡。
+
+分析パイプラインの最後に、セッションのクラスタ (ClusterStat) の重心を、これまでに見つかったトピック (Topic) の重心と照合する。
+- 照合はクラスタの重心とトピックの重心をそれぞれ正規化し、コサイン類似度の行列 (クラスタ数 x トピック数) を1回の行列積で計算する
+- 最も類似度の高いトピックとの類似度が TOPIC_MATCH_THRESHOLD 以上ならそのトピック、未満なら新しいトピックとする
+  (HDBSCAN が1つの話題を複数のクラスタに分けた場合は、同じトピックにまとめて集計する)
+- トピックごとのセッション内のコメント数・割合・感情の件数を TopicSnapshot に保存し、トピックの重心をコメント数で重み付けして更新する
+トレンドのAPI (topic_trends) は Topic と TopicSnapshot だけを参照し、コメントの再埋め込みやクラスタリングはしない。
+
+使い方 (CLI):
+    python -m app.topics --backfill    # 既存の分析セッションを作成順に照合する
+    python -m app.topics --reset --backfill
+"""
+import argparse
+import logging
+import pickle
+from collections import defaultdict
+
+import numpy as np
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+
+from app.config import TOPIC_MATCH_THRESHOLD
+from app.models import AnalysisSession, ClusterStat, Comment, Topic, TopicSnapshot
+from app import metrics
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+metrics.describe("topics_matched_total", "counter", "既存のトピックに照合したクラスタ数")
+metrics.describe("topics_created_total", "counter", "新しく作成したトピック数")
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _load_topic_matrix(db: Session):
+    """全トピックと、その重心を並べた行列 (トピック数 x 次元、正規化済み) を返す。"""
+    topics = db.query(Topic).order_by(Topic.id).all()
+    if not topics:
+        return topics, None
+    return topics, np.vstack([pickle.loads(t.centroid) for t in topics]).astype(np.float32)
+
+
+def _representative_texts(db: Session, stats: list) -> dict:
+    """クラスタの代表コメント (重心に最も近いコメント、なければ重要度1位) の本文を cluster_id ごとに返す。"""
+    comment_ids = {}
+    for stat in stats:
+        comment_id = stat.medoid_comment_id or (stat.top_comment_ids or [None])[0]
+        if comment_id is not None:
+            comment_ids[stat.cluster_id] = comment_id
+    if not comment_ids:
+        return {}
+    texts = dict(db.query(Comment.id, Comment.text).filter(Comment.id.in_(list(comment_ids.values()))).all())
+    return {cluster_id: texts.get(comment_id) for cluster_id, comment_id in comment_ids.items()}
+
+
+def track_topics(db: Session, analysis_session: AnalysisSession) -> dict:
+    """
+    分析セッションのクラスタをトピックに照合し、TopicSnapshot を保存する。
+    既に照合済みのセッションは何もしない。戻り値は {"matched": 既存トピックに照合したクラスタ数, "created": 新しいトピック数, "topics": スナップショット数}。
+    """
+    report = {"matched": 0, "created": 0, "topics": 0}
+    if db.query(TopicSnapshot.id).filter(TopicSnapshot.session_id == analysis_session.id).first() is not None:
+        logger.info(f"分析セッションID {analysis_session.id} のトピックは照合済みです。")
+        return report
+
+    stats = db.query(ClusterStat).filter(
+        ClusterStat.session_id == analysis_session.id,
+        ClusterStat.cluster_id != -1,
+        ClusterStat.centroid != None
+    ).order_by(ClusterStat.cluster_id).all()
+    if not stats:
+        logger.info(f"分析セッションID {analysis_session.id} には照合するクラスタがありません。")
+        return report
+
+    centroids = _normalize_rows(np.vstack([pickle.loads(s.centroid) for s in stats]).astype(np.float32))
+    topics, topic_matrix = _load_topic_matrix(db)
+
+    # クラスタごとに最も類似度の高いトピックを選ぶ (クラスタ数 x トピック数の類似度行列を1回で計算する)
+    best_index = np.full(len(stats), -1)
+    best_similarity = np.zeros(len(stats), dtype=np.float32)
+    if topic_matrix is not None:
+        similarities = centroids @ topic_matrix.T
+        best_index = similarities.argmax(axis=1)
+        best_similarity = similarities[np.arange(len(stats)), best_index]
+
+    texts = _representative_texts(db, stats)
+    total = analysis_session.total_comments or sum(s.size for s in stats)
+
+    # トピックごとに、このセッションで照合したクラスタをまとめる (新しいトピックはクラスタごとに作る)
+    groups = defaultdict(list)
+    new_topics = []
+    for i, stat in enumerate(stats):
+        if best_index[i] >= 0 and best_similarity[i] >= TOPIC_MATCH_THRESHOLD:
+            groups[topics[best_index[i]].id].append(i)
+            report["matched"] += 1
+        else:
+            new_topics.append(i)
+
+    try:
+        for i in new_topics:
+            stat = stats[i]
+            topic = Topic(
+                label=texts.get(stat.cluster_id),
+                centroid=pickle.dumps(centroids[i]),
+                total_comments=0,
+                session_count=0,
+                label_cluster_size=0,
+                first_session_id=analysis_session.id
+            )
+            db.add(topic)
+            db.flush()
+            groups[topic.id].append(i)
+            best_similarity[i] = 1.0
+            topics.append(topic)
+            report["created"] += 1
+
+        topics_by_id = {t.id: t for t in topics}
+        for topic_id, indexes in groups.items():
+            topic = topics_by_id[topic_id]
+            members = [stats[i] for i in indexes]
+            sizes = np.array([s.size for s in members], dtype=np.float32)
+            comment_count = int(sizes.sum())
+
+            # 重心はこれまでのコメント数とこのセッションのコメント数で重み付けした平均 (正規化し直す)
+            merged = pickle.loads(topic.centroid) * (topic.total_comments or 0) + (centroids[indexes] * sizes[:, None]).sum(axis=0)
+            merged /= np.linalg.norm(merged) or 1.0
+            topic.centroid = pickle.dumps(merged.astype(np.float32))
+            topic.total_comments = (topic.total_comments or 0) + comment_count
+            topic.session_count = (topic.session_count or 0) + 1
+            topic.last_session_id = analysis_session.id
+
+            # ラベルは、これまでで最も大きいクラスタの代表コメントにする
+            largest = max(members, key=lambda s: s.size)
+            if largest.size > (topic.label_cluster_size or 0) and texts.get(largest.cluster_id):
+                topic.label = texts[largest.cluster_id]
+                topic.label_cluster_size = largest.size
+
+            scores = [(s.avg_importance, s.size) for s in members if s.avg_importance is not None]
+            db.add(TopicSnapshot(
+                topic_id=topic_id,
+                session_id=analysis_session.id,
+                session_created_at=analysis_session.created_at,
+                cluster_ids=[s.cluster_id for s in members],
+                comment_count=comment_count,
+                share=comment_count / total * 100 if total else 0.0,
+                positive_count=sum(s.positive_count or 0 for s in members),
+                negative_count=sum(s.negative_count or 0 for s in members),
+                avg_importance=sum(a * n for a, n in scores) / sum(n for _, n in scores) if scores else None,
+                similarity=float(max(best_similarity[i] for i in indexes))
+            ))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    report["topics"] = len(groups)
+    metrics.inc("topics_matched_total", report["matched"])
+    metrics.inc("topics_created_total", report["created"])
+    logger.info(
+        f"分析セッションID {analysis_session.id} のクラスタ {len(stats)} 件をトピックに照合しました "
+        f"(既存トピック {report['matched']} 件、新規トピック {report['created']} 件)。"
+    )
+    return report
+
+
+def _slope(values: list) -> float:
+    """セッション順の割合 (%) の最小二乗法による傾き (1セッションあたりの増減、ポイント)。"""
+    if len(values) < 2:
+        return 0.0
+    return float(np.polyfit(np.arange(len(values), dtype=np.float64), np.asarray(values, dtype=np.float64), 1)[0])
+
+
+def _topic_summary(topic: Topic) -> dict:
+    return {
+        "topic_id": topic.id,
+        "label": topic.label,
+        "total_comments": topic.total_comments,
+        "session_count": topic.session_count,
+        "first_session_id": topic.first_session_id,
+        "last_session_id": topic.last_session_id,
+    }
+
+
+def topic_trends(db: Session, limit: int = 10, sort: str = "total", min_sessions: int = 1) -> list:
+    """
+    トピックごとのセッション順の時系列を返す。
+    series はトピックが初めて現れたセッション以降の全セッション (照合済みのもの) を含み、現れなかったセッションは割合 0 とする。
+    growth はその割合の傾き。sort は "total" (コメント数の多い順) または "growth" (増加傾向の強い順)。
+    """
+    # 照合済みのセッション (時系列の横軸)。スナップショットの軽い列だけを読む
+    rows = db.query(
+        TopicSnapshot.topic_id, TopicSnapshot.session_id, TopicSnapshot.session_created_at,
+        TopicSnapshot.comment_count, TopicSnapshot.share, TopicSnapshot.positive_count,
+        TopicSnapshot.negative_count, TopicSnapshot.avg_importance
+    ).all()
+    sessions = sorted({(r.session_created_at, r.session_id) for r in rows}, key=lambda s: (s[0] is None, s[0], s[1]))
+    session_order = {session_id: i for i, (_, session_id) in enumerate(sessions)}
+
+    points_by_topic = defaultdict(dict)
+    for r in rows:
+        points_by_topic[r.topic_id][session_order[r.session_id]] = r
+
+    topics = db.query(Topic).filter(Topic.session_count >= min_sessions).all()
+    trends = []
+    for topic in topics:
+        points = points_by_topic.get(topic.id)
+        if not points:
+            continue
+        series = []
+        for i in range(min(points), len(sessions)):
+            created_at, session_id = sessions[i]
+            point = points.get(i)
+            series.append({
+                "session_id": session_id,
+                "created_at": created_at.isoformat() if created_at else None,
+                "comment_count": point.comment_count if point else 0,
+                "share": round(point.share or 0.0, 2) if point else 0.0,
+                "positive_count": point.positive_count if point else 0,
+                "negative_count": point.negative_count if point else 0,
+                "avg_importance": point.avg_importance if point else None,
+            })
+        trend = _topic_summary(topic)
+        trend["growth"] = round(_slope([p["share"] for p in series]), 3) + 0.0  # -0.0 を 0.0 にする
+        trend["series"] = series
+        trends.append(trend)
+
+    if sort == "growth":
+        trends.sort(key=lambda t: (-t["growth"], -t["total_comments"], t["topic_id"]))
+    else:
+        trends.sort(key=lambda t: (-t["total_comments"], t["topic_id"]))
+    return trends[:limit]
+
+
+def topic_detail(db: Session, topic_id: int) -> dict | None:
+    """トピックの概要と、トピックが現れたセッションごとの集計 (照合したクラスタIDを含む) を返す。"""
+    topic = db.query(Topic).filter(Topic.id == topic_id).first()
+    if topic is None:
+        return None
+    snapshots = db.query(TopicSnapshot).filter(TopicSnapshot.topic_id == topic_id).order_by(
+        TopicSnapshot.session_created_at, TopicSnapshot.session_id
+    ).all()
+    detail = _topic_summary(topic)
+    detail["sessions"] = [
+        {
+            "session_id": s.session_id,
+            "created_at": s.session_created_at.isoformat() if s.session_created_at else None,
+            "cluster_ids": s.cluster_ids,
+            "comment_count": s.comment_count,
+            "share": round(s.share or 0.0, 2),
+            "positive_count": s.positive_count,
+            "negative_count": s.negative_count,
+            "avg_importance": s.avg_importance,
+            "similarity": round(s.similarity, 3) if s.similarity is not None else None,
+        }
+        for s in snapshots
+    ]
+    return detail
+
+
+def backfill(db: Session) -> int:
+    """まだ照合していない既存の分析セッションを作成順に照合し、照合したセッション数を返す (アーカイブ済みのセッションはクラスタ別集計がないため対象外)。"""
+    tracked = {session_id for (session_id,) in db.query(TopicSnapshot.session_id).distinct()}
+    sessions = db.query(AnalysisSession).filter(
+        or_(AnalysisSession.status == None, AnalysisSession.status == "done"),
+        AnalysisSession.archived_at == None
+    ).order_by(AnalysisSession.created_at, AnalysisSession.id).all()
+    count = 0
+    for analysis_session in sessions:
+        if analysis_session.id in tracked:
+            continue
+        track_topics(db, analysis_session)
+        count += 1
+    return count
+
+
+def main():
+    from app.config import engine, SessionLocal
+    from app.models import Base, upgrade_schema
+
+    parser = argparse.ArgumentParser(description="分析セッションのクラスタをセッションをまたいだトピックに照合する")
+    parser.add_argument("--backfill", action="store_true", help="まだ照合していない既存のセッションを作成順に照合する")
+    parser.add_argument("--reset", action="store_true", help="トピックとスナップショットをすべて削除する (閾値を変えて作り直す場合)")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    upgrade_schema(engine)
+
+    db = SessionLocal()
+    try:
+        if args.reset:
+            db.query(TopicSnapshot).delete(synchronize_session=False)
+            db.query(Topic).delete(synchronize_session=False)
+            db.commit()
+            print("トピックとスナップショットを削除しました。")
+        if args.backfill:
+            count = backfill(db)
+            print(f"{count} 件のセッションを照合しました (トピック数: {db.query(Topic).count()})。")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+ベンチマーク用のローカル疑似 Groq / OpenAI 互換サーバー。
+
+/openai/v1/chat/completions (Groq SDK) と /v1/chat/completions (OpenAI互換クライアント) を受け付け、
+ストリーミング (SSE) と非ストリーミングの両方でレスポンスを返す。
+ラベル付けのプロンプトには make_data.py のテンプレートに付いている正解ラベルを返すため、
+実際のAPIを呼ばずにパイプライン全体を再現性のある形で実行できる。
+
+使い方:
+    python -m benchmarks.fake_groq --port 8765 --latency-ms 200 --jitter-ms 50 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from make_data import comment_templates
+
+app = FastAPI()
+
+# 起動時の引数で上書きされる設定値
+settings = {
+    "latency_ms": 0.0,  # 1リクエストあたりの基本遅延
+    "jitter_ms": 0.0,  # 遅延のばらつき (一様分布)
+    "error_rate": 0.0,  # HTTP 500 を返す確率
+    "rate_limit_rate": 0.0,  # HTTP 429 を返す確率
+    "chunk_size": 16,  # ストリーミング時に1チャンクに含める文字数
+}
+
+# テキストが長いテンプレートから順に照合し、部分一致の誤判定を防ぐ
+_TEMPLATES_BY_LENGTH = sorted(comment_templates, key=lambda t: len(t["text"]), reverse=True)
+
+_SUMMARY_TEXT = (
+    "全体としてポジティブなコメントが多い一方、インフラ (音声・通信) に関するネガティブなコメントが目立ちます。"
+    "\n次に行うべきこと:\n1. 配信環境の点検\n2. 資料の事前配布\n3. 質問対応の時間確保"
+)
+
+
+def _label_for_prompt(prompt: str) -> dict:
+    for template in _TEMPLATES_BY_LENGTH:
+        if template["text"] in prompt:
+            return {
+                "カテゴリ": template["category"] if template["category"] in ("講義内容", "授業資料", "運営") else "その他",
+                "危険性": bool(template.get("danger")),
+                "感情": template["sentiment"],
+                **template["tags"],
+            }
+    return {"カテゴリ": "その他", "危険性": False, "感情": 0, "質問": 0, "具体的": 0, "インフラ": 0, "緊急性": 0}
+
+
+def _completion_text(body: dict) -> str:
+    prompt = "\n".join(m.get("content", "") for m in body.get("messages", []))
+    if (body.get("response_format") or {}).get("type") == "json_object":
+        return json.dumps(_label_for_prompt(prompt), ensure_ascii=False)
+    return _SUMMARY_TEXT
+
+
+def _usage(body: dict, text: str) -> dict:
+    prompt_tokens = sum(len(m.get("content", "")) for m in body.get("messages", [])) // 2
+    completion_tokens = len(text) // 2
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+
+async def _simulate_latency():
+    delay = settings["latency_ms"] + random.uniform(-settings["jitter_ms"], settings["jitter_ms"])
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+
+
+def _error_response():
+    roll = random.random()
+    if roll < settings["rate_limit_rate"]:
+        return JSONResponse(status_code=429, content={"error": {"message": "Rate limit reached (fake)", "type": "rate_limit_exceeded"}}, headers={"retry-after": "1"})
+    if roll < settings["rate_limit_rate"] + settings["error_rate"]:
+        return JSONResponse(status_code=500, content={"error": {"message": "Internal server error (fake)", "type": "internal_error"}})
+    return None
+
+
+@app.post("/openai/v1/chat/completions")
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    await _simulate_latency()
+    error = _error_response()
+    if error is not None:
+        return error
+
+    text = _completion_text(body)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    model = body.get("model", "fake-model")
+    usage = _usage(body, text)
+
+    if not body.get("stream"):
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+    async def event_stream():
+        size = settings["chunk_size"]
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        for i, piece in enumerate(pieces):
+            is_last = i == len(pieces) - 1
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": "stop" if is_last else None}],
+            }
+            if is_last:
+                # Groq は最後のチャンクの x_groq.usage に、OpenAI は usage にトークン数を載せる
+                chunk["x_groq"] = {"id": completion_id, "usage": usage}
+                chunk["usage"] = usage
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="ベンチマーク用の疑似 Groq / OpenAI 互換サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    settings.update(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
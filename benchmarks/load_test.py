@@ -0,0 +1,256 @@
+"""
+読み取りAPIの負荷試験。
+
+benchmarks/seed_history.py で作成したデータベースに対して uvicorn でアプリを起動し、同時に --concurrency 個のクライアントから
+エンドポイントごとに --duration 秒ずつリクエストを送る。エンドポイントごとに、レイテンシの p50/p95/p99、スループット、
+レスポンスサイズ、1リクエストあたりのDBクエリ数、サーバープロセス (ワーカーを含む) のメモリ使用量 (RSS) を測り、JSONに保存する。
+--database-url を変えて実行すれば、SQLite と PostgreSQL などを同じ条件で比較できる。
+
+使い方:
+    python -m benchmarks.seed_history --sessions 500 --comments 1000 --database-url sqlite:///history.db
+    python -m benchmarks.load_test --database-url sqlite:///history.db --concurrency 16 --duration 10
+    python -m benchmarks.load_test --url http://127.0.0.1:8000 --database-url sqlite:///history.db   # 起動済みのサーバーに送る
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import httpx
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENDPOINTS = ["analysis_sessions", "time_series_data", "analysis_results", "cluster_details"]
+# メモリ使用量を記録する間隔 (秒)
+RSS_SAMPLE_INTERVAL = 0.2
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def _process_tree_rss_mb(pid: int) -> float | None:
+    """プロセスとその子孫プロセス (uvicorn のワーカー) の RSS の合計 (MB)。/proc がない環境では None。"""
+    total_kb = 0
+    pending = [pid]
+    try:
+        while pending:
+            current = pending.pop()
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+                        break
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        if total_kb == 0:
+            return None
+    return round(total_kb / 1024, 1)
+
+
+def load_targets(database_url: str, sample_sessions: int, seed: int) -> list:
+    """リクエストに使うセッションIDとクラスタID [(session_id, [cluster_id, ...]), ...] をDBから読む。"""
+    os.environ["DATABASE_URL"] = database_url
+    sys.path.insert(0, REPO_ROOT)
+    from app.config import SessionLocal
+    from app.models import AnalysisSession, ClusterStat
+
+    db = SessionLocal()
+    try:
+        session_ids = [row.id for row in db.query(AnalysisSession.id).filter(AnalysisSession.status == "done").all()]
+        if not session_ids:
+            raise SystemExit(f"分析セッションがありません。先に benchmarks.seed_history を実行してください: {database_url}")
+        random.Random(seed).shuffle(session_ids)
+        session_ids = session_ids[:sample_sessions]
+        clusters = {session_id: [] for session_id in session_ids}
+        for row in db.query(ClusterStat.session_id, ClusterStat.cluster_id).filter(ClusterStat.session_id.in_(session_ids)).all():
+            clusters[row.session_id].append(row.cluster_id)
+        return [(session_id, clusters[session_id] or [-1]) for session_id in session_ids]
+    finally:
+        db.close()
+
+
+def make_url_factory(endpoint: str, targets: list, rng: random.Random, cluster_limit: int):
+    def factory() -> str:
+        session_id, cluster_ids = rng.choice(targets)
+        if endpoint == "analysis_sessions":
+            return "/api/analysis_sessions"
+        if endpoint == "time_series_data":
+            return "/api/time_series_data"
+        if endpoint == "analysis_results":
+            return f"/api/analysis_results?session_id={session_id}"
+        return f"/api/cluster_details/{rng.choice(cluster_ids)}?session_id={session_id}&limit={cluster_limit}"
+    return factory
+
+
+async def run_endpoint(client: httpx.AsyncClient, endpoint: str, url_factory, args, server_pid: int | None) -> dict:
+    """1エンドポイント分の負荷をかけ、レイテンシ・スループット・メモリ使用量を返す。"""
+    for _ in range(args.warmup):
+        await client.get(url_factory())
+
+    latencies, sizes, queries = [], [], []
+    errors = 0
+    rss_samples = []
+    rss_start = _process_tree_rss_mb(server_pid) if server_pid else None
+    stop_at = time.perf_counter() + args.duration
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() < stop_at:
+            started = time.perf_counter()
+            try:
+                response = await client.get(url_factory())
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                errors += 1
+                continue
+            sizes.append(len(response.content))
+            if "x-db-query-count" in response.headers:
+                queries.append(int(response.headers["x-db-query-count"]))
+
+    async def sample_rss():
+        while time.perf_counter() < stop_at:
+            rss = _process_tree_rss_mb(server_pid)
+            if rss is not None:
+                rss_samples.append(rss)
+            await asyncio.sleep(RSS_SAMPLE_INTERVAL)
+
+    started = time.perf_counter()
+    tasks = [worker() for _ in range(args.concurrency)]
+    if server_pid:
+        tasks.append(sample_rss())
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    latencies_ms = np.array(latencies) * 1000
+    percentiles = np.percentile(latencies_ms, [50, 95, 99]) if len(latencies_ms) else [None] * 3
+    return {
+        "endpoint": endpoint,
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+        "latency_ms": {
+            "p50": round(float(percentiles[0]), 2) if len(latencies_ms) else None,
+            "p95": round(float(percentiles[1]), 2) if len(latencies_ms) else None,
+            "p99": round(float(percentiles[2]), 2) if len(latencies_ms) else None,
+            "max": round(float(latencies_ms.max()), 2) if len(latencies_ms) else None,
+            "mean": round(float(latencies_ms.mean()), 2) if len(latencies_ms) else None,
+        },
+        "response_kb_mean": round(float(np.mean(sizes)) / 1024, 1) if sizes else None,
+        "db_queries_mean": round(float(np.mean(queries)), 2) if queries else None,
+        "rss_mb": {
+            "start": rss_start,
+            "peak": max(rss_samples) if rss_samples else None,
+            "end": _process_tree_rss_mb(server_pid) if server_pid else None,
+        },
+    }
+
+
+async def run_load_test(args, base_url: str, targets: list, server_pid: int | None) -> list:
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    results = []
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+        for endpoint in args.endpoints:
+            print(f"[load] {endpoint}: 同時 {args.concurrency} クライアントで {args.duration} 秒間実行中...", flush=True)
+            result = await run_endpoint(client, endpoint, make_url_factory(endpoint, targets, rng, args.cluster_limit), args, server_pid)
+            latency = result["latency_ms"]
+            print(
+                f"[load] {endpoint}: {result['requests']} 件 (エラー {result['errors']} 件), {result['throughput_rps']} 件/秒, "
+                f"p50 {latency['p50']} ms / p95 {latency['p95']} ms / p99 {latency['p99']} ms, "
+                f"クエリ {result['db_queries_mean']} 回/件, RSS ピーク {result['rss_mb']['peak']} MB",
+                flush=True,
+            )
+            results.append(result)
+    return results
+
+
+def _wait_for_server(url: str, timeout: float = 60.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"アプリのサーバーが起動しませんでした: {url}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="読み取りAPI (履歴一覧・時系列・分析結果・クラスタ詳細) の負荷試験")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL") or f"sqlite:///{os.path.join(REPO_ROOT, 'benchmarks', 'results', 'history.db')}",
+                        help="benchmarks.seed_history で作成したDB")
+    parser.add_argument("--url", help="起動済みのサーバーのURL (指定しない場合はこのスクリプトが uvicorn を起動する)")
+    parser.add_argument("--port", type=int, default=8770, help="起動する uvicorn のポート")
+    parser.add_argument("--workers", type=int, default=1, help="起動する uvicorn のワーカー数")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help=f"カンマ区切りのエンドポイント ({', '.join(ENDPOINTS)})")
+    parser.add_argument("--concurrency", type=int, default=16, help="同時に送るクライアント数")
+    parser.add_argument("--duration", type=float, default=10.0, help="エンドポイントごとの実行時間 (秒)")
+    parser.add_argument("--warmup", type=int, default=10, help="計測前に送るリクエスト数")
+    parser.add_argument("--timeout", type=float, default=60.0, help="1リクエストのタイムアウト (秒)")
+    parser.add_argument("--sample-sessions", type=int, default=200, help="リクエストに使うセッション数 (ランダムに選ぶ)")
+    parser.add_argument("--cluster-limit", type=int, default=50, help="クラスタ詳細の1ページあたりのコメント数")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=os.path.join(REPO_ROOT, "benchmarks", "results", "read_api.json"))
+    args = parser.parse_args()
+    args.endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    unknown = set(args.endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"不明なエンドポイント: {', '.join(sorted(unknown))}")
+
+    targets = load_targets(args.database_url, args.sample_sessions, args.seed)
+
+    server = None
+    base_url = args.url
+    if base_url is None:
+        base_url = f"http://127.0.0.1:{args.port}"
+        env = dict(os.environ, DATABASE_URL=args.database_url, DEBUG="true")  # DEBUG ではリクエストごとのクエリ数がヘッダーで返る
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(args.port), "--workers", str(args.workers), "--log-level", "warning"],
+            cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+    try:
+        _wait_for_server(base_url + "/api/analysis_sessions")
+        results = asyncio.run(run_load_test(args, base_url, targets, server.pid if server else None))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "revision": _git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "database": args.database_url.split("://", 1)[0],
+            "workers": args.workers if server else None,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "sample_sessions": len(targets),
+            "cluster_limit": args.cluster_limit,
+        },
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"[load] 結果を {args.output} に保存しました。")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+/upload パイプラインのオフラインベンチマーク。
+
+make_data.py のテンプレートから 1k / 10k / 100k 件の合成コーパスを作り、
+ローカルの疑似Groqサーバー (benchmarks/fake_groq.py) に対して /upload パイプライン全体を実行する。
+サイズごとに別プロセス・別DBで実行し、ステージ別の処理時間、スループット、ピークRSS、
+DBクエリ数、LLM呼び出し数をJSONファイルに保存する (バージョン間の性能比較用)。
+
+使い方:
+    python -m benchmarks.run_pipeline --sizes 1000,10000,100000 --latency-ms 200 --error-rate 0.01
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def _wait_for_server(url: str, timeout: float = 30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return
+        except urllib.error.HTTPError:
+            # 404/405 でもサーバーは起動している
+            return
+        except Exception:
+            time.sleep(0.2)
+    raise RuntimeError(f"疑似Groqサーバーが起動しませんでした: {url}")
+
+
+def run_worker(size: int, seed: int) -> dict:
+    """
+    1サイズ分のベンチマークを実行する (子プロセス内で呼ばれる)。
+    app の設定はインポート時に環境変数から読み込まれるため、親プロセスが環境変数を設定してから起動する。
+    """
+    from fastapi.testclient import TestClient
+
+    from make_data import generate_comments
+
+    import app.main as app_main
+    from app import metrics
+    from app.models import AnalysisSession
+
+    df = generate_comments(size, seed=seed)
+    csv_bytes = df.to_csv(index=False, header=["comment_text"]).encode("utf-8")
+
+    with TestClient(app_main.app) as client:
+        started = time.perf_counter()
+        response = client.post("/upload", files={"file": (f"bench_{size}.csv", csv_bytes, "text/csv")}, follow_redirects=False)
+        wall_seconds = time.perf_counter() - started
+        if response.status_code != 303:
+            raise RuntimeError(f"/upload が失敗しました: {response.status_code} {response.text[:500]}")
+        # DEBUG=true で起動しているため、/upload リクエスト中のクエリ数がヘッダーで返る
+        queries = int(response.headers["X-DB-Query-Count"])
+
+        db = app_main.SessionLocal()
+        try:
+            analysis_session = db.query(AnalysisSession).order_by(AnalysisSession.id.desc()).first()
+            stage_timings = analysis_session.stage_timings
+            label_agreement = analysis_session.label_agreement
+        finally:
+            db.close()
+
+    # Linux の ru_maxrss は KB 単位 (macOS はバイト単位)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = max_rss / 1024 / 1024 if sys.platform == "darwin" else max_rss / 1024
+
+    return {
+        "size": size,
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_comments_per_second": round(size / wall_seconds, 2) if wall_seconds > 0 else None,
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "db_queries": queries,
+        "stage_timings": stage_timings,
+        "label_agreement": label_agreement,
+        "metrics": metrics.snapshot(),
+    }
+
+
+def run_benchmark(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="comment-bench-")
+    fake_server_url = f"http://127.0.0.1:{args.port}"
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "benchmarks.fake_groq",
+            "--port", str(args.port),
+            "--latency-ms", str(args.latency_ms),
+            "--jitter-ms", str(args.jitter_ms),
+            "--error-rate", str(args.error_rate),
+            "--rate-limit-rate", str(args.rate_limit_rate),
+        ],
+        cwd=REPO_ROOT,
+    )
+    results = []
+    try:
+        _wait_for_server(fake_server_url + "/v1/chat/completions")
+        for size in args.sizes:
+            print(f"[benchmark] {size} 件のコーパスで実行中...", flush=True)
+            env = dict(
+                os.environ,
+                DATABASE_URL=f"sqlite:///{os.path.join(workdir, f'bench_{size}.db')}",
+                UPLOAD_DIR=os.path.join(workdir, "uploads"),
+                GROQ_API_KEY="benchmark",
+                GROQ_BASE_URL=fake_server_url,
+                LLM_REQUEST_INTERVAL="0",
+                LLM_PARSE_RETRY_WAIT="0",
+                LLM_ERROR_RETRY_WAIT="0",
+                DEDUP_ENABLED="false" if args.no_dedup else "true",
+                PIPELINE_MODE=args.pipeline_mode,
+                DEBUG="true",
+            )
+            completed = subprocess.run(
+                [sys.executable, "-m", "benchmarks.run_pipeline", "--worker", "--size", str(size), "--seed", str(args.seed)],
+                cwd=REPO_ROOT, env=env, capture_output=True, text=True,
+            )
+            if completed.returncode != 0:
+                print(completed.stderr[-3000:], file=sys.stderr)
+                results.append({"size": size, "error": f"worker exited with {completed.returncode}"})
+                continue
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            print(f"[benchmark] {size} 件: {result['wall_seconds']} 秒, {result['throughput_comments_per_second']} 件/秒, "
+                  f"ピークRSS {result['peak_rss_mb']} MB, クエリ {result['db_queries']} 回", flush=True)
+            results.append(result)
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        "revision": _git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "sizes": args.sizes,
+            "seed": args.seed,
+            "latency_ms": args.latency_ms,
+            "jitter_ms": args.jitter_ms,
+            "error_rate": args.error_rate,
+            "rate_limit_rate": args.rate_limit_rate,
+            "dedup": not args.no_dedup,
+            "pipeline_mode": args.pipeline_mode,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/upload パイプラインのオフラインベンチマーク")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="カンマ区切りのコーパスサイズ")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--port", type=int, default=8765, help="疑似Groqサーバーのポート")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--no-dedup", action="store_true", help="重複コメントの集約を無効にして実行する")
+    parser.add_argument("--pipeline-mode", default="label_first", choices=["label_first", "cluster_first"])
+    parser.add_argument("--output", default=os.path.join(REPO_ROOT, "benchmarks", "results", "pipeline.json"))
+    # 子プロセス用 (1サイズ分を実行して結果JSONを標準出力に書く)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.size, args.seed), ensure_ascii=False))
+        return
+
+    args.sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    report = run_benchmark(args)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"[benchmark] 結果を {args.output} に保存しました。")
+    # 失敗したサイズがあれば CI のビルドを失敗させる (結果のJSONは失敗の記録として残す)
+    failed = [result["size"] for result in report["results"] if "error" in result]
+    if failed:
+        print(f"[benchmark] 失敗したサイズ: {failed}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+読み取りAPIの負荷試験用に、何年分もの分析履歴を持つ合成データベースを作る。
+
+make_data.py のテンプレートから、セッションごとに指定件数のコメント (カテゴリ・感情・危険性・タグ・クラスタID・重要度・埋め込み) を作り、
+クラスタ別集計・ランキング・PN比グラフ・集計値は分析パイプラインと同じ関数で作成する。
+PN比グラフ (Base64のPNG) は描画に時間がかかるため、最初の --render-charts 件のセッションだけ描画し、残りのセッションでは使い回す
+(画像のサイズは実際の分析結果と同じになる)。
+
+使い方:
+    python -m benchmarks.seed_history --sessions 500 --comments 1000 --years 3 --database-url sqlite:///history.db
+    python -m benchmarks.load_test --database-url sqlite:///history.db
+"""
+import argparse
+import asyncio
+import logging
+import os
+import pickle
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 合成データのセッションの batch_id (コメントはセッションごとに Comment.session_id で分ける)
+SEED_BATCH_ID = "seed-history"
+# all-MiniLM-L6-v2 の次元数
+EMBEDDING_DIM = 384
+# コメントをまとめて INSERT する件数
+INSERT_CHUNK_SIZE = 5000
+
+
+def _template_vectors(templates: list, rng: np.random.Generator) -> np.ndarray:
+    # テンプレートごとの埋め込みの基準ベクトル (同じテンプレートのコメントは近いベクトルになる)
+    return rng.normal(size=(len(templates), EMBEDDING_DIM)).astype(np.float32)
+
+
+def _comment_rows(session_id: int, count: int, templates: list, vectors: np.ndarray, clusters: list, rng: random.Random,
+                  np_rng: np.random.Generator, embeddings: bool) -> list:
+    from app.scoring import importance_from_tags
+
+    rows = []
+    noise = np_rng.normal(scale=0.1, size=(count, EMBEDDING_DIM)).astype(np.float32) if embeddings else None
+    for i in range(count):
+        index = rng.randrange(len(templates))
+        template = templates[index]
+        tags = dict(template["tags"])
+        category = template["category"] if template["category"] in ("講義内容", "授業資料", "運営") else "その他"
+        rows.append({
+            "text": template["text"] if rng.random() < 0.7 else f"{template['text']} ({rng.randrange(10000)})",
+            "category": category,
+            "danger": bool(template.get("danger")),
+            "sentiment": template["sentiment"],
+            "tags": tags,
+            # 約1割をノイズ (-1) にし、残りはテンプレートごとのクラスタにする
+            "cluster_id": -1 if rng.random() < 0.1 else clusters[index],
+            "importance_score": importance_from_tags(tags),
+            "embedding": pickle.dumps(vectors[index] + noise[i]) if embeddings else None,
+            "label_state": "done",
+            "label_attempts": 1,
+            "label_provider": "seed",
+            "duplicate_count": 1,
+            "session_id": session_id,
+            "ingest_session_id": session_id,
+        })
+    return rows
+
+
+def seed(args):
+    from sqlalchemy import insert
+
+    from make_data import comment_templates
+    from app.config import engine, SessionLocal
+    from app.models import Base, Comment, AnalysisSession, upgrade_schema
+    from app.scoring import calculate_cluster_stats
+    from app.analyze import generate_pn_charts, get_top_clusters_and_comments, count_sentiments, summary_inputs
+
+    Base.metadata.create_all(bind=engine)
+    upgrade_schema(engine)
+    # パイプラインの関数がクラスタごとに出す INFO ログを抑える (進捗はこのスクリプトが表示する)
+    logging.disable(logging.INFO)
+
+    rng = random.Random(args.seed)
+    np_rng = np.random.default_rng(args.seed)
+    vectors = _template_vectors(comment_templates, np_rng)
+    # テンプレートをクラスタに割り当てる (1クラスタあたり数テンプレート)
+    clusters = [i % args.clusters for i in range(len(comment_templates))]
+    rng.shuffle(clusters)
+
+    now = datetime.now()
+    start = now - timedelta(days=365 * args.years)
+    step = (now - start) / max(args.sessions, 1)
+    rendered_charts = []
+    started = time.perf_counter()
+
+    db = SessionLocal()
+    try:
+        for n in range(args.sessions):
+            analysis_session = AnalysisSession(
+                csv_filename=f"lecture_{n + 1:05d}.csv",
+                created_at=start + step * n,
+                status="running",
+                batch_id=SEED_BATCH_ID,
+            )
+            db.add(analysis_session)
+            db.commit()
+            session_id = analysis_session.id
+
+            rows = _comment_rows(session_id, args.comments, comment_templates, vectors, clusters, rng, np_rng, not args.no_embeddings)
+            for offset in range(0, len(rows), INSERT_CHUNK_SIZE):
+                db.execute(insert(Comment), rows[offset:offset + INSERT_CHUNK_SIZE])
+            db.commit()
+
+            # クラスタ別集計・ランキング・集計値はパイプラインと同じ関数で作る
+            calculate_cluster_stats(db, session_id)
+            db.commit()
+            if len(rendered_charts) < args.render_charts:
+                rendered_charts.append(generate_pn_charts(db, session_id))
+            charts = rendered_charts[n % len(rendered_charts)] if rendered_charts else {"total_pn_chart": "", "category_pn_charts": {}}
+            top_clusters = asyncio.run(get_top_clusters_and_comments(db, session_id=session_id))
+            overall, categories = count_sentiments(db, session_id)
+            total = overall["total"]
+
+            analysis_session.total_comments = total
+            analysis_session.total_pn_chart_base64 = charts["total_pn_chart"]
+            analysis_session.category_pn_charts_base64 = charts["category_pn_charts"]
+            analysis_session.top_clusters_data = top_clusters
+            analysis_session.overall_positive_percent = overall["positive"] / total * 100 if total else 0.0
+            analysis_session.overall_negative_percent = overall["negative"] / total * 100 if total else 0.0
+            analysis_session.category_sentiment_percents = {
+                category: counts["positive"] / counts["total"] * 100 if counts["total"] else 0.0 for category, counts in categories.items()
+            }
+            analysis_session.dangerous_comment_count = sum(1 for r in rows if r["danger"])
+            analysis_session.summary_inputs = summary_inputs(overall, categories, top_clusters)
+            analysis_session.stage_timings = {"total_seconds": 0.0, "stages": {}, "counters": {}}
+            analysis_session.status = "done"
+            db.commit()
+
+            if (n + 1) % max(args.sessions // 20, 1) == 0 or n + 1 == args.sessions:
+                elapsed = time.perf_counter() - started
+                print(f"[seed] {n + 1}/{args.sessions} セッション ({(n + 1) * args.comments} 件のコメント、{elapsed:.1f} 秒)", flush=True)
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="読み取りAPIの負荷試験用に、合成の分析履歴を持つデータベースを作る")
+    parser.add_argument("--database-url", default=None, help="作成先のDB (既定は環境変数 DATABASE_URL、なければ sqlite:///benchmarks/results/history.db)")
+    parser.add_argument("--sessions", type=int, default=200, help="分析セッション数")
+    parser.add_argument("--comments", type=int, default=1000, help="1セッションあたりのコメント数")
+    parser.add_argument("--years", type=float, default=3.0, help="セッションの作成日時を分散させる期間 (年)")
+    parser.add_argument("--clusters", type=int, default=12, help="1セッションあたりのクラスタ数 (ノイズを除く)")
+    parser.add_argument("--render-charts", type=int, default=5, help="PN比グラフを実際に描画するセッション数 (残りは使い回す)")
+    parser.add_argument("--no-embeddings", action="store_true", help="コメントの埋め込みベクトルを保存しない")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    # app の設定はインポート時に環境変数から読み込まれるため、app をインポートする前に設定する
+    database_url = args.database_url or os.getenv("DATABASE_URL") or f"sqlite:///{os.path.join(REPO_ROOT, 'benchmarks', 'results', 'history.db')}"
+    if database_url.startswith("sqlite:///"):
+        os.makedirs(os.path.dirname(os.path.abspath(database_url[len("sqlite:///"):])), exist_ok=True)
+    os.environ["DATABASE_URL"] = database_url
+    sys.path.insert(0, REPO_ROOT)
+
+    seed(args)
+    print(f"[seed] {database_url} に {args.sessions} セッション × {args.comments} 件のコメントを作成しました。")
+
+
+if __name__ == "__main__":
+    main()
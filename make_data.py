@@ -168,43 +168,54 @@ comment_templates = [
     {"text": "ネットワーク環境が安定しており、快適に受講できました。", "category": "インフラ", "sentiment": 1, "tags": {"質問":0, "具体的":0, "インフラ":0, "緊急性":0}},
 ]
 
-# 重複を避けるために、一度使用したコメントはリストから削除
-unique_comments_data = []
-# 危険コメントはランダムにいくつか混ぜる
-danger_comments = [t for t in comment_templates if t.get("danger")]
-safe_comments = [t for t in comment_templates if not t.get("danger")]
+def generate_comments(num_comments=100, num_danger=5, seed=None):
+    """
+    テンプレートからコメントを num_comments 件生成し、comment_text 列の DataFrame を返す。
+    ベンチマーク (benchmarks/) からも合成コーパスの生成に利用する。
+    """
+    rng = random.Random(seed)
 
-# 危険コメントを数個選ぶ (例: 5個)
-selected_danger_comments = random.sample(danger_comments, min(5, len(danger_comments)))
-unique_comments_data.extend(selected_danger_comments)
+    # 重複を避けるために、一度使用したコメントはリストから削除
+    unique_comments_data = []
+    # 危険コメントはランダムにいくつか混ぜる
+    danger_comments = [t for t in comment_templates if t.get("danger")]
+    safe_comments = [t for t in comment_templates if not t.get("danger")]
 
-# 残りの安全なコメントから重複なく選ぶ
-num_safe_to_select = 100 - len(selected_danger_comments)
-selected_safe_comments = random.sample(safe_comments, min(num_safe_to_select, len(safe_comments)))
-unique_comments_data.extend(selected_safe_comments)
+    # 危険コメントを数個選ぶ (例: 5個)
+    selected_danger_comments = rng.sample(danger_comments, min(num_danger, len(danger_comments)))
+    unique_comments_data.extend(selected_danger_comments)
 
-# 最終的に100件になるように調整 (テンプレートが足りない場合はループで回す)
-final_comments = []
-comment_id = 1
-while len(final_comments) < 100:
-    temp_comment = random.choice(unique_comments_data) # 選んだコメントの中からさらにランダムに
-    text_variant = temp_comment["text"]
+    # 残りの安全なコメントから重複なく選ぶ
+    num_safe_to_select = max(num_comments - len(selected_danger_comments), 0)
+    selected_safe_comments = rng.sample(safe_comments, min(num_safe_to_select, len(safe_comments)))
+    unique_comments_data.extend(selected_safe_comments)
 
-    # ユニークなコメントにするためのバリエーションを追加
-    # ランダムな数字とIDを追加して、必ずユニークになるようにする
-    variant_suffixes = ["。", "。", "。", "。", "ですね。", "と思います。", "と感じました。", "です。", "でした。"]
-    additional_text = f" (コメントID: {comment_id}, {random.randint(1000, 9999)})"
-    
-    final_comments.append({"comment_text": text_variant + random.choice(variant_suffixes) + additional_text})
-    comment_id += 1
+    # 最終的に num_comments 件になるように調整 (テンプレートが足りない場合はループで回す)
+    final_comments = []
+    comment_id = 1
+    while len(final_comments) < num_comments:
+        temp_comment = rng.choice(unique_comments_data) # 選んだコメントの中からさらにランダムに
+        text_variant = temp_comment["text"]
 
-# pandas DataFrame に変換
-df_comments = pd.DataFrame(final_comments)
+        # ユニークなコメントにするためのバリエーションを追加
+        # ランダムな数字とIDを追加して、必ずユニークになるようにする
+        variant_suffixes = ["。", "。", "。", "。", "ですね。", "と思います。", "と感じました。", "です。", "でした。"]
+        additional_text = f" (コメントID: {comment_id}, {rng.randint(1000, 9999)})"
 
-# CSVとしてエクスポート
-csv_file_path = "unique_100_comments.csv"
-df_comments.to_csv(csv_file_path, index=False, header=False, encoding='utf-8-sig')
+        final_comments.append({"comment_text": text_variant + rng.choice(variant_suffixes) + additional_text})
+        comment_id += 1
 
-print(f"CSVファイル '{csv_file_path}' を生成しました。")
-print("ファイルの内容の一部:")
-print(df_comments.head())
\ No newline at end of file
+    # pandas DataFrame に変換
+    return pd.DataFrame(final_comments)
+
+
+if __name__ == "__main__":
+    df_comments = generate_comments(100)
+
+    # CSVとしてエクスポート
+    csv_file_path = "unique_100_comments.csv"
+    df_comments.to_csv(csv_file_path, index=False, header=False, encoding='utf-8-sig')
+
+    print(f"CSVファイル '{csv_file_path}' を生成しました。")
+    print("ファイルの内容の一部:")
+    print(df_comments.head())
@@ -91,21 +91,48 @@ const ImportanceRanking = ({ clusters, onClusterClick }) => {
     );
 };
 
-const CommentDetailsModal = ({ show, onClose, clusterDetails }) => {
+const CommentDetailsModal = ({ show, onClose, clusterDetails, filters, onFilterChange, onLoadMore, loadingMore }) => {
     if (!show || !clusterDetails) return null;
 
+    // モーダル本文を末尾近くまでスクロールしたら次のページを読み込む
+    const handleScroll = (e) => {
+        const el = e.currentTarget;
+        if (el.scrollTop + el.clientHeight >= el.scrollHeight - 100 && clusterDetails.next_cursor && !loadingMore) {
+            onLoadMore();
+        }
+    };
+
     return (
         <div className={`modal fade ${show ? 'show d-block' : ''}`} tabIndex="-1" role="dialog" style={{backgroundColor: 'rgba(0,0,0,0.5)'}}>
-            <div className="modal-dialog modal-lg" role="document">
+            <div className="modal-dialog modal-lg modal-dialog-scrollable" role="document">
                 <div className="modal-content">
                     <div className="modal-header">
                         <h5 className="modal-title">クラスタID: {clusterDetails.cluster_id} のコメント詳細</h5>
                         <button type="button" className="btn-close" onClick={onClose}></button>
                     </div>
-                    <div className="modal-body">
+                    <div className="modal-body" onScroll={handleScroll}>
                         <h6>代表コメント:</h6>
                         <p>{clusterDetails.representative_text}</p>
-                        <h6>構成コメント ({clusterDetails.comments.length}件):</h6>
+                        <div className="d-flex gap-2 mb-3">
+                            <select className="form-select form-select-sm" value={filters.category} onChange={(e) => onFilterChange({...filters, category: e.target.value})}>
+                                <option value="">カテゴリ: すべて</option>
+                                <option value="講義内容">講義内容</option>
+                                <option value="授業資料">授業資料</option>
+                                <option value="運営">運営</option>
+                                <option value="その他">その他</option>
+                            </select>
+                            <select className="form-select form-select-sm" value={filters.sentiment} onChange={(e) => onFilterChange({...filters, sentiment: e.target.value})}>
+                                <option value="">感情: すべて</option>
+                                <option value="1">Positive</option>
+                                <option value="0">Negative</option>
+                            </select>
+                            <select className="form-select form-select-sm" value={filters.danger} onChange={(e) => onFilterChange({...filters, danger: e.target.value})}>
+                                <option value="">危険性: すべて</option>
+                                <option value="true">Yes</option>
+                                <option value="false">No</option>
+                            </select>
+                        </div>
+                        <h6>構成コメント ({clusterDetails.total_count ?? clusterDetails.comments.length}件):</h6>
                         <ul className="list-unstyled">
                             {clusterDetails.comments.map(comment => (
                                 <li key={comment.id} className="border p-2 mb-2 rounded">
@@ -120,6 +147,11 @@ const CommentDetailsModal = ({ show, onClose, clusterDetails }) => {
                                 </li>
                             ))}
                         </ul>
+                        {loadingMore && (
+                            <div className="text-center my-2">
+                                <div className="spinner-border spinner-border-sm" role="status"></div>
+                            </div>
+                        )}
                     </div>
                     <div className="modal-footer">
                         <button type="button" className="btn btn-secondary" onClick={onClose}>閉じる</button>
@@ -284,7 +316,7 @@ const HomePage = ({ loadingAnalysis, timeSeriesData }) => { // loadingUpload, up
 };
 
 // -- 分析結果表示ページ (AnalysisPage) --
-const AnalysisPage = ({ loadingAnalysis, pnCharts, topClusters, aiAnalysisComment, onClusterClick, activeContent, setActiveContent, currentSessionId }) => {
+const AnalysisPage = ({ loadingAnalysis, pnCharts, topClusters, aiAnalysisComment, streamingAiComment, onClusterClick, activeContent, setActiveContent, currentSessionId }) => {
     // 表示するコンテンツの切り替えボタン
     // Sidebarではなく、このページ内にタブとして配置
     const getAnalysisPageTitle = () => {
@@ -360,10 +392,13 @@ const AnalysisPage = ({ loadingAnalysis, pnCharts, topClusters, aiAnalysisCommen
                             <div className="card analysis-comment-container">
                                 <div className="card-header">
                                     AI分析コメント
+                                    {streamingAiComment && <span className="spinner-border spinner-border-sm ms-2" role="status" aria-hidden="true"></span>}
                                 </div>
                                 <div className="card-body">
                                     {aiAnalysisComment ? (
                                         <p style={{ whiteSpace: 'pre-wrap' }}>{aiAnalysisComment}</p>
+                                    ) : streamingAiComment ? (
+                                        <div className="text-muted">AI分析コメントを生成中...</div>
                                     ) : (
                                         <div className="alert alert-info">AI分析コメントがありません。</div>
                                     )}
@@ -404,7 +439,9 @@ const HistoryPage = ({ loadingHistory, analysisSessions, onSessionClick }) => {
                             <h5>{formatDateTime(session.created_at)} - {session.csv_filename}</h5>
                             <small className="text-muted">
                                 コメント総数: {session.total_comments}件 / 
-                                P: {session.overall_positive_percent}% / 
+                                P: {session.overall_positive_percent}%{session.approximation && !session.approximation.refined && session.approximation.overall.positive && (
+                                    ` (推定 ${session.approximation.overall.positive.low}〜${session.approximation.overall.positive.high}%)`
+                                )} / 
                                 N: {session.overall_negative_percent}% / 
                                 危険コメント: {session.dangerous_comment_count}件
                             </small>
@@ -418,6 +455,247 @@ const HistoryPage = ({ loadingHistory, analysisSessions, onSessionClick }) => {
 };
 
 
+// -- 新規コンポーネント: ライブページ (授業中のコメントの逐次分析) --
+// WebSocket (/ws/live/{id}) で受け付け・ラベル付けのたびに送られる集計値とコメントを表示する
+const LIVE_RECENT_LIMIT = 50;
+
+// 直近のコメント一覧 (新しい順) に、受け付けた・分析済みのコメントを反映する
+const mergeLiveComments = (recent, comments) => {
+    const updated = new Map(comments.map(c => [c.id, c]));
+    const merged = recent.map(c => updated.has(c.id) ? updated.get(c.id) : c);
+    const known = new Set(recent.map(c => c.id));
+    const added = comments.filter(c => !known.has(c.id)).reverse();
+    return [...added, ...merged].slice(0, LIVE_RECENT_LIMIT);
+};
+
+const LivePage = ({ onEnded }) => {
+    const [liveSessions, setLiveSessions] = useState([]);
+    const [title, setTitle] = useState('');
+    const [liveSessionId, setLiveSessionId] = useState(null);
+    const [live, setLive] = useState(null); // {title, counters, clusters, recent}
+    const [connected, setConnected] = useState(false);
+    const [commentText, setCommentText] = useState('');
+    const [ending, setEnding] = useState(false);
+    const [liveError, setLiveError] = useState('');
+    const socketRef = React.useRef(null);
+    const endedRef = React.useRef(false); // 終了の通知 (WebSocket と終了APIのレスポンス) を1回だけ扱う
+
+    const finish = (sessionId) => {
+        if (endedRef.current) return;
+        endedRef.current = true;
+        onEnded(sessionId);
+    };
+
+    const fetchLiveSessions = useCallback(async () => {
+        try {
+            const response = await fetch('/api/live/sessions');
+            if (!response.ok) throw new Error('ライブセッションの取得に失敗しました。');
+            setLiveSessions(await response.json());
+        } catch (error) {
+            console.error('Error fetching live sessions:', error);
+            setLiveError(error.message);
+        }
+    }, []);
+
+    useEffect(() => { fetchLiveSessions(); }, [fetchLiveSessions]);
+
+    // セッションを選ぶと WebSocket に接続し、届いたメッセージで表示を更新する
+    useEffect(() => {
+        if (!liveSessionId) return;
+        const protocol = window.location.protocol === 'https:' ? 'wss' : 'ws';
+        const socket = new WebSocket(`${protocol}://${window.location.host}/ws/live/${liveSessionId}`);
+        socketRef.current = socket;
+        socket.onopen = () => setConnected(true);
+        socket.onclose = () => setConnected(false);
+        socket.onmessage = (event) => {
+            const message = JSON.parse(event.data);
+            if (message.type === 'snapshot') {
+                setLive({title: message.title, counters: message.counters, clusters: message.clusters, recent: [...message.recent].reverse()});
+            } else if (message.type === 'received') {
+                setLive(prev => prev && ({...prev, counters: message.counters, recent: mergeLiveComments(prev.recent, message.comments)}));
+            } else if (message.type === 'labeled') {
+                setLive(prev => prev && ({...prev, counters: message.counters, clusters: message.clusters, recent: mergeLiveComments(prev.recent, message.comments)}));
+            } else if (message.type === 'ended') {
+                finish(message.session_id);
+            } else if (message.type === 'error') {
+                setLiveError(message.detail);
+            }
+        };
+        return () => {
+            socket.close();
+            if (socketRef.current === socket) socketRef.current = null;
+        };
+    }, [liveSessionId]);
+
+    const handleCreate = async (event) => {
+        event.preventDefault();
+        try {
+            const response = await fetch('/api/live/sessions', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({title: title || null}),
+            });
+            if (!response.ok) throw new Error('ライブセッションの開始に失敗しました。');
+            const data = await response.json();
+            setLiveError('');
+            setLiveSessionId(data.session_id);
+        } catch (error) {
+            console.error('Error creating live session:', error);
+            setLiveError(error.message);
+        }
+    };
+
+    const handleSendComment = (event) => {
+        event.preventDefault();
+        if (!commentText.trim() || !socketRef.current || socketRef.current.readyState !== WebSocket.OPEN) return;
+        socketRef.current.send(JSON.stringify({text: commentText}));
+        setCommentText('');
+    };
+
+    const handleEnd = async () => {
+        setEnding(true);
+        try {
+            const response = await fetch(`/api/live/${liveSessionId}/end`, {method: 'POST'});
+            if (!response.ok) {
+                const errorData = await response.json();
+                throw new Error(errorData.detail || 'ライブセッションの終了に失敗しました。');
+            }
+            const data = await response.json();
+            finish(data.session_id);
+        } catch (error) {
+            console.error('Error ending live session:', error);
+            setLiveError(error.message);
+        } finally {
+            setEnding(false);
+        }
+    };
+
+    if (!liveSessionId) {
+        return (
+            <div className="history-list-container">
+                <h2 className="section-header">ライブ分析</h2>
+                {liveError && <div className="alert alert-danger">{liveError}</div>}
+                <form className="d-flex gap-2 mb-4" onSubmit={handleCreate}>
+                    <input type="text" className="form-control" placeholder="講義名 (省略可)" value={title} onChange={(e) => setTitle(e.target.value)} />
+                    <button type="submit" className="btn btn-primary text-nowrap">ライブ分析を開始</button>
+                </form>
+                <h5>受付中のセッション</h5>
+                {liveSessions.length === 0 ? (
+                    <div className="alert alert-info">受付中のライブセッションはありません。</div>
+                ) : (
+                    <ul className="list-group">
+                        {liveSessions.map(s => (
+                            <li key={s.session_id} className="list-group-item d-flex justify-content-between align-items-center history-list-item" onClick={() => setLiveSessionId(s.session_id)}>
+                                <div>{s.title} <small className="text-muted">({formatDateTime(s.created_at)})</small></div>
+                                <span className="badge bg-primary rounded-pill">表示する</span>
+                            </li>
+                        ))}
+                    </ul>
+                )}
+            </div>
+        );
+    }
+
+    const counters = live ? live.counters : null;
+    return (
+        <div>
+            <div className="d-flex justify-content-between align-items-center section-header">
+                <h2 className="mb-0">
+                    {live ? live.title : 'ライブ分析'}
+                    <span className={`badge ms-2 ${connected ? 'bg-success' : 'bg-secondary'}`} style={{fontSize: '0.8rem'}}>{connected ? '接続中' : '未接続'}</span>
+                </h2>
+                <button className="btn btn-outline-danger" onClick={handleEnd} disabled={ending}>
+                    {ending ? <><span className="spinner-border spinner-border-sm me-2" role="status" aria-hidden="true"></span>分析中...</> : '受付を終了して分析'}
+                </button>
+            </div>
+            {liveError && <div className="alert alert-danger">{liveError}</div>}
+            {counters && (
+                <div className="row g-3 mb-3">
+                    {[
+                        ['受付', counters.received, `未処理 ${counters.pending} / 失敗 ${counters.failed}`, ''],
+                        ['ポジティブ率', counters.positive_percent !== null ? `${counters.positive_percent}%` : '-', `P ${counters.positive} / N ${counters.negative}`, ''],
+                        ['緊急', counters.urgent, '緊急性が高いコメント', counters.urgent > 0 ? 'border-danger text-danger' : ''],
+                        ['危険', counters.danger, '不適切な内容のコメント', counters.danger > 0 ? 'border-warning' : ''],
+                    ].map(([label, value, note, extra]) => (
+                        <div className="col-md-3" key={label}>
+                            <div className={`card h-100 ${extra}`}>
+                                <div className="card-body">
+                                    <div className="text-muted small">{label}</div>
+                                    <div className="fs-3 fw-bold">{value}</div>
+                                    <div className="text-muted small">{note}</div>
+                                </div>
+                            </div>
+                        </div>
+                    ))}
+                </div>
+            )}
+            <div className="row g-3">
+                <div className="col-lg-6">
+                    <div className="card ranking-container">
+                        <div className="card-header">注目のコメント群 (重要度の合計順)</div>
+                        <ul className="list-group list-group-flush">
+                            {live && live.clusters.length > 0 ? live.clusters.map(c => (
+                                <li key={c.cluster_id} className="list-group-item">
+                                    <div className="d-flex justify-content-between">
+                                        <strong>{c.representative_text}</strong>
+                                        <span className="badge bg-secondary align-self-start">{c.size}件</span>
+                                    </div>
+                                    <small className="text-muted">重要度 {c.importance_total.toFixed(1)} / 緊急 {c.urgent} / N {c.negative}</small>
+                                </li>
+                            )) : <li className="list-group-item text-muted">まだコメントがありません。</li>}
+                        </ul>
+                    </div>
+                    {counters && Object.keys(counters.categories).length > 0 && (
+                        <div className="card ranking-container">
+                            <div className="card-header">カテゴリ別</div>
+                            <table className="table table-sm mb-0 comment-table">
+                                <thead><tr><th>カテゴリ</th><th>件数</th><th>P</th><th>N</th></tr></thead>
+                                <tbody>
+                                    {Object.entries(counters.categories).map(([category, counts]) => (
+                                        <tr key={category}><td>{category}</td><td>{counts.total}</td><td>{counts.positive}</td><td>{counts.negative}</td></tr>
+                                    ))}
+                                </tbody>
+                            </table>
+                        </div>
+                    )}
+                </div>
+                <div className="col-lg-6">
+                    <div className="card ranking-container">
+                        <div className="card-header">コメント (新しい順)</div>
+                        <div className="card-body">
+                            <form className="d-flex gap-2 mb-3" onSubmit={handleSendComment}>
+                                <input type="text" className="form-control form-control-sm" placeholder="コメントを送信" value={commentText} onChange={(e) => setCommentText(e.target.value)} disabled={!connected} />
+                                <button type="submit" className="btn btn-sm btn-primary text-nowrap" disabled={!connected}>送信</button>
+                            </form>
+                            <ul className="list-group">
+                                {live && live.recent.map(c => (
+                                    <li key={c.id} className={`list-group-item ${c.urgency >= 2 ? 'list-group-item-danger' : c.danger ? 'list-group-item-warning' : ''}`}>
+                                        {c.text}
+                                        <div>
+                                            {c.state === 'pending' ? (
+                                                <span className="spinner-border spinner-border-sm text-secondary" role="status" aria-hidden="true"></span>
+                                            ) : c.state === 'failed' ? (
+                                                <span className="badge bg-light text-dark">ラベル付け失敗</span>
+                                            ) : (
+                                                <>
+                                                    <span className="badge bg-secondary tag-badge">{c.category}</span>
+                                                    <span className={`badge tag-badge ${c.sentiment === 1 ? 'bg-success' : 'bg-danger'}`}>{c.sentiment === 1 ? 'Positive' : 'Negative'}</span>
+                                                    {c.urgency > 0 && <span className="badge bg-warning text-dark tag-badge">緊急性:{c.urgency}</span>}
+                                                </>
+                                            )}
+                                        </div>
+                                    </li>
+                                ))}
+                            </ul>
+                        </div>
+                    </div>
+                </div>
+            </div>
+        </div>
+    );
+};
+
+
 // -- メインアプリケーションコンポーネント (App) --
 const App = () => {
     // 全体的なローディング状態
@@ -429,12 +707,16 @@ const App = () => {
     const [pnCharts, setPnCharts] = useState(null);
     const [topClusters, setTopClusters] = useState([]);
     const [aiAnalysisComment, setAiAnalysisComment] = useState("");
+    const [streamingAiComment, setStreamingAiComment] = useState(false); // AI分析コメントをストリーミング受信中
+    const aiStreamRef = React.useRef(null); // 受信中の EventSource
     const [analysisSessions, setAnalysisSessions] = useState([]); // 分析履歴リスト用ステート
     const [timeSeriesData, setTimeSeriesData] = useState(null); // 時系列データ用ステート
 
     // モーダル関連
     const [selectedClusterDetails, setSelectedClusterDetails] = useState(null);
     const [showModal, setShowModal] = useState(false);
+    const [clusterFilters, setClusterFilters] = useState({category: '', sentiment: '', danger: ''}); // クラスタ詳細の絞り込み条件
+    const [loadingMoreComments, setLoadingMoreComments] = useState(false); // クラスタ詳細の次ページ読み込み中
     
     // UIメッセージ
     const [uploadMessage, setUploadMessage] = useState({status: '', message: ''});
@@ -447,6 +729,39 @@ const App = () => {
     const [activeContent, setActiveContent] = useState('pn_charts'); 
 
     // -- API呼び出し関数 --
+    // AI分析コメントを Server-Sent Events で受信し、生成されたトークンから順に表示する
+    const streamAiAnalysisComment = useCallback((sessionId) => {
+        if (aiStreamRef.current) {
+            aiStreamRef.current.close();
+        }
+        setAiAnalysisComment("");
+        setStreamingAiComment(true);
+
+        const source = new EventSource(`/api/ai_analysis_comment/stream?session_id=${sessionId}`);
+        aiStreamRef.current = source;
+        const finish = () => {
+            source.close();
+            if (aiStreamRef.current === source) {
+                aiStreamRef.current = null;
+            }
+            setStreamingAiComment(false);
+        };
+
+        source.addEventListener('token', (event) => {
+            const data = JSON.parse(event.data);
+            setAiAnalysisComment(prev => prev + data.text);
+        });
+        source.addEventListener('done', finish);
+        // サーバーから送られる error イベントと、接続エラーの両方をここで扱う (自動再接続はさせない)
+        source.addEventListener('error', (event) => {
+            if (event.data) {
+                const data = JSON.parse(event.data);
+                setUploadMessage({status: 'error', message: data.detail || 'AI分析コメントの生成に失敗しました。'});
+            }
+            finish();
+        });
+    }, []);
+
     // 分析結果（PNグラフ、ランキング、AIコメント）をフェッチ
     const fetchAnalysisResults = useCallback(async (sessionId = null) => {
         try {
@@ -469,6 +784,10 @@ const App = () => {
             }
             const aiData = await aiResponse.json();
             setAiAnalysisComment(aiData.comment);
+            // AI分析コメントが未生成のセッションはストリーミングで生成・受信する
+            if (sessionId && !aiData.comment) {
+                streamAiAnalysisComment(sessionId);
+            }
 
         } catch (error) {
             console.error('Error fetching analysis results or AI comment:', error);
@@ -479,7 +798,7 @@ const App = () => {
         } finally {
             setLoadingAnalysis(false);
         }
-    }, []);
+    }, [streamAiAnalysisComment]);
 
     // 分析履歴リストをフェッチ
     const fetchAnalysisSessions = useCallback(async () => {
@@ -534,7 +853,17 @@ const App = () => {
                 body: formData,
             });
 
-            if (response.redirected) {
+            const newSessionId = response.redirected ? new URL(response.url).searchParams.get('session_id') : null;
+            if (newSessionId) {
+                // 作成されたセッションの分析結果を表示し、AI分析コメントはストリーミングで受信する
+                setUploadMessage({status: 'success', message: 'ファイルのアップロードと分析処理が完了しました。AI分析コメントを生成中...'});
+                await fetchTimeSeriesData(); // ホームページ用に時系列データ再フェッチ
+                fetchAnalysisSessions(); // 履歴ページ用に履歴リスト再フェッチ
+                setCurrentSessionId(parseInt(newSessionId));
+                setActiveContent('ai_comment');
+                setPath('/analysis');
+                await fetchAnalysisResults(parseInt(newSessionId));
+            } else if (response.redirected) {
                 setUploadMessage({status: 'success', message: 'ファイルのアップロードと分析処理が完了しました。結果を読み込み中...'});
                 // リダイレクト後はURLが '/' になるので、その後のデータフェッチをトリガー
                 // ホームページと履歴ページの両方のデータを更新する
@@ -561,25 +890,27 @@ const App = () => {
         }
     };
 
-    // クラスタ詳細の取得とモーダル表示
-    const handleClusterClick = async (clusterId) => {
-        try {
-            // ★★★ ここを修正します ★★★
-            // テンプレートリテラルの記述が間違っている可能性
-            // 正しくはバッククォート (`) で囲み、変数を ${変数名} で埋め込みます
-            const url = currentSessionId 
-                ? `/api/cluster_details/${clusterId}?session_id=${currentSessionId}` 
-                : `/api/cluster_details/${clusterId}`;
-            // 以前のコードでは、おそらく `url` の変数定義がバッククォートではなくクォートで囲まれていたため、
-            // 変数の中身が文字列としてそのまま送られていました。
-            // 正しいテンプレートリテラルの例: `これは${変数}です`
+    // クラスタ詳細の1ページ分を取得する (cursor を渡すと続きのページ)
+    const fetchClusterDetailsPage = async (clusterId, filters, cursor = null) => {
+        const params = new URLSearchParams();
+        if (currentSessionId) params.append('session_id', currentSessionId);
+        if (cursor) params.append('cursor', cursor);
+        Object.entries(filters).forEach(([key, value]) => {
+            if (value !== '') params.append(key, value);
+        });
+        const response = await fetch(`/api/cluster_details/${clusterId}?${params.toString()}`);
+        if (!response.ok) {
+            const errorData = await response.json();
+            throw new Error(errorData.detail || 'クラスタ詳細の取得に失敗しました。');
+        }
+        return response.json();
+    };
 
-            const response = await fetch(url);
-            if (!response.ok) {
-                const errorData = await response.json();
-                throw new Error(errorData.detail || 'クラスタ詳細の取得に失敗しました。');
-            }
-            const data = await response.json();
+    // クラスタ詳細の取得とモーダル表示 (最初のページのみ。続きはスクロールで読み込む)
+    const handleClusterClick = async (clusterId, filters = {category: '', sentiment: '', danger: ''}) => {
+        try {
+            const data = await fetchClusterDetailsPage(clusterId, filters);
+            setClusterFilters(filters);
             setSelectedClusterDetails(data);
             setShowModal(true);
         } catch (error) {
@@ -588,6 +919,25 @@ const App = () => {
         }
     };
 
+    // モーダルを末尾までスクロールしたときに次のページを追加する
+    const handleLoadMoreComments = async () => {
+        if (!selectedClusterDetails || !selectedClusterDetails.next_cursor || loadingMoreComments) return;
+        setLoadingMoreComments(true);
+        try {
+            const data = await fetchClusterDetailsPage(selectedClusterDetails.cluster_id, clusterFilters, selectedClusterDetails.next_cursor);
+            setSelectedClusterDetails(prev => ({
+                ...prev,
+                comments: [...prev.comments, ...data.comments],
+                next_cursor: data.next_cursor
+            }));
+        } catch (error) {
+            console.error('Error fetching more cluster comments:', error);
+            setUploadMessage({status: 'error', message: error.message || 'クラスタ詳細の取得中にエラーが発生しました。'});
+        } finally {
+            setLoadingMoreComments(false);
+        }
+    };
+
     // 履歴セッションがクリックされたときのハンドラー
     const handleHistorySessionClick = (sessionId) => {
         setCurrentSessionId(sessionId); // 表示するセッションIDを更新
@@ -596,6 +946,15 @@ const App = () => {
         // window.history.pushState(null, '', `/history/${sessionId}`); // 必要に応じてURLを更新
     };
 
+    // ライブセッションの受付が終了したら、そのセッションの分析結果を表示する
+    const handleLiveEnded = useCallback((sessionId) => {
+        fetchAnalysisSessions();
+        setCurrentSessionId(sessionId);
+        setActiveContent('ranking');
+        setPath('/analysis');
+        fetchAnalysisResults(sessionId);
+    }, [fetchAnalysisSessions, fetchAnalysisResults]);
+
     // -- ルーティングロジック --
     // ブラウザのURLが変更されたときにpathステートを更新
     useEffect(() => {
@@ -663,6 +1022,9 @@ const App = () => {
                     <a href="/history" className={`nav-link text-start ${path === '/history' ? 'active' : ''}`} onClick={(e) => { e.preventDefault(); setPath('/history'); window.history.pushState({}, '', '/history'); }}>
                         分析履歴
                     </a>
+                    <a href="/live" className={`nav-link text-start ${path === '/live' ? 'active' : ''}`} onClick={(e) => { e.preventDefault(); setPath('/live'); window.history.pushState({}, '', '/live'); }}>
+                        ライブ分析
+                    </a>
                 </div>
                 <hr className="text-white"/>
                 <h5 className="card-title text-white mb-3 mt-3">アップロード</h5>
@@ -670,6 +1032,11 @@ const App = () => {
                     <div className="input-group mb-3">
                         <input type="file" name="file" className="form-control form-control-sm" accept=".csv" required disabled={loadingUpload} />
                     </div>
+                    <div className="form-check mb-3 text-white">
+                        {/* 近似分析: サンプルだけをラベル付けしてPN比を推定し、残りはバックグラウンドで処理する */}
+                        <input type="checkbox" name="approximate" value="true" className="form-check-input" id="approximateUpload" disabled={loadingUpload} />
+                        <label className="form-check-label small" htmlFor="approximateUpload">近似分析 (大規模なCSV向け)</label>
+                    </div>
                     <button type="submit" className="btn btn-primary btn-sm w-100" disabled={loadingUpload}>
                         {loadingUpload ? (
                             <>
@@ -708,12 +1075,16 @@ const App = () => {
                         pnCharts={pnCharts}
                         topClusters={topClusters}
                         aiAnalysisComment={aiAnalysisComment}
+                        streamingAiComment={streamingAiComment}
                         onClusterClick={handleClusterClick}
                         activeContent={activeContent}
                         setActiveContent={setActiveContent}
                         currentSessionId={currentSessionId} 
                     />
                 )}
+                {path === '/live' && ( // ライブ分析ページ
+                    <LivePage onEnded={handleLiveEnded} />
+                )}
                 {path === '/history' && ( // 履歴ページ
                     <HistoryPage 
                         loadingHistory={loadingHistory}
@@ -726,6 +1097,10 @@ const App = () => {
                     show={showModal} 
                     onClose={() => setShowModal(false)} 
                     clusterDetails={selectedClusterDetails} 
+                    filters={clusterFilters}
+                    onFilterChange={(filters) => handleClusterClick(selectedClusterDetails.cluster_id, filters)}
+                    onLoadMore={handleLoadMoreComments}
+                    loadingMore={loadingMoreComments}
                 />
             </div>
         </>
@@ -0,0 +1,25 @@
+"""
+単体テストで共通に使うフィクスチャ。
+
+db: テストごとに作る一時ファイルの SQLite データベースのセッション (app.config の DATABASE_URL とは別)。
+"""
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.models import Base
+
+
+@pytest.fixture
+def db_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", connect_args={"check_same_thread": False, "timeout": 30})
+    Base.metadata.create_all(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def db(db_factory):
+    session = db_factory()
+    yield session
+    session.close()
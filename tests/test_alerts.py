@@ -0,0 +1,44 @@
+"""
+app.alerts のアラートの保存と、分析セッションへの紐付けの単体テスト。
+"""
+from app.alerts import attach_alerts, list_alerts, raise_alerts
+from app.models import AnalysisSession, Comment
+
+URGENT = {"category": "授業内容", "danger": False, "tags": {"緊急性": 5}}
+NORMAL = {"category": "授業内容", "danger": False, "tags": {"緊急性": 0}}
+
+
+def test_upload_alerts_are_listed_under_the_created_session(db):
+    # /upload のコメントはスコープが None で、ラベル付けの時点ではセッションがまだない
+    comments = [Comment(text="音声が聞こえません"), Comment(text="わかりやすい")]
+    db.add_all(comments)
+    db.commit()
+    raise_alerts(db, [(comments[0].id, comments[0].text, URGENT), (comments[1].id, comments[1].text, NORMAL)])
+
+    analysis_session = AnalysisSession(csv_filename="upload.csv")
+    db.add(analysis_session)
+    db.flush()
+    db.query(Comment).filter(Comment.ingest_session_id == None).update({Comment.ingest_session_id: analysis_session.id})
+    attach_alerts(db, analysis_session.id)
+    db.commit()
+
+    alerts = list_alerts(db, session_id=analysis_session.id)
+    assert [a["comment_id"] for a in alerts] == [comments[0].id]
+    assert alerts[0]["kinds"] == ["urgent"]
+
+
+def test_alerts_use_the_ingesting_session(db):
+    older = AnalysisSession(csv_filename="old.csv")
+    newer = AnalysisSession(csv_filename="new.csv")
+    db.add_all([older, newer])
+    db.flush()
+    # 前回の /upload で取り込み、今回の実行でラベル付けしたコメントは取り込んだセッションのアラートになる
+    comment = Comment(text="画面が映らない", ingest_session_id=older.id)
+    db.add(comment)
+    db.commit()
+    raise_alerts(db, [(comment.id, comment.text, URGENT)])
+    attach_alerts(db, newer.id)
+    db.commit()
+
+    assert [a["comment_id"] for a in list_alerts(db, session_id=older.id)] == [comment.id]
+    assert list_alerts(db, session_id=newer.id) == []
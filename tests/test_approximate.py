@@ -0,0 +1,111 @@
+"""
+app.approximate の層化抽出 (配分・抽出) と層化比推定の信頼区間の単体テスト。
+"""
+import math
+
+import numpy as np
+import pytest
+from scipy.stats import norm
+
+from app.approximate import _ratio_estimate, allocate, draw_sample, estimate
+from app.models import Comment
+
+Z95 = float(norm.ppf(0.975))
+
+
+def _units(values):
+    return [{"y": v, "x": 1} for v in values]
+
+
+def _estimate(strata):
+    return _ratio_estimate(strata, lambda u: u["y"], lambda u: u["x"], Z95)
+
+
+def test_allocate_is_proportional_with_floor_and_cap():
+    weights = {"a": 700, "b": 290, "c": 10}
+    sizes = {"a": 1000, "b": 1000, "c": 1}
+    # c は下限 2 件だが、代表コメントが1件しかないため1件
+    assert allocate(weights, sizes, 100, min_per_stratum=2) == {"a": 70, "b": 29, "c": 1}
+    assert allocate({"a": 1, "b": 99}, {"a": 50, "b": 50}, 40, min_per_stratum=2) == {"a": 2, "b": 40}
+    assert allocate({"a": 0}, {"a": 5}, 10, min_per_stratum=2) == {"a": 2}
+
+
+def test_census_has_no_sampling_error():
+    # 全数調査した層 (n == N_h) だけなら、推定値は真の割合で信頼区間の幅は 0
+    result = _estimate([(4, _units([1, 0, 0, 1])), (2, _units([1, 1]))])
+    assert result == {"estimate": round(4 / 6 * 100, 2), "low": round(4 / 6 * 100, 2), "high": round(4 / 6 * 100, 2)}
+
+
+def test_ratio_estimate_matches_the_stratified_variance():
+    y1, y2 = np.array([1, 0, 1, 1]), np.array([0, 0, 1])
+    result = _estimate([(40, _units(y1)), (60, _units(y2))])
+    p = (40 * y1.mean() + 60 * y2.mean()) / 100
+    variance = sum(population ** 2 * (1 - len(y) / population) * (y - p).var(ddof=1) / len(y)
+                   for population, y in [(40, y1), (60, y2)])
+    margin = Z95 * math.sqrt(variance) / 100
+    assert result["estimate"] == round(p * 100, 2)
+    assert result["low"] == round((p - margin) * 100, 2)
+    assert result["high"] == round(min(p + margin, 1.0) * 100, 2)
+
+
+def test_ratio_estimate_edge_cases():
+    # ラベルが得られなかった層は除き、分母が 0 の場合は推定しない
+    assert _estimate([(10, [])]) is None
+    assert _ratio_estimate([(10, _units([1, 0]))], lambda u: u["y"], lambda u: 0, Z95) is None
+    # 1件しか得られなかった層は分散に寄与しない
+    single = _estimate([(100, _units([1]))])
+    assert single == {"estimate": 100.0, "low": 100.0, "high": 100.0}
+    # 区間は 0-100% に収める
+    low = _estimate([(1000, _units([0, 0, 0, 1]))])
+    assert 0.0 <= low["low"] <= low["estimate"] <= low["high"] <= 100.0
+
+
+def test_confidence_interval_coverage():
+    # 2層の母集団から繰り返し抽出し、95% 信頼区間が真の割合を含む割合を確かめる
+    rng = np.random.default_rng(0)
+    populations = [rng.random(2000) < 0.3, rng.random(500) < 0.7]
+    truth = sum(p.sum() for p in populations) / sum(len(p) for p in populations) * 100
+    trials, covered = 400, 0
+    for _ in range(trials):
+        strata = [(len(p), _units(rng.choice(p, size=n, replace=False).astype(int))) for p, n in zip(populations, [80, 20])]
+        result = _estimate(strata)
+        covered += result["low"] <= truth <= result["high"]
+    assert 0.9 <= covered / trials <= 0.99
+
+
+def test_draw_sample_and_estimate(db):
+    comments = []
+    for i in range(60):
+        comments.append(Comment(text=f"大きいクラスタ{i}", cluster_id=0, duplicate_count=2 if i % 10 == 0 else 1))
+    for i in range(30):
+        comments.append(Comment(text=f"中くらいのクラスタ{i}", cluster_id=1))
+    # 小さなクラスタは1つの層にまとめる
+    comments += [Comment(text="小さいクラスタA", cluster_id=2), Comment(text="小さいクラスタB", cluster_id=3)]
+    # ラベル付け済みのコメントは全数調査の層
+    comments += [Comment(text=f"ラベル済み{i}", cluster_id=0, category="授業内容", sentiment=1) for i in range(5)]
+    db.add_all(comments)
+    db.commit()
+
+    sample = draw_sample(db, sample_size=30, rng=np.random.default_rng(1))
+    strata = sample["strata"]
+    assert set(strata) == {("sampled", 0), ("sampled", 1), ("sampled", "small"), ("labeled", 0)}
+    assert strata[("sampled", 0)]["weight"] == 66 and len(strata[("sampled", 0)]["sampled"]) == 20
+    assert len(strata[("sampled", 1)]["sampled"]) == 9
+    assert len(strata[("sampled", "small")]["sampled"]) == 2
+    assert len(strata[("labeled", 0)]["sampled"]) == 5
+    assert len(set(sample["sample_ids"])) == len(sample["sample_ids"]) == 31
+    assert draw_sample(db, sample_size=30, rng=np.random.default_rng(1))["sample_ids"] == sample["sample_ids"]
+
+    # 抽出したコメントをすべてネガティブとしてラベル付けすると、ポジティブはラベル済みの5件だけ
+    db.query(Comment).filter(Comment.id.in_(sample["sample_ids"])).update(
+        {Comment.category: "授業内容", Comment.sentiment: 0}, synchronize_session=False
+    )
+    db.commit()
+    result = estimate(db, sample)
+    assert result["population_comments"] == 103
+    assert result["sampled_comments"] == 31 and result["labeled_comments"] == 36
+    # 重複メンバーの数は抽出から推定するため、コメント数の推定誤差の分だけ真の割合からずれる
+    positive, negative = result["overall"]["positive"], result["overall"]["negative"]
+    assert positive["estimate"] == pytest.approx(5 / 103 * 100, abs=0.5)
+    assert positive["estimate"] + negative["estimate"] == pytest.approx(100.0)
+    assert result["categories"]["授業内容"]["share"]["estimate"] == 100.0
@@ -0,0 +1,119 @@
+"""
+app.archive のアーカイブ (Parquet・サイドカーファイルへの書き出しとDBからの削除) と、アーカイブ済みのクラスタ詳細の単体テスト。
+"""
+import pytest
+
+from app import archive
+from app.analyze import get_comments_in_cluster
+from app.models import AnalysisSession, ClusterStat, Comment
+
+pytest.importorskip("pyarrow")
+
+
+@pytest.fixture(autouse=True)
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", str(tmp_path / "archive"))
+
+
+def _batch_session(db, scores):
+    # 1クラスタのバッチのセッション (スコアが None のコメントを含む)
+    analysis_session = AnalysisSession(csv_filename="batch.csv", batch_id="job-1", status="done",
+                                       ai_analysis_comment="まとめ", top_clusters_data=[{"cluster_id": 0}])
+    db.add(analysis_session)
+    db.flush()
+    comments = [Comment(text=f"コメント{i}", session_id=analysis_session.id, ingest_session_id=analysis_session.id,
+                        cluster_id=0, category="授業内容", danger=False, sentiment=1, importance_score=score)
+                for i, score in enumerate(scores)]
+    db.add_all(comments)
+    db.flush()
+    ranked = sorted(comments, key=lambda c: (c.importance_score is None, -(c.importance_score or 0.0), c.id))
+    db.add(ClusterStat(session_id=analysis_session.id, cluster_id=0, size=len(comments),
+                       top_comment_ids=[c.id for c in ranked[:3]]))
+    db.commit()
+    # アーカイブでコメントの行は削除されるため、IDと本文を先に取り出しておく
+    return analysis_session, [(c.id, c.text) for c in ranked]
+
+
+def _all_pages(fetch, limit):
+    pages, cursor = [], None
+    while True:
+        page = fetch(limit=limit, cursor=cursor)
+        pages.append(page)
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return pages
+
+
+def test_archive_round_trip(db):
+    analysis_session, ranked = _batch_session(db, [0.5, None, 0.9, 0.5, None, 0.1, 0.9])
+    live_pages = _all_pages(lambda **kw: get_comments_in_cluster(db, 0, analysis_session.id, **kw), limit=3)
+
+    assert archive.archive_session(db, analysis_session) == len(ranked)
+    assert db.query(Comment).count() == 0
+    assert db.query(ClusterStat).count() == 0
+    assert archive.session_results(analysis_session)["ai_analysis_comment"] == "まとめ"
+
+    archived_pages = _all_pages(lambda **kw: archive.get_archived_comments_in_cluster(analysis_session, 0, **kw), limit=3)
+    assert [c["id"] for p in archived_pages for c in p["comments"]] == [comment_id for comment_id, _ in ranked]
+    assert [c["id"] for p in archived_pages for c in p["comments"]] == [c["id"] for p in live_pages for c in p["comments"]]
+    assert archived_pages[0]["total_count"] == len(ranked)
+    assert archived_pages[1]["total_count"] is None
+    assert archived_pages[0]["representative_text"] == ranked[0][1]
+
+
+def test_archived_pages_end_exactly_at_limit(db):
+    analysis_session, ranked = _batch_session(db, [0.3, 0.2, 0.1, 0.4])
+    archive.archive_session(db, analysis_session)
+
+    pages = _all_pages(lambda **kw: archive.get_archived_comments_in_cluster(analysis_session, 0, **kw), limit=2)
+    assert [len(p["comments"]) for p in pages] == [2, 2]
+    assert [c["id"] for p in pages for c in p["comments"]] == [comment_id for comment_id, _ in ranked]
+
+    filtered = archive.get_archived_comments_in_cluster(analysis_session, 0, sentiment=0)
+    assert filtered["comments"] == [] and filtered["total_count"] == 0
+
+
+def test_sidecar_is_reread_after_save(db):
+    analysis_session, _ = _batch_session(db, [0.1])
+    archive.archive_session(db, analysis_session)
+
+    assert archive.load_session_sidecar(analysis_session) is archive.load_session_sidecar(analysis_session)
+    archive.save_session_result(analysis_session, "ai_analysis_comment", "再生成したまとめ")
+    assert archive.session_results(analysis_session)["ai_analysis_comment"] == "再生成したまとめ"
+
+
+def test_upload_comments_stay_while_a_newer_upload_session_exists(db):
+    older = AnalysisSession(csv_filename="1.csv")
+    newer = AnalysisSession(csv_filename="2.csv")
+    db.add_all([older, newer])
+    db.flush()
+    old_comment = Comment(text="前回のコメント", ingest_session_id=older.id, cluster_id=0, importance_score=0.9)
+    new_comment = Comment(text="今回のコメント", ingest_session_id=newer.id, cluster_id=0, importance_score=0.5)
+    db.add_all([old_comment, new_comment])
+    db.flush()
+    # 新しいセッションのクラスタは累積のコメントを集計するため、前回のコメントが代表になる
+    db.add(ClusterStat(session_id=newer.id, cluster_id=0, size=2, top_comment_ids=[old_comment.id, new_comment.id]))
+    db.commit()
+
+    assert archive.archive_session(db, older) == 1
+    assert db.query(Comment).count() == 2
+    detail = get_comments_in_cluster(db, 0, newer.id)
+    assert detail["representative_text"] == "前回のコメント"
+    assert detail["total_count"] == 2
+
+    # 最新のセッションをアーカイブすると、参照するセッションがなくなるため両方とも削除する
+    assert archive.archive_session(db, newer) == 1
+    assert db.query(Comment).count() == 0
+
+
+def test_missing_representative_falls_back_to_next_top_comment(db):
+    analysis_session = AnalysisSession(csv_filename="1.csv")
+    db.add(analysis_session)
+    db.flush()
+    comment = Comment(text="残っているコメント", ingest_session_id=analysis_session.id, cluster_id=0, importance_score=0.5)
+    db.add(comment)
+    db.flush()
+    db.add(ClusterStat(session_id=analysis_session.id, cluster_id=0, size=2, top_comment_ids=[comment.id + 100, comment.id]))
+    db.commit()
+
+    assert get_comments_in_cluster(db, 0, analysis_session.id)["representative_text"] == "残っているコメント"
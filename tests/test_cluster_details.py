@@ -0,0 +1,72 @@
+"""
+app.analyze のクラスタ詳細のカーソル ((importance_score, id) のキーセット方式) と絞り込みの単体テスト。
+"""
+import pytest
+
+from app.analyze import decode_cluster_cursor, encode_cluster_cursor, get_comments_in_cluster
+from app.models import AnalysisSession, ClusterStat, Comment
+
+
+@pytest.mark.parametrize("score, comment_id", [(0.75, 12), (None, 3), (0.0, 1), (1e-9, 2 ** 40)])
+def test_cursor_round_trip(score, comment_id):
+    cursor = encode_cluster_cursor(score, comment_id)
+    assert decode_cluster_cursor(cursor) == (score, comment_id)
+    # URL のクエリ文字列にそのまま載せられる
+    assert all(c.isalnum() or c in "-_=" for c in cursor)
+
+
+@pytest.mark.parametrize("cursor", ["", "!!!", encode_cluster_cursor(0.5, 1)[:-4], "WzEsMiwzXQ=="])
+def test_invalid_cursor_is_rejected(cursor):
+    with pytest.raises(ValueError):
+        decode_cluster_cursor(cursor)
+
+
+def _cluster(db, scores):
+    analysis_session = AnalysisSession(csv_filename="batch.csv", batch_id="job-1")
+    db.add(analysis_session)
+    db.flush()
+    comments = [Comment(text=f"コメント{i}", session_id=analysis_session.id, cluster_id=0, importance_score=score,
+                        sentiment=i % 2, category="授業内容")
+                for i, score in enumerate(scores)]
+    db.add_all(comments)
+    db.flush()
+    db.add(ClusterStat(session_id=analysis_session.id, cluster_id=0, size=len(comments)))
+    db.commit()
+    expected = sorted(comments, key=lambda c: (c.importance_score is None, -(c.importance_score or 0.0), c.id))
+    return analysis_session.id, [c.id for c in expected]
+
+
+def _all_ids(db, session_id, limit, **filters):
+    ids, cursor, pages = [], None, 0
+    while True:
+        page = get_comments_in_cluster(db, 0, session_id, limit=limit, cursor=cursor, **filters)
+        ids += [c["id"] for c in page["comments"]]
+        pages += 1
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return ids, pages
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 8, 50])
+def test_pages_follow_score_order_across_ties_and_nulls(db, limit):
+    # 同点のスコア、スコアのないコメント (NULL は末尾) を含む
+    session_id, expected = _cluster(db, [0.5, None, 0.9, 0.5, None, 0.1, 0.9, 0.5])
+    ids, pages = _all_ids(db, session_id, limit)
+    assert ids == expected
+    # 件数がページサイズの倍数のときに空のページを返さない
+    assert pages == -(-len(expected) // limit)
+
+
+def test_cursor_after_the_last_null_score_returns_nothing(db):
+    session_id, expected = _cluster(db, [0.3, None, None])
+    page = get_comments_in_cluster(db, 0, session_id, cursor=encode_cluster_cursor(None, expected[-1]))
+    assert page["comments"] == [] and page["next_cursor"] is None and page["total_count"] is None
+
+
+def test_filters_and_total_count(db):
+    session_id, expected = _cluster(db, [0.5, 0.4, 0.3, 0.2, 0.1])
+    first = get_comments_in_cluster(db, 0, session_id, limit=1, sentiment=1)
+    assert first["total_count"] == 2
+    ids, _ = _all_ids(db, session_id, 1, sentiment=1)
+    assert ids == [expected[1], expected[3]]
+    assert get_comments_in_cluster(db, 0, session_id, limit=2)["total_count"] == 5
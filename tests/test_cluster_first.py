@@ -0,0 +1,103 @@
+"""
+app.cluster_first のクラスタ単位のラベル付け (medoid のラベルの展開・例コメントの一致率・チャンクごとのコミット) の単体テスト。
+LLMは呼ばず、label_comment を差し替える。
+"""
+import asyncio
+import pickle
+
+import numpy as np
+import pytest
+
+from app import cluster_first
+from app.models import Comment
+
+
+def _add_clusters(db, clusters: int = 3, size: int = 10, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    for cluster_id in range(clusters):
+        center = np.zeros(16, dtype=np.float32)
+        center[cluster_id] = 1.0
+        for i in range(size):
+            embedding = center + rng.normal(scale=0.05, size=16).astype(np.float32)
+            db.add(Comment(text=f"クラスタ{cluster_id}のコメント{i}", cluster_id=cluster_id, embedding=pickle.dumps(embedding),
+                           label_state="pending"))
+    db.commit()
+
+
+def _fake_labeler(fail_after: int | None = None, category_of=lambda comment: "授業内容"):
+    calls = []
+
+    async def label_comment(comment, deadline=None):
+        if fail_after is not None and len(calls) >= fail_after:
+            raise RuntimeError("プロセスが停止した")
+        calls.append(comment.id)
+        comment.category = category_of(comment)
+        comment.danger = False
+        comment.sentiment = 1
+        comment.tags = {"質問": 0}
+        comment.label_state = "done"
+        comment.label_error = None
+        comment.label_provider = "fake"
+        comment.label_attempts = (comment.label_attempts or 0) + 1
+        return True
+
+    label_comment.calls = calls
+    return label_comment
+
+
+def test_labels_and_propagates_every_member(db, monkeypatch):
+    _add_clusters(db)
+    labeler = _fake_labeler()
+    monkeypatch.setattr(cluster_first, "label_comment", labeler)
+
+    report = asyncio.run(cluster_first.label_clusters_by_exemplars(db))
+    assert report["clusters"] == 3
+    assert report["llm_calls"] == len(labeler.calls) < 30
+    assert report["propagated"] + report["llm_calls"] == 30
+    states = {state for state, in db.query(Comment.label_state).all()}
+    assert states == {"done"}
+    assert db.query(Comment).filter(Comment.category == None).count() == 0
+
+
+def test_labels_committed_before_a_crash_are_kept(db, monkeypatch):
+    _add_clusters(db)
+    # 1つ目のクラスタ (medoid と例コメント) の後で止まる
+    monkeypatch.setattr(cluster_first, "LABEL_COMMIT_CHUNK_SIZE", 5)
+    monkeypatch.setattr(cluster_first, "label_comment", _fake_labeler(fail_after=cluster_first.CLUSTER_FIRST_EXEMPLARS))
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(cluster_first.label_clusters_by_exemplars(db))
+    db.rollback()
+    labeled = db.query(Comment).filter(Comment.category != None).count()
+    assert labeled >= 10 - 1  # 1つ目のクラスタ (閾値未満のメンバーを除く) は書き込み済み
+    # 処理中だったコメントは次回の実行で "pending" に戻り、残りから再開する
+    assert db.query(Comment).filter(Comment.label_state == "in_flight").count() > 0
+    monkeypatch.setattr(cluster_first, "label_comment", _fake_labeler())
+    asyncio.run(cluster_first.label_clusters_by_exemplars(db))
+    assert db.query(Comment).filter(Comment.category == None).count() == 0
+
+
+def test_agreement_audits_random_propagated_members(db, monkeypatch):
+    # 各クラスタは medoid とほぼ同じコメント 3 件 (core) と、類似度 0.85 で展開されるが別のカテゴリのコメント 7 件 (edge)
+    dim = 64
+    for cluster_id in range(20):
+        base = np.zeros(dim, dtype=np.float32)
+        base[cluster_id] = 1.0
+        for i in range(10):
+            if i < 3:
+                embedding, kind = base + np.float32(0.001 * i), "core"
+            else:
+                direction = np.zeros(dim, dtype=np.float32)
+                direction[20 + i] = 1.0
+                embedding, kind = 0.85 * base + np.sqrt(1 - 0.85 ** 2) * direction, "edge"
+            db.add(Comment(text=f"クラスタ{cluster_id}-{kind}{i}", cluster_id=cluster_id, embedding=pickle.dumps(embedding.astype(np.float32)),
+                           label_state="pending"))
+    db.commit()
+    monkeypatch.setattr(cluster_first, "label_comment",
+                        _fake_labeler(category_of=lambda comment: "その他" if "edge" in comment.text else "授業内容"))
+
+    report = asyncio.run(cluster_first.label_clusters_by_exemplars(db, rng=np.random.default_rng(0)))
+    assert report["exemplar_pairs"] == 20 * (cluster_first.CLUSTER_FIRST_EXEMPLARS - 1)
+    # medoid に最も近いメンバー (core) だけを比べると一致率は 1.0 になるが、展開したメンバーの大半 (edge) は一致しない
+    assert report["category_agreement"] < 0.6
+    assert report["sentiment_agreement"] == 1.0
@@ -0,0 +1,46 @@
+"""
+cluster_first パイプラインの回帰テスト。
+
+benchmarks.run_pipeline を使い、疑似Groqサーバー (benchmarks.fake_groq) に対して /upload パイプライン全体を別プロセスで実行する
+(app の設定はインポート時に環境変数から読み込まれるため、テストのプロセスでは app をインポートしない)。
+クラスタが2つ以上あるコーパスで、例コメントのラベル付けからラベルの展開・アラートの送信までが最後まで通ることを確認する。
+"""
+import json
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.mark.parametrize("dedup", [False, True], ids=["no-dedup", "dedup"])
+def test_cluster_first_pipeline_completes(tmp_path, dedup):
+    output = tmp_path / "pipeline.json"
+    command = [
+        sys.executable, "-m", "benchmarks.run_pipeline",
+        "--sizes", "300", "--pipeline-mode", "cluster_first",
+        "--port", str(_free_port()), "--output", str(output),
+    ]
+    if not dedup:
+        command.append("--no-dedup")
+    completed = subprocess.run(command, cwd=REPO_ROOT, capture_output=True, text=True, timeout=600)
+    assert completed.returncode == 0, completed.stderr[-3000:]
+
+    result = json.loads(output.read_text(encoding="utf-8"))["results"][0]
+    assert "error" not in result, completed.stderr[-3000:]
+    report = result["label_agreement"]
+    assert report["llm_calls"] > 0
+    assert report["failed"] == 0
+    if not dedup:
+        # 最初のクラスタの後もラベル付けが続くこと (2つ目以降のクラスタで例コメントをラベル付けする)
+        assert report["clusters"] >= 2
+        assert report["exemplar_pairs"] > 0
@@ -0,0 +1,60 @@
+"""
+app.dedup の正規化・MinHash/LSH による重複グループ化と、重複メンバーへのラベル展開の単体テスト。
+"""
+from app.dedup import (
+    collapse_duplicates, group_near_duplicates, minhash_signature, normalize_text, propagate_duplicate_labels, text_hash,
+)
+from app.models import Comment
+
+
+def test_normalize_text_unifies_width_case_and_symbols():
+    assert normalize_text("ＡＢＣ、 資料が 見にくい！！") == "abc資料が見にくい"
+    assert normalize_text("Slide_3 -- OK?") == "slide3ok"
+    assert text_hash("資料が見にくい。") == text_hash("資料が 見にくい!!")
+
+
+def test_normalize_text_keeps_digits():
+    assert normalize_text("第3回") != normalize_text("第12回")
+    assert text_hash("5点です") != text_hash("1点です")
+
+
+def test_minhash_signature_is_deterministic():
+    signature = minhash_signature(normalize_text("スライドの文字が小さくて読めませんでした"))
+    assert (signature == minhash_signature(normalize_text("スライドの文字が小さくて読めませんでした"))).all()
+    assert len(minhash_signature("ab")) == len(signature)
+
+
+def test_group_near_duplicates():
+    texts = [
+        "スライドの文字が小さくて後ろの席からは読めませんでした",
+        "授業の進め方がとてもわかりやすかったです",
+        "スライドの文字が小さくて後ろの席からは読めませんでした。",
+        "スライドの文字が小さくて後ろの席からは読めませんでしたね",
+        "第3回",
+        "第12回",
+    ]
+    groups = group_near_duplicates(texts)
+    # 完全一致 (記号だけの違い) と語尾だけが違う近似重複は、最初のコメントを代表にまとめる
+    assert groups[:4] == [0, 1, 0, 0]
+    # 短いコメントは数字が違えば別のグループ
+    assert groups[4] == 4 and groups[5] == 5
+    assert group_near_duplicates([]) == []
+
+
+def test_collapse_and_propagate_labels(db):
+    texts = ["音声が途切れます", "音声が途切れます!", "資料をもっと早く公開してください"]
+    db.add_all([Comment(text=t) for t in texts])
+    db.commit()
+
+    collapse_duplicates(db)
+    comments = db.query(Comment).order_by(Comment.id).all()
+    assert [c.duplicate_of for c in comments] == [None, comments[0].id, None]
+    assert [c.duplicate_count for c in comments] == [2, 1, 1]
+
+    comments[0].category, comments[0].sentiment, comments[0].tags = "インフラ", 0, {"緊急性": 3}
+    db.commit()
+    propagate_duplicate_labels(db)
+    db.expire_all()
+    member = db.get(Comment, comments[1].id)
+    assert (member.category, member.sentiment, member.tags) == ("インフラ", 0, {"緊急性": 3})
+    assert db.get(Comment, comments[2].id).category is None
@@ -0,0 +1,59 @@
+"""
+app.export のキーセット方式のバッチ読み出しと、CSV・Parquet への書き出しの単体テスト。
+"""
+import csv
+import io
+import pickle
+
+import numpy as np
+import pytest
+
+from app.export import CSV_COLUMNS, iter_comment_batches, iter_csv, iter_parquet, session_comments
+from app.models import AnalysisSession, Comment
+
+
+def _session_with_comments(db, count, embeddings=False):
+    analysis_session = AnalysisSession(csv_filename="batch.csv", batch_id="job-1")
+    other = AnalysisSession(csv_filename="other.csv", batch_id="job-2")
+    db.add_all([analysis_session, other])
+    db.flush()
+    for i in range(count):
+        embedding = pickle.dumps(np.full(4, i, dtype=np.float32)) if embeddings and i % 2 == 0 else None
+        db.add(Comment(text=f"コメント{i}", session_id=analysis_session.id, category="授業内容", sentiment=i % 2,
+                       importance_score=i / 10, tags={"緊急性": i % 3}, embedding=embedding))
+        # 別のセッションのコメントを間に挟む (IDが連続しない)
+        db.add(Comment(text=f"別のセッション{i}", session_id=other.id))
+    db.commit()
+    return analysis_session
+
+
+@pytest.mark.parametrize("count, batch_size, sizes", [(6, 3, [3, 3]), (7, 3, [3, 3, 1]), (2, 5, [2]), (0, 3, [])])
+def test_batches_cover_every_comment_once(db, count, batch_size, sizes):
+    analysis_session = _session_with_comments(db, count)
+    batches = list(iter_comment_batches(db, session_comments(analysis_session), batch_size=batch_size))
+    assert [len(rows) for rows in batches] == sizes
+    ids = [row.id for rows in batches for row in rows]
+    assert ids == sorted(ids)
+    assert [row.text for rows in batches for row in rows] == [f"コメント{i}" for i in range(count)]
+
+
+def test_csv_export(db):
+    analysis_session = _session_with_comments(db, 5)
+    content = "".join(iter_csv(db, analysis_session, batch_size=2))
+    assert content.startswith("\ufeff")
+    rows = list(csv.reader(io.StringIO(content[1:])))
+    assert rows[0] == CSV_COLUMNS
+    assert [row[1] for row in rows[1:]] == [f"コメント{i}" for i in range(5)]
+    assert [row[CSV_COLUMNS.index("緊急性")] for row in rows[1:]] == ["0", "1", "2", "0", "1"]
+
+
+def test_parquet_export_with_embeddings(db):
+    pq = pytest.importorskip("pyarrow.parquet")
+    analysis_session = _session_with_comments(db, 5, embeddings=True)
+    data = b"".join(iter_parquet(db, analysis_session, include_embeddings=True, batch_size=2))
+    table = pq.read_table(io.BytesIO(data))
+    assert table.num_rows == 5
+    assert table.column("text").to_pylist() == [f"コメント{i}" for i in range(5)]
+    # 埋め込みのないコメントは null
+    embeddings = table.column("embedding").to_pylist()
+    assert embeddings[0] == [0.0] * 4 and embeddings[1] is None and embeddings[2] == [2.0] * 4
@@ -0,0 +1,28 @@
+"""
+app.live のライブセッションの受付の単体テスト。
+"""
+import asyncio
+
+import pytest
+
+from app.live import LiveSession
+from app.models import Comment
+
+
+def test_ingest_rejects_comments_after_stop(db):
+    async def scenario():
+        live = LiveSession(1, "テスト")
+        queue = live.subscribe()
+        assert len(live.ingest(db, ["音声が聞こえません", " "])) == 1
+        assert queue.get_nowait()["type"] == "received"
+
+        # LiveHub.end が受付を終了した後は、接続中の WebSocket から届いたコメントも保存しない
+        live.stopped = True
+        with pytest.raises(ValueError):
+            live.ingest(db, ["終了後のコメント"])
+        return live
+
+    live = asyncio.run(scenario())
+    assert db.query(Comment).filter(Comment.session_id == 1).count() == 1
+    assert live.queue.qsize() == 1
+    assert live.counters.received == 1
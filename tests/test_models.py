@@ -0,0 +1,36 @@
+"""
+app.models のスキーマ移行 (upgrade_schema / compress_session_blobs) の単体テスト。
+"""
+from sqlalchemy import text
+
+from app.models import COMPRESSED_BLOBS_SCHEMA_VERSION, AnalysisSession, compress_session_blobs
+
+
+def _insert_legacy_comment(conn, session_id, comment):
+    # 圧縮カラム型の導入前の形式 (文字列) で保存された行
+    conn.execute(text("INSERT INTO analysis_sessions (id, csv_filename, ai_analysis_comment) VALUES (:id, 'old.csv', :comment)"),
+                 {"id": session_id, "comment": comment})
+
+
+def test_legacy_rows_are_compressed_once(db_factory):
+    engine = db_factory.kw["bind"]
+    with engine.begin() as conn:
+        _insert_legacy_comment(conn, 1, "圧縮前のまとめ")
+
+    compress_session_blobs(engine)
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT typeof(ai_analysis_comment) FROM analysis_sessions WHERE id = 1")).scalar() == "blob"
+        assert conn.execute(text("PRAGMA user_version")).scalar() == COMPRESSED_BLOBS_SCHEMA_VERSION
+    db = db_factory()
+    assert db.get(AnalysisSession, 1).ai_analysis_comment == "圧縮前のまとめ"
+    db.close()
+
+    # 移行済みのデータベースは走査しない (後から文字列の行があっても書き換えず、読み取り時にそのまま返す)
+    with engine.begin() as conn:
+        _insert_legacy_comment(conn, 2, "移行後に書かれた文字列")
+    compress_session_blobs(engine)
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT typeof(ai_analysis_comment) FROM analysis_sessions WHERE id = 2")).scalar() == "text"
+    db = db_factory()
+    assert db.get(AnalysisSession, 2).ai_analysis_comment == "移行後に書かれた文字列"
+    db.close()
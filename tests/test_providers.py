@@ -0,0 +1,132 @@
+"""
+app.providers のレート制限・サーキットブレーカー・ヘッジリクエストの単体テスト (APIは呼ばない)。
+"""
+import asyncio
+import time
+
+import pytest
+
+from app import metrics
+from app.providers import CircuitBreaker, LLMCallError, LLMProvider, LLMRouter, RateLimiter
+
+
+class FakeProvider(LLMProvider):
+    """acomplete が latency 秒待ってから応答するプロバイダー。"""
+
+    def __init__(self, name: str, latency: float, requests_per_minute: float = 0, p95: float | None = None):
+        super().__init__(name, "fake", requests_per_minute)
+        self.latency = latency
+        self.calls = 0
+        if p95 is not None:
+            # ヘッジの判断に使う応答時間を埋める
+            for _ in range(50):
+                self.stats.record_success(p95)
+
+    async def acomplete(self, messages, temperature, max_tokens, json_mode=False, purpose="label"):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return f"{self.name}-response"
+
+
+def _complete(router: LLMRouter, provider: LLMProvider):
+    return router.complete(provider, [{"role": "user", "content": "test"}], temperature=0.0, max_tokens=8)
+
+
+def test_rate_limiter_releases_cancelled_reservation():
+    async def scenario():
+        limiter = RateLimiter(60 / 0.5)
+        await limiter.acquire()
+        assert not limiter.try_acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0.05)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        # 取り消した予約が返されたため、次の呼び出しは最初の呼び出しの直後の枠を使える
+        started = time.monotonic()
+        await limiter.acquire()
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 0.5
+
+
+def test_circuit_breaker_allows_single_probe_when_half_open():
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=0.05)
+    assert breaker.admit() == "closed"
+    breaker.record_failure()
+    assert breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.admit() is None
+
+    time.sleep(0.06)
+    assert breaker.state == "half_open"
+    assert breaker.available()
+    assert breaker.admit() == "probe"
+    # 試験の呼び出しの結果が出るまで、他の呼び出しは通さない
+    assert not breaker.available()
+    assert breaker.admit() is None
+    assert 0 < breaker.retry_in() <= 1.0
+
+    breaker.release_probe()
+    assert breaker.admit() == "probe"
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.admit() == "closed"
+
+
+def test_failed_probe_reopens_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.admit() == "probe"
+    assert breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_complete_rejects_call_while_probe_in_flight():
+    provider = FakeProvider("groq", latency=0.0)
+    provider.breaker = CircuitBreaker(failure_threshold=1, cooldown=0.0)
+    provider.breaker.record_failure()
+    assert provider.breaker.admit() == "probe"
+
+    with pytest.raises(LLMCallError) as excinfo:
+        asyncio.run(_complete(LLMRouter([provider]), provider))
+    assert excinfo.value.kind == "circuit_open"
+    assert provider.calls == 0
+
+
+def test_rate_limit_wait_does_not_trigger_hedge():
+    # 1回あたり 0.05 秒で返るが、レート制限で 0.15 秒ずつ待つ。待ち時間はヘッジまでの時間に含めない
+    provider = FakeProvider("groq", latency=0.03, requests_per_minute=60 / 0.15, p95=0.05)
+    router = LLMRouter([provider])
+
+    async def scenario():
+        for _ in range(3):
+            responder, text = await _complete(router, provider)
+            assert responder is provider
+
+    with metrics.collect_stage_timings() as timings:
+        asyncio.run(scenario())
+    assert provider.calls == 3
+    assert timings.counters["llm_hedged_requests_total"] == 0
+
+
+def test_hedge_skipped_without_free_rate_slot():
+    provider = FakeProvider("groq", latency=0.2, requests_per_minute=60 / 10, p95=0.02)
+    with metrics.collect_stage_timings() as timings:
+        responder, text = asyncio.run(_complete(LLMRouter([provider]), provider))
+    assert text == "groq-response"
+    assert provider.calls == 1
+    assert timings.counters["llm_hedged_requests_total"] == 0
+    assert timings.counters["llm_hedge_skipped_total"] == 1
+    # ヘッジのために次の枠を予約していない
+    assert provider.rate_limiter._next_slot - time.monotonic() <= 10
+
+
+def test_hedge_uses_other_provider_when_primary_is_slow():
+    slow = FakeProvider("groq", latency=0.5, p95=0.02)
+    fast = FakeProvider("local", latency=0.01)
+    responder, text = asyncio.run(_complete(LLMRouter([slow, fast]), slow))
+    assert responder is fast
+    assert text == "local-response"
+    assert slow.calls == 1 and fast.calls == 1
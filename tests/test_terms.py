@@ -0,0 +1,60 @@
+"""
+app.terms の用語の文書頻度 (TermStat) の加算とキーワード抽出の単体テスト。
+"""
+import numpy as np
+
+from app.models import AnalysisSession, Comment, TermStat
+from app.terms import _update_document_counts, analyze_terms, tokenize
+
+
+def _counts(db) -> dict:
+    return dict(db.query(TermStat.term, TermStat.document_count).all())
+
+
+def test_update_document_counts_increments_existing_terms(db):
+    _update_document_counts(db, np.array(["音声", "資料"]), np.array([2, 0]))
+    db.commit()
+    _update_document_counts(db, np.array(["音声", "資料", "板書"]), np.array([3, 1, 4]))
+    db.commit()
+    assert _counts(db) == {"音声": 5, "資料": 1, "板書": 4}
+
+
+def test_concurrent_sessions_add_the_same_new_term(db_factory):
+    # 2つのセッションが、まだ TermStat にない同じ用語をそれぞれ加算する (以前は2件目の INSERT が主キー違反になった)
+    first, second = db_factory(), db_factory()
+    try:
+        _update_document_counts(first, np.array(["音声"]), np.array([2]))
+        first.commit()
+        _update_document_counts(second, np.array(["音声"]), np.array([3]))
+        second.commit()
+        assert _counts(first) == {"音声": 5}
+    finally:
+        first.close()
+        second.close()
+
+
+def _add_session(db, texts: list) -> AnalysisSession:
+    analysis_session = AnalysisSession(csv_filename="test.csv", batch_id="test")
+    db.add(analysis_session)
+    db.flush()
+    db.add_all(Comment(text=text, session_id=analysis_session.id, ingest_session_id=analysis_session.id, category="授業内容")
+               for text in texts)
+    db.commit()
+    return analysis_session
+
+
+def test_analyze_terms_adds_each_session_once(db):
+    first = _add_session(db, ["音声が聞こえない", "音声が途切れる", "スライドが見やすい"])
+    second = _add_session(db, ["音声が小さい", "板書が見えない"])
+    analyze_terms(db, first)
+    analyze_terms(db, second)
+    assert _counts(db)["音声"] == 3
+    # 再計算では文書頻度を加算しない
+    keywords = analyze_terms(db, first)
+    assert _counts(db)["音声"] == 3
+    assert keywords["documents"] == 3
+    assert keywords["overall"][0]["term"] == "音声"
+
+
+def test_bigram_tokenizer_splits_kanji_runs():
+    assert tokenize("講義資料がほしい", "bigram") == ["講義", "義資", "資料"]